@@ -9,6 +9,7 @@ from __future__ import division
 
 import sys, utilities, os
 from chemistry.amber.readparm import amberParm
+from mdcrd import load_data
 
 acceptorlist = {'ASP' : 'CG', 'AS4' : 'CG', 'GLU' : 'CD', 'GL4' : 'CD'}
 donorlist = {'AS4' : 'CG', 'ASH' : 'CG', 'GL4' : 'CD', 'GLH' : 'CD', 'LYS' : 'NZ', 'ARG' : 'CZ'}
@@ -106,7 +107,7 @@ for x in range(len(pairs)):
    don_index = pairs[x][1]
    don_atom = donorlist[residues[don_index-1]]
 
-   file.write('distance {0}_{1} :{0}@{2} :{1}@{3} out _FSB_{0}_{1}.dat\n'.format(acc_index, don_index, acc_atom, don_atom))
+   file.write('distance {0}_{1} :{0}@{2} :{1}@{3} out _FSB_dist.dat\n'.format(acc_index, don_index, acc_atom, don_atom))
 
 file.close()
 
@@ -116,16 +117,14 @@ print 'Done with cpptraj...'
 
 outputfile = open(output,'w')
 
+# all of the distances are columns of one data file, in the order of pairs
+if len(pairs) > 0:
+   distances = load_data('_FSB_dist.dat', structured=True)
+
 for x in range(len(pairs)):
-   file = open('_FSB_{0}_{1}.dat'.format(pairs[x][0],pairs[x][1]),'r')
-   within = 0.0
-   total = 0.0
-   for line in file:
-      words = line.split()
-      if float(words[1]) < tolerance:
-         within += 1.0
-      total += 1.0
-   file.close()
+   column = distances[distances.dtype.names[x+1]]
+   within = float((column < tolerance).sum())
+   total = float(len(column))
    if within / total >= fraction:
       outputfile.write('{0} {1} - {2} {3} : Fraction {4:.3f}\n'.format(residues[pairs[x][0]-1].ljust(3), str(pairs[x][0]).rjust(3),
                  residues[pairs[x][1]-1].ljust(3), str(pairs[x][1]).rjust(3), within / total))
@@ -99,6 +99,34 @@ printf "   Checking mdcrd.py log file:  "
 diff -Nru mdcrd_py.log.check mdcrd_py.log > mdcrd_py.log.diff
 test_cleanup $? mdcrd_py.log.diff
 /bin/rm -f AmberTraj_RMSD.dat mdcrd_py.log
+
+python ../mdcrd.py -n 3 -p trpcage.nowat.parm7 trpcage.solv5.[1-5]_remd12.nc > /dev/null
+
+printf "   Checking parallel RMSD data: "
+diff -Nru AmberTraj_RMSD.dat.check AmberTraj_RMSD.dat > AmberTraj_RMSD.par.diff
+test_cleanup $? AmberTraj_RMSD.par.diff
+/bin/rm -f AmberTraj_RMSD.dat mdcrd_py.log
+
+printf "   Checking parallel 'first' RMSD: "
+python - > mdcrd_first.diff 2>&1 << EOF
+import sys
+sys.path.insert(0, "..")
+import numpy as np
+import mdcrd
+trajs = ["trpcage.solv5.%d_remd12.nc" % i for i in range(1, 6)]
+t = mdcrd.AmberTraj("trpcage.nowat.parm7", trajs, logfile="mdcrd_first.log",
+                    overwrite=True)
+# A data set named 'first' must not be taken for the reference argument
+t.rmsd(setname="first", capture=True)
+t.run(3)
+ref = mdcrd.RmsdData("AmberTraj_RMSD.dat.check").data
+rmsd = t.data.get("first", np.zeros(0))
+if not (rmsd.shape == ref.shape and np.allclose(rmsd, ref, atol=1.e-4)):
+  print "RMSDs to the first frame differ from AmberTraj_RMSD.dat.check"
+  sys.exit(1)
+EOF
+test_cleanup $? mdcrd_first.diff
+/bin/rm -f mdcrd_first.log
 echo "============================================================"
 echo "Testing remd.py"
 python ../remd.py -l rem1.log -t TEMP -o tmp
@@ -112,5 +140,23 @@ printf "   Checking pH-REM log analysis: "
 diff -Nru ph_remlog.stats.check tmp > ph_remlog.stats.diff
 test_cleanup $? ph_remlog.stats.diff
 echo "============================================================"
+echo "Testing coords.GzipSeekFile"
+printf "   Checking line reads across buffers: "
+python - > gzipseek.diff 2>&1 << EOF
+import sys, gzip
+sys.path.insert(0, "../UCSB_Python_Mods")
+import coords
+f = gzip.open("gzipseek.tmp.gz", "wb")
+for i in range(20000): f.write("%d %s\n" % (i, "x" * (i % 37)))
+f.close()
+Ref = gzip.open("gzipseek.tmp.gz", "rb").readlines()
+Lines = list(coords.GzipSeekFile("gzipseek.tmp.gz"))
+if not Lines == Ref:
+  print "Read %d lines, expected %d" % (len(Lines), len(Ref))
+  sys.exit(1)
+EOF
+test_cleanup $? gzipseek.diff
+/bin/rm -f gzipseek.tmp.gz
+echo "============================================================"
 
 /bin/rm -f tmp
@@ -7,7 +7,7 @@ and a reference pdb file.  Produces a new pdb file with "-fluct" appended.
 
 Usage     : calcfluct.py TRJFILE PRMTOPFILE REFPDB [NSKIP NREAD NSTRIDE]
 
-trjfile   : trajectory CRD file (can be gzipped)
+trjfile   : trajectory CRD file (can be gzipped) or NetCDF file
 prmtopfile: PARM7 file
 nskip     : number of configs in trajectory to skip (default is 0)
 nread     : number of configs in trajectory to read; -1 is all (default -1)
@@ -36,7 +36,7 @@ else:
   NStride = 1
 
 RefPos = coords.GetPdbCoords(PdbFile)
-t = coords.TrjClass(TrjFile, PrmtopFile, 
+t = coords.GetTrjObj(TrjFile, PrmtopFile,
     NRead = NRead, NSkip = NSkip, NStride = NStride)
 
 NAtom = len(RefPos)
@@ -44,11 +44,11 @@ print "Found %d atoms" % NAtom
 dSq = zeros(NAtom, float)
 N = 0
 
-for Pos in t:
-  N += 1
-  r = rmsd.RMSD(RefPos, Pos, Align = True)
-  dSq += ((RefPos - Pos)**2).sum(axis=1)
-  if N % 100 == 0: print "Analyzed %d frames" % N
+for PosStack in t.IterChunks(100, Reuse = True):
+  r, PosStack = rmsd.RMSDBatch(RefPos, PosStack, RetAligned = True)
+  dSq += ((RefPos - PosStack)**2).sum(axis=2).sum(axis=0)
+  N += len(PosStack)
+  print "Analyzed %d frames" % N
 dSq = dSq/N
 dSq = sqrt(dSq)
 print "Analyzed %d frames" % N
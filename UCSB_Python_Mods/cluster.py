@@ -24,6 +24,23 @@ OPTIONS   : "--rmsd=X" to set the rmsd tolerance (default 2.0)
             "--prefix=X" to change the output prefix (default "clust")
             "--compres='1,3-5'" to use residues 1 and 3-5 to minimize RMSD
             "--calcres='1-5,9'" to calculate rmsd only for residues 1-5 and 9
+            "--prefetch=X" parse the next X pdb files ahead in worker processes
+            "--pdbcache=X" cache parsed pdb coordinates in X.cache.npy so that
+                           later runs on the same files skip pdb parsing
+            "--method=X" clustering method: "mss" to cluster around average
+                         structures in passes over the configs (default),
+                         "medoids" for k-medoids with maxclust clusters, or
+                         "linkage" for average-linkage clustering, merging
+                         clusters closer than the rmsd tolerance; linkage
+                         works on a copy of the rmsd matrix (4*N*N/2 bytes)
+                         kept in memory, or on disk next to the matrix file,
+                         much more slowly, when memory is short
+            "--matrix=X" pairwise rmsd matrix file for the medoids and linkage
+                         methods (default PREFIXrmsd.npy); it is reused by later
+                         runs only if it was built from the same files, frames,
+                         atoms, and residue selections, and an interrupted
+                         calculation resumes from it
+            "--nproc=X" number of processes for the rmsd matrix (default all cpus)
 """
 
 #check for instructions
@@ -55,6 +72,15 @@ if __name__ == '__main__':
   Prefix = Args.get("prefix", "clust")
   CompResInd = scripttools.GetNumList(Args.get("compres", None), Offset = -1)
   CalcResInd = scripttools.GetNumList(Args.get("calcres", None), Offset = -1)
+  Prefetch = int(Args.get("prefetch", 0))
+  PdbCache = Args.get("pdbcache", None)
+  Method = Args.get("method", "mss").lower()
+  MatrixFile = Args.get("matrix", Prefix + "rmsd.npy")
+  NProc = Args.get("nproc", None)
+  if not NProc is None: NProc = int(NProc)
+  if not Method in ["mss", "medoids", "linkage"]:
+    print "Unrecognized clustering method %s." % Method
+    sys.exit()
 
   #decide mask
   if "allatom" in Args["FLAGS"]:
@@ -71,12 +97,13 @@ if __name__ == '__main__':
   if ".pdb" in Args[1]:
     Mode = 0
     PdbFiles = Args["ARGS"][1:]
-    cobj = coords.PdbListClass(PdbFiles, Mask = Mask)
+    cobj = coords.PdbListClass(PdbFiles, Mask = Mask, Prefetch = Prefetch,
+                               CoordCache = PdbCache)
   else:
     Mode = 1
     TrjFile, PrmtopFile = Args[1], Args[2]
-    cobj = coords.TrjClass(TrjFile, PrmtopFile, Mask = Mask,
-                           NRead = NRead, NSkip = NSkip, NStride = NStride)
+    cobj = coords.GetTrjObj(TrjFile, PrmtopFile, Mask = Mask,
+                            NRead = NRead, NSkip = NSkip, NStride = NStride)
 
   #examine any residue specific masks
   AtomInd, CompInd, CalcInd = rmsd.GetCoordsObjMasks(cobj, AtomMask = Mask,
@@ -84,9 +111,19 @@ if __name__ == '__main__':
                                                      CalcResInd = CalcResInd)
 
   #run the cluster algorithm
-  Pos, ClustNum, ClustWeights, ClustPop, ConfRmsd, ClustRmsd = rmsd.ClusterMSS(cobj,
-    RmsdTol, MaxIter = MaxIter, MaxCluster = MaxCluster, MaxClusterWork = MaxClusterWork,
-    Method = 0, CompInd = CompInd, CalcInd = CalcInd)
+  if Method == "mss":
+    Pos, ClustNum, ClustWeights, ClustPop, ConfRmsd, ClustRmsd = rmsd.ClusterMSS(cobj,
+      RmsdTol, MaxIter = MaxIter, MaxCluster = MaxCluster, MaxClusterWork = MaxClusterWork,
+      Method = 0, CompInd = CompInd, CalcInd = CalcInd)
+  else:
+    Mat = rmsd.CalcRMSDMatrix(cobj, MatrixFile, CompInd = CompInd, CalcInd = CalcInd,
+                              NProc = NProc)
+    if Method == "medoids":
+      Pos, ClustNum, ClustWeights, ClustPop, ConfRmsd, ClustRmsd = rmsd.ClusterMedoids(cobj,
+        Mat, abs(MaxCluster))
+    else:
+      Pos, ClustNum, ClustWeights, ClustPop, ConfRmsd, ClustRmsd = rmsd.ClusterLinkage(cobj,
+        Mat, RmsdTol, MaxCluster = MaxCluster)
   Indices = cobj.GetIndices()
 
   if Mode == 0:
@@ -94,8 +131,9 @@ if __name__ == '__main__':
     for (i, Posi) in enumerate(Pos):
       pc = 100. * float(ClustWeights[i]) / float(sum(ClustWeights))
       fn = Prefix + "%02d_%.0fpc.pdb" % (i+1, pc)
-      if -i in ClustNum:
-        j = ClustNum.index(-i)
+      #use a member of the cluster as the pdb template
+      if i+1 in ClustNum:
+        j = list(ClustNum).index(i+1)
       else:
         j = 0
       coords.SavePdbCoordsPdb(Posi, fn, PdbFiles[j])
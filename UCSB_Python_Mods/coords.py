@@ -6,7 +6,10 @@
 #coordinate file formats.  Currently: pdb and amber trajectory.
 
 from numpy import *
-import copy, os, gzip, pdbtools
+from numpy.lib.format import open_memmap
+import copy, os, re, gzip, zlib, bisect, time, string, cPickle, json, pdbtools
+import multiprocessing
+from collections import OrderedDict
 
 #Masks for backbone atoms
 NoMask = []
@@ -16,6 +19,45 @@ BackboneMask = ["CA", "C", "N"]
 AlphaCarbonMask = ["CA"]
 Caps = ["NHE","NME","ACE"]
 
+#Whether or not to save trajectory frame offsets in a sidecar file
+#(e.g., traj.crd.idx) and reuse them on later opens
+UseTrjIndex = True
+#Extension of the trajectory index sidecar files
+TrjIndexExt = ".idx"
+#Version of the trajectory index format
+TrjIndexVer = 1
+
+#Extensions of the binary trajectory cache files (float32 .npy data
+#and a JSON header), e.g., traj.crd.cache.npy and traj.crd.cache.json
+TrjCacheExt = ".cache.npy"
+TrjCacheHeadExt = ".cache.json"
+#Version of the trajectory cache format
+TrjCacheVer = 1
+#Version of the pdb list coordinate cache format; coordinates are kept
+#as int32 thousandths of an angstrom, which is exact for pdb files
+PdbCacheVer = 2
+
+#Number of uncompressed bytes between decompressor checkpoints
+#in random-access gzip files
+GzipCheckpointSpacing = 8388608
+
+#Checkpoints for gzip files opened by name, shared between file
+#objects; keyed by absolute path, with values (size, mtime, points),
+#and holding at most GzipPointCacheSize of the most recent files
+GzipPointCache = OrderedDict()
+GzipPointCacheSize = 32
+
+#Indexed prmtop files, shared by all readers in the process; keyed by
+#absolute path, with values (size, mtime, PrmtopIndex)
+PrmtopCache = {}
+
+#Maps blanks and signs in fixed-width numeric fields to zero digits
+FixedWidthTrans = string.maketrans(" +-", "000")
+FixedWidthTable = frombuffer(FixedWidthTrans, dtype = uint8)
+#Format strings for whole blocks of fixed-width fields, keyed by
+#(field format, number of values, values per line)
+FixedWidthFmts = {}
+
 
 def GetPdbSeq(PdbFile):
   "Gets the sequence from a PdbFile."
@@ -44,6 +86,36 @@ def GetPdbCoords(PdbFile, Mask = NoMask):
   else:
     raise IOError, "Pdb file does not exist."
 
+def GetPdbNameKey(Lines):
+  """Returns a string of the atom name fields tested by masks for a list
+of ATOM records; files with the same key select the same atoms."""
+  return "".join([s[13:15].ljust(2) for s in Lines])
+
+def GetPdbMaskInd(PdbFile, Mask):
+  """Returns (Names, AtomInd) for a Pdb file, where Names is the atom name
+key of its ATOM records (see GetPdbNameKey) and AtomInd the indices of
+those matching Mask (None if there is no mask), using the same atom name
+test as GetPdbCoords."""
+  Lines = [s for s in open(PdbFile, "rU") if s[0:4] == "ATOM"]
+  Names = GetPdbNameKey(Lines)
+  if Mask == NoMask: return Names, None
+  AtomInd = [i for (i, s) in enumerate(Lines) if s[13:15].strip() in Mask]
+  return Names, array(AtomInd, int)
+
+def GetPdbCoordsInd(PdbFile, AtomInd = None, Names = None):
+  """Gets coordinates of the ATOM records with indices AtomInd (default
+is all) from a Pdb file.  Returns None if Names is given and the file
+has a different atom name key, i.e., different or reordered atoms."""
+  Lines = [s for s in open(PdbFile, "rU") if s[0:4] == "ATOM"]
+  if not Names is None and not GetPdbNameKey(Lines) == Names: return None
+  if not AtomInd is None: Lines = [Lines[i] for i in AtomInd]
+  try:
+    Pos = ParseFixedWidth("".join([s[30:54].ljust(24) for s in Lines]), 8)
+  except ValueError:
+    Pos = array([[float(s[30:38]), float(s[38:46]), float(s[46:54])]
+                 for s in Lines], float)
+  return Pos.reshape((-1, 3))
+
 def SavePdbCoordsPdb(Pos, PdbFile, PdbTmplFile, Mask = NoMask):
   "Saves a coordinate array to a pdb file using a template pdb file."
   if os.path.isfile(PdbTmplFile):
@@ -97,7 +169,46 @@ def SavePdbCoordsObj(Pos, CoordsObj, PdbFile, Mask = NoMask, Standardize = True)
   SavePdbCoords(Pos, CoordsObj.AtomNames, CoordsObj.AtomRes,
                 CoordsObj.Seq, PdbFile, Mask = Mask, Standardize = Standardize)
 
-def ParseCrdString(s, AtomNames = [], Mask = NoMask):
+def DecodeFixedWidth(b, d = None):
+  """Decodes an array of fixed-width numeric fields, one field per row of
+the uint8 array b, into a flat float array.  Fortran f-format fields are
+decoded as digit columns over all fields at once, so there is no Python
+loop over values; anything else (e.g., exponents) is left to numpy's
+string conversion.
+* d: optional copy of b with blanks and signs already mapped to zeros"""
+  FieldLen = b.shape[1]
+  if len(b) == 0: return zeros(0, float)
+  #fast path: the point is in the same column of every field; blanks
+  #and signs are then just leading zeros of the integer mantissa
+  j = flatnonzero(b[0] == 46)
+  if len(j) == 1 and all(b[:,j[0]] == 46):
+    j = j[0]
+    if d is None: d = FixedWidthTable[b]
+    d = d - uint8(48)
+    d[:,j] = 0
+    if d.max() <= 9:
+      Pow = 10.**arange(FieldLen - 1)[::-1]
+      Weights = concatenate((Pow[:j], [0.], Pow[j:]))
+      #the mantissas are exact integers and the divisor is an exact power
+      #of ten, so this rounds the same way float() does
+      Pos = dot(d.astype(float), Weights) / 10.**(FieldLen - 1 - j)
+      Pos[flatnonzero(b == 45) / FieldLen] *= -1.
+      return Pos
+  return ascontiguousarray(b).view("S%d" % FieldLen).ravel().astype(float)
+
+def ParseFixedWidth(s, FieldLen = 8):
+  """Parses a string of fixed-width numeric fields into a flat float array.
+Line breaks are ignored, as in the Amber crd and rst formats."""
+  s = s.replace("\n", "")
+  r = mod(len(s), FieldLen)
+  if r > 0: s = s + " " * (FieldLen - r)
+  if len(s) == 0: return zeros(0, float)
+  b = frombuffer(s, dtype = uint8).reshape((-1, FieldLen))
+  #translating the whole string is faster than a table lookup
+  d = frombuffer(s.translate(FixedWidthTrans), dtype = uint8)
+  return DecodeFixedWidth(b, d.reshape((-1, FieldLen)))
+
+def ParseCrdStringOld(s, AtomNames = [], Mask = NoMask):
   """Takes a text string of Crd coordinates and parses into an array."""
   #parse into a n by 3 array
   try:
@@ -115,8 +226,97 @@ def ParseCrdString(s, AtomNames = [], Mask = NoMask):
   else:
     raise ValueError, "Improper number of coordinates found in Crd string."
 
+def ParseCrdString(s, AtomNames = [], Mask = NoMask):
+  """Takes a text string of Crd coordinates and parses into an array."""
+  #parse into a n by 3 array
+  try:
+    Pos = ParseFixedWidth(s, 8)
+  except ValueError:
+    raise ValueError, "Improper number of coordinates found in Crd string."
+  if mod(len(Pos), 3) == 0:
+    Pos = reshape(Pos, (-1,3))
+    #if using mask remove the extraneous coordinates
+    if not Mask == NoMask and len(AtomNames) == len(Pos):
+      Pos = compress([a.strip() in Mask for a in AtomNames], Pos, 0)
+    return Pos
+  else:
+    raise ValueError, "Improper number of coordinates found in Crd string."
+
+def ParseCrdFrames(s, NAtom, AtomNames = [], Mask = NoMask):
+  """Takes a text string of one or more consecutive Crd frames and parses
+into an array of dimensions [NFrame, NAtom, 3]."""
+  try:
+    Pos = ParseFixedWidth(s, 8)
+  except ValueError:
+    raise ValueError, "Improper number of coordinates found in Crd string."
+  if NAtom > 0 and mod(len(Pos), 3 * NAtom) == 0:
+    Pos = reshape(Pos, (-1, NAtom, 3))
+    #if using mask remove the extraneous coordinates
+    if not Mask == NoMask and len(AtomNames) == NAtom:
+      Pos = compress([a.strip() in Mask for a in AtomNames], Pos, 1)
+    return Pos
+  else:
+    raise ValueError, "Improper number of coordinates found in Crd string."
+
 
-def ParseRstString(s, AtomNames = [], Mask = NoMask):
+def GetMaskInd(AtomNames, Mask):
+  """Returns an array of the indices of atoms whose names are in Mask,
+or None if there is no mask."""
+  if Mask == NoMask: return None
+  return array([i for (i, a) in enumerate(AtomNames) if a.strip() in Mask], int)
+
+def GetCrdByteInd(NAtom, AtomInd, NPerLine = 10):
+  """Returns (FrameLen, ByteInd, NewlineInd) for picking atoms out of
+an Amber crd frame without decoding the rest of it.
+* FrameLen: number of bytes in a frame
+* ByteInd: [3*len(AtomInd), 8] array of byte positions of the atoms' fields
+* NewlineInd: byte positions of the line breaks in a frame"""
+  NField = 3 * NAtom
+  NLine = NField / NPerLine
+  if NField % NPerLine > 0: NLine += 1
+  FrameLen = 8 * NField + NLine
+  Fields = (3 * asarray(AtomInd, int)[:,newaxis] + arange(3)).ravel()
+  ByteInd = (8 * Fields + Fields / NPerLine)[:,newaxis] + arange(8)
+  NewlineInd = minimum(arange(1, NLine + 1) * (8 * NPerLine + 1), FrameLen) - 1
+  return FrameLen, ByteInd, NewlineInd
+
+def ParseCrdAtoms(s, NAtom, AtomInd, CrdByteInd = None):
+  """Takes a text string of one or more consecutive Crd frames and parses
+only the atoms in AtomInd into an array of dimensions [NFrame, NAtom, 3].
+Fields of other atoms are never decoded.
+* CrdByteInd: optional precomputed result of GetCrdByteInd(NAtom, AtomInd)"""
+  if CrdByteInd is None: CrdByteInd = GetCrdByteInd(NAtom, AtomInd)
+  FrameLen, ByteInd, NewlineInd = CrdByteInd
+  if len(s) > 0 and len(s) % FrameLen == 0:
+    b = frombuffer(s, dtype = uint8).reshape((-1, FrameLen))
+    #only use byte positions if every line has the standard width
+    if all(b[:,NewlineInd] == 10):
+      NFrame = len(b)
+      Pos = DecodeFixedWidth(b[:,ByteInd].reshape((-1, 8)))
+      return Pos.reshape((NFrame, -1, 3))
+  Pos = ParseCrdFrames(s, NAtom)
+  return Pos.take(AtomInd, axis = 1)
+
+
+def GetFixedWidthFmt(N, Fmt = "%12.7f", NPerLine = 6):
+  """Returns a cached format string for N fixed-width fields written
+NPerLine to a line; every line, including the last, ends in a newline."""
+  Key = (Fmt, N, NPerLine)
+  if not Key in FixedWidthFmts:
+    n, r = divmod(N, NPerLine)
+    s = (Fmt * NPerLine + "\n") * n
+    if r > 0: s += Fmt * r + "\n"
+    FixedWidthFmts[Key] = s
+  return FixedWidthFmts[Key]
+
+def FormatFixedWidth(Vals, Fmt = "%12.7f", NPerLine = 6):
+  """Formats an array of values into lines of NPerLine fixed-width fields,
+as in the Amber crd and rst formats, with a single string format
+operation.  Every line, including the last, ends in a newline."""
+  Vals = asarray(Vals, float).ravel()
+  return GetFixedWidthFmt(len(Vals), Fmt, NPerLine) % tuple(Vals.tolist())
+
+def ParseRstStringOld(s, AtomNames = [], Mask = NoMask):
   """Takes a text string of Rst coordinates and parses into an array;
 Note that this will return velocities as well."""
   #parse into a n by 3 array
@@ -135,8 +335,148 @@ Note that this will return velocities as well."""
   else:
     raise IOError, "Improper number of coordinates found in Rst file."
 
+def ParseRstString(s, AtomNames = [], Mask = NoMask):
+  """Takes a text string of Rst coordinates and parses into an array;
+Note that this will return velocities as well."""
+  #parse into a n by 3 array
+  try:
+    Pos = ParseFixedWidth(s, 12)
+  except ValueError:
+    raise ValueError, "Improper number of coordinates found in Crd string."
+  if mod(len(Pos), 3) == 0:
+    Pos = reshape(Pos, (-1,3))
+    #if using mask remove the extraneous coordinates
+    if not Mask == NoMask and len(AtomNames) == len(Pos):
+      Pos = compress([a.strip() in Mask for a in AtomNames], Pos, 0)
+    return Pos
+  else:
+    raise IOError, "Improper number of coordinates found in Rst file."
+
 
-def GetPrmtopBlock(PrmtopFile, Flag, BlockLen = None):
+class PrmtopIndex:
+  """Index of the %FLAG sections of an Amber prmtop file.  The file is
+read once; the byte range and %FORMAT of every flag are recorded, and a
+section is only parsed when it is first asked for."""
+
+  def __init__(self, PrmtopFile):
+    """Reads and indexes a prmtop file.
+* PrmtopFile: string name of prmtop file"""
+    if not os.path.isfile(PrmtopFile):
+      raise IOError, "Could not find Prmtop file."
+    self.PrmtopFile = PrmtopFile
+    f = open(PrmtopFile, "rU")
+    self.Data = f.read()
+    f.close()
+    #dictionary of flag name to (start byte, stop byte, format)
+    self.Flags = {}
+    #flag names in file order
+    self.FlagNames = []
+    #parsed sections
+    self.__Blocks = {}
+    self.__Arrays = {}
+    Pos = 0
+    while True:
+      Pos = self.Data.find("%FLAG", Pos)
+      if Pos < 0: break
+      if Pos > 0 and not self.Data[Pos-1] == "\n":
+        Pos += 5
+        continue
+      i = self.Data.find("\n", Pos)
+      if i < 0: i = len(self.Data)
+      Name = self.Data[Pos+5:i].strip()
+      #skip the format and any comment lines
+      Fmt = None
+      Start = i + 1
+      while self.Data.startswith("%", Start) and not self.Data.startswith("%FLAG", Start):
+        i = self.Data.find("\n", Start)
+        if i < 0: i = len(self.Data)
+        if self.Data.startswith("%FORMAT", Start):
+          Fmt = self.__ParseFormat(self.Data[Start:i])
+        Start = i + 1
+      Start = min(Start, len(self.Data))
+      Stop = self.Data.find("\n%", Start - 1)
+      if Stop < 0:
+        Stop = len(self.Data)
+      else:
+        Stop += 1
+      self.Flags[Name] = (Start, Stop, Fmt)
+      self.FlagNames.append(Name)
+      Pos = Stop
+
+  def __ParseFormat(self, s):
+    """Returns (type, width) for a Fortran format line like %FORMAT(10I8)."""
+    m = re.search(r"\(\s*\d*\s*([aAiIeEfF])\s*(\d+)", s)
+    if m is None: return None
+    return m.group(1).upper(), int(m.group(2))
+
+  def __FlagName(self, Flag):
+    "Strips a leading %FLAG from a flag name."
+    Flag = Flag.strip()
+    if Flag.startswith("%FLAG"): Flag = Flag[5:].strip()
+    return Flag
+
+  def __contains__(self, Flag):
+    return self.__FlagName(Flag) in self.Flags
+
+  def GetString(self, Flag):
+    "Returns the raw text of a flag section, or an empty string if missing."
+    Flag = self.__FlagName(Flag)
+    if not Flag in self.Flags: return ""
+    Start, Stop, Fmt = self.Flags[Flag]
+    return self.Data[Start:Stop]
+
+  def GetBlock(self, Flag, BlockLen = None):
+    """Returns a flag section as a list of strings, split on whitespace or
+into fields of BlockLen characters, as for GetPrmtopBlock."""
+    Key = (self.__FlagName(Flag), BlockLen)
+    if not Key in self.__Blocks:
+      Lines = self.GetString(Flag).split("\n")[:-1]
+      if BlockLen is None:
+        Dat = " ".join(Lines).split()
+      else:
+        Dat = [l[i:i+BlockLen] for l in Lines for i in xrange(0, len(l), BlockLen)]
+      self.__Blocks[Key] = Dat
+    return list(self.__Blocks[Key])
+
+  def Get(self, Flag):
+    """Returns a flag section as a numpy array typed by its %FORMAT:
+integers for I, floats for E and F, and strings for A."""
+    Flag = self.__FlagName(Flag)
+    if not Flag in self.__Arrays:
+      if not Flag in self.Flags:
+        raise KeyError, "Could not find %s in prmtop file." % Flag
+      Start, Stop, Fmt = self.Flags[Flag]
+      if Fmt is None:
+        raise ValueError, "Unknown format for %s in prmtop file." % Flag
+      Type, Width = Fmt
+      if Type == "A":
+        Dat = array(self.GetBlock(Flag, Width), "S%d" % Width)
+      else:
+        Dat = self.Data[Start:Stop].replace("\n", "")
+        Dat = Dat[:len(Dat) - len(Dat) % Width]
+        Dat = frombuffer(Dat, "S%d" % Width)
+        if Type == "I":
+          Dat = Dat.astype(int)
+        else:
+          Dat = Dat.astype(float)
+      self.__Arrays[Flag] = Dat
+    return self.__Arrays[Flag]
+
+
+def GetPrmtopIndex(PrmtopFile):
+  """Returns the PrmtopIndex for a prmtop file, shared process-wide
+and rebuilt only if the file's size or modification time changes."""
+  if not os.path.isfile(PrmtopFile):
+    raise IOError, "Could not find Prmtop file."
+  Key = os.path.abspath(PrmtopFile)
+  Stat = os.stat(PrmtopFile)
+  Val = PrmtopCache.get(Key, None)
+  if Val is None or Val[:2] != (Stat.st_size, Stat.st_mtime):
+    Val = (Stat.st_size, Stat.st_mtime, PrmtopIndex(PrmtopFile))
+    PrmtopCache[Key] = Val
+  return Val[2]
+
+def GetPrmtopBlockOld(PrmtopFile, Flag, BlockLen = None):
   "Gets Prmtop data for a specified Flag."
   if os.path.isfile(PrmtopFile):
     f = open(PrmtopFile, "rU")
@@ -158,6 +498,10 @@ def GetPrmtopBlock(PrmtopFile, Flag, BlockLen = None):
     raise IOError, "Could not find Prmtop file."
     return None
 
+def GetPrmtopBlock(PrmtopFile, Flag, BlockLen = None):
+  "Gets Prmtop data for a specified Flag."
+  return GetPrmtopIndex(PrmtopFile).GetBlock(Flag, BlockLen)
+
 def GetPrmtopAtomNames(PrmtopFile):
   "Gets the names of atoms from a Prmtop file."
   Names = GetPrmtopBlock(PrmtopFile, "%FLAG ATOM_NAME", BlockLen = 4)
@@ -175,14 +519,14 @@ def GetPrmtopSeq(PrmtopFile):
 
 def GetPrmtopAtomRes(PrmtopFile):
   "Gets the atom's residue numbers from a Prmtop file."
-  ResPtr = GetPrmtopBlock(PrmtopFile, "%FLAG RESIDUE_POINTER", BlockLen = 8)
-  if ResPtr is None: return None
-  AtomNames = GetPrmtopAtomNames(PrmtopFile)
-  ResPtr = [int(x) for x in ResPtr] + [len(AtomNames) + 1]
-  AtomRes = []
-  for i in range(0, len(ResPtr)-1):
-    AtomRes.extend([i] * (ResPtr[i+1] - ResPtr[i]))
-  return AtomRes
+  Index = GetPrmtopIndex(PrmtopFile)
+  ResPtr = Index.Get("RESIDUE_POINTER")
+  NAtom = len(Index.GetBlock("ATOM_NAME", 4))
+  #residue number of each atom is the count of residue starts up to it
+  Starts = zeros(NAtom + 1, int)
+  add.at(Starts, ResPtr - 1, 1)
+  AtomRes = cumsum(Starts[:NAtom]) - 1
+  return AtomRes.tolist()
 
 
 def GetCrdCoords(CrdFile, PrmtopFile = "", Mask = NoMask):
@@ -203,18 +547,74 @@ def GetCrdCoords(CrdFile, PrmtopFile = "", Mask = NoMask):
     raise IOError, "Crd file not found."
 
 
+class CrdWriter:
+  """Appendable writer for Amber crd trajectories.  Frames are formatted
+as whole blocks with a format string built once per frame size, and
+files ending in .gz are written through a streaming gzip compressor.
+* CrdFile: name of the crd file
+* Mode: "w" to start a new file or "a" to append to an existing one
+* Head: True to write the title line; in "a" mode it is only written
+  if the file is missing or empty
+* Gzip: True or False to force compression; None to use the extension
+* Title: title line for a new file"""
+
+  def __init__(self, CrdFile, Mode = "w", Head = True, Gzip = None,
+               Title = "ACE"):
+    if Gzip is None: Gzip = CrdFile.endswith(".gz")
+    Mode = Mode.replace("b", "") + "b"
+    if Mode.startswith("a"):
+      Head = Head and (not os.path.isfile(CrdFile) or os.path.getsize(CrdFile) == 0)
+    if Gzip:
+      self.__fobj = gzip.GzipFile(CrdFile, Mode)
+    else:
+      self.__fobj = open(CrdFile, Mode)
+    self.CrdFile = CrdFile
+    self.NAtom = None
+    self.NFrame = 0
+    if Head:
+      self.__fobj.write(Title.ljust(80) + "\n")
+
+  def __len__(self):
+    "Returns the number of frames written so far."
+    return self.NFrame
+
+  def Write(self, Pos, Box = None):
+    """Writes one frame (NAtom x 3) or a batch of frames (NFrame x NAtom x 3).
+* Box: optional box lengths (3) or one set per frame (NFrame x 3)"""
+    Pos = asarray(Pos, float)
+    if Pos.ndim == 2: Pos = Pos[newaxis]
+    if not Pos.ndim == 3 or not Pos.shape[2] == 3:
+      raise ValueError, "Positions must be NAtom x 3 or NFrame x NAtom x 3."
+    NFrame, NAtom = Pos.shape[:2]
+    if self.NAtom is None:
+      self.NAtom = NAtom
+    elif not NAtom == self.NAtom:
+      raise IOError, "Frame has %d atoms; expected %d." % (NAtom, self.NAtom)
+    FrameFmt = GetFixedWidthFmt(3 * NAtom, "%8.3f", 10)
+    Vals = Pos.reshape((NFrame, -1))
+    if not Box is None:
+      Box = asarray(Box, float).reshape((-1, 3))
+      if len(Box) == 1: Box = Box.repeat(NFrame, axis = 0)
+      FrameFmt += GetFixedWidthFmt(3, "%8.3f", 10)
+      Vals = concatenate((Vals, Box), axis = 1)
+    #format blocks of about a million values at a time
+    n = max(1, 1000000 / Vals.shape[1])
+    for i in xrange(0, NFrame, n):
+      Block = Vals[i:i+n]
+      self.__fobj.write((FrameFmt * len(Block)) % tuple(Block.ravel().tolist()))
+    self.NFrame += NFrame
+
+  def Close(self):
+    "Closes the file."
+    self.__fobj.close()
+
+
 def SaveCrdCoords(Pos, CrdFile, Mode = "wb", Head = True):
-  "Saves coordinates to a Crd file."
-  NPerLine = 10
-  Fmt = "%8.3f"
-  f = open(CrdFile, Mode)
-  if Head: f.write("ACE".ljust(80) + "\n")
-  p = [Fmt % x for x in Pos.flat]
-  r = mod(len(p),NPerLine)
-  if r > 0: p.extend([""]*(NPerLine-r))
-  for i in xrange(0, len(p), NPerLine):
-    f.write("".join(p[i:i+NPerLine]) + "\n")
-  f.close()
+  """Saves coordinates to a Crd file; when appending, the title line is
+only written to a missing or empty file."""
+  f = CrdWriter(CrdFile, Mode, Head)
+  f.Write(Pos)
+  f.Close()
 
 
 def GetRstCoords(RstFile, PrmtopFile = "", Mask = NoMask):
@@ -242,12 +642,8 @@ def SaveRstCoords(Pos, RstFile):
   f = open(RstFile, "w")
   f.write("ACE".ljust(80) + "\n")
   f.write("%5d  0.0000000E+00\n" % len(Pos))
-  p = [Fmt % x for x in Pos.flat]
-  r = mod(len(p),NPerLine)
-  if r > 0: p.extend([""]*(NPerLine-r))
-  for i in xrange(0, len(p), NPerLine):
-    f.write("".join(p[i:i+NPerLine]) + "\n")
-  f.close()  
+  f.write(FormatFixedWidth(Pos, Fmt, NPerLine))
+  f.close()
   
 
 def AmbToPdb(RstFile, PrmtopFile, PdbFile, AAtm = False, BRes = False):
@@ -285,27 +681,262 @@ def SavePdbCoordsAmb2(Pos, PrmtopFile, PdbFile, AAtm = False, BRes = False):
 
 def PdbsToCrd(PdbFileList, CrdFile):
   """Saves multiple pdb files as a crd file"""
-  NPerLine = 10
-  Fmt = "%8.3f"
   NAtom = -1
-  f = open(CrdFile, "w")
-  f.write("ACE".ljust(80) + "\n")
+  f = CrdWriter(CrdFile, "w")
   for fn in PdbFileList:
     Pos = GetPdbCoords(fn)
     if NAtom < 0:
       NAtom = len(Pos)
     elif not len(Pos) == NAtom:
-      f.close()
+      f.Close()
       raise IOError, "Pdb files do not have same number of atoms."      
-    p = [Fmt % x for x in Pos.flat]
-    r = mod(len(p),NPerLine)
-    if r > 0: p.extend([""]*(NPerLine-r))
-    for i in xrange(0, len(p), NPerLine):
-      f.write("".join(p[i:i+NPerLine]) + "\n")
-  f.close()
+    f.Write(Pos)
+  f.Close()
     
   
 
+class GzipSeekFile:
+  """Read-only gzip file object with fast random access.  As the file is
+decompressed, a copy of the decompressor state is saved every Spacing
+uncompressed bytes (as in zlib's zran example).  A seek, forward or
+backward, then restarts decompression from the nearest checkpoint before
+the target instead of from the start of the file."""
+
+  def __init__(self, FileName = None, Mode = "rb", fileobj = None,
+               Spacing = None, Points = None):
+    """Opens a gzip file for random-access reading.
+* FileName: string name of gzip file
+* Mode: must be a read mode
+* fileobj: optional file object to read compressed data from
+* Spacing: uncompressed bytes between checkpoints
+  (default is GzipCheckpointSpacing)
+* Points: list of checkpoints to use and extend; by default these are
+  shared with other GzipSeekFile objects opened on the same file"""
+    if "w" in Mode or "a" in Mode:
+      raise IOError, "GzipSeekFile only supports reading."
+    if fileobj is None:
+      self.fobj = open(FileName, "rb")
+      self.__OwnFile = True
+    else:
+      self.fobj = fileobj
+      self.__OwnFile = False
+    if Spacing is None: Spacing = GzipCheckpointSpacing
+    self.Spacing = Spacing
+    #list of checkpoints (uncompressed offset, compressed offset, decompressor)
+    if Points is None:
+      Points = []
+      if not FileName is None and os.path.isfile(FileName):
+        Key = os.path.abspath(FileName)
+        Stat = os.stat(FileName)
+        Val = GzipPointCache.pop(Key, None)
+        if Val is None or Val[:2] != (Stat.st_size, Stat.st_mtime):
+          Val = (Stat.st_size, Stat.st_mtime, Points)
+        else:
+          Points = Val[2]
+        GzipPointCache[Key] = Val
+        while len(GzipPointCache) > GzipPointCacheSize:
+          GzipPointCache.popitem(last = False)
+    self.Points = Points
+    self.__Start(0, 0, None)
+
+  def __Start(self, UPos, CPos, Decomp):
+    """Starts decompressing from a given state."""
+    if Decomp is None:
+      Decomp = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    self.__Decomp = Decomp
+    self.fobj.seek(CPos)
+    self.__CPos = CPos
+    #uncompressed offset of the start of the buffer
+    self.__UPos = UPos
+    self.__Buf = ""
+    self.__BufPos = 0
+    self.__EOF = False
+
+  def __Fill(self, ChunkSize = 65536):
+    """Decompresses the next chunk onto the buffer.
+Returns False at the end of the file."""
+    if self.__EOF: return False
+    s = self.fobj.read(ChunkSize)
+    self.__CPos += len(s)
+    if len(s) == 0:
+      self.__EOF = True
+      Out = self.__Decomp.flush()
+    else:
+      Out = self.__Decomp.decompress(s)
+      #start a new decompressor for each following gzip member
+      while len(self.__Decomp.unused_data) > 0:
+        Rest = self.__Decomp.unused_data
+        if Rest.strip("\0") == "":
+          #trailing zero padding
+          self.__Decomp = zlib.decompressobj(16 + zlib.MAX_WBITS)
+          break
+        self.__Decomp = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        Out += self.__Decomp.decompress(Rest)
+    #drop what has already been read from the buffer
+    self.__UPos += self.__BufPos
+    self.__Buf = self.__Buf[self.__BufPos:] + Out
+    self.__BufPos = 0
+    #save a checkpoint at the decompression frontier
+    End = self.__UPos + len(self.__Buf)
+    if not self.__EOF and (len(self.Points) == 0 or
+                           End >= self.Points[-1][0] + self.Spacing):
+      self.Points.append((End, self.__CPos, self.__Decomp.copy()))
+    return True
+
+  def read(self, size = -1):
+    while size < 0 or len(self.__Buf) - self.__BufPos < size:
+      if not self.__Fill(): break
+    if size < 0:
+      s = self.__Buf[self.__BufPos:]
+    else:
+      s = self.__Buf[self.__BufPos:self.__BufPos + size]
+    self.__BufPos += len(s)
+    return s
+
+  def readline(self, size = -1):
+    i = self.__Buf.find("\n", self.__BufPos)
+    while i < 0 and (size < 0 or len(self.__Buf) - self.__BufPos < size):
+      #the fill drops consumed bytes, so only search past those kept
+      Kept = len(self.__Buf) - self.__BufPos
+      if not self.__Fill(): break
+      i = self.__Buf.find("\n", self.__BufPos + Kept)
+    if i < 0:
+      i = len(self.__Buf)
+    else:
+      i += 1
+    if size >= 0: i = min(i, self.__BufPos + size)
+    s = self.__Buf[self.__BufPos:i]
+    self.__BufPos = i
+    return s
+
+  def __iter__(self):
+    return self
+
+  def next(self):
+    s = self.readline()
+    if len(s) == 0: raise StopIteration
+    return s
+
+  def tell(self):
+    return self.__UPos + self.__BufPos
+
+  def seek(self, offset, whence = 0):
+    if whence == 1:
+      offset += self.tell()
+    elif whence == 2:
+      while self.__Fill(): pass
+      offset += self.__UPos + len(self.__Buf)
+    offset = max(int(offset), 0)
+    End = self.__UPos + len(self.__Buf)
+    if offset >= self.__UPos and offset <= End:
+      #target is in the buffer
+      self.__BufPos = offset - self.__UPos
+      return
+    #find the nearest checkpoint before the target
+    i = bisect.bisect_right([x[0] for x in self.Points], offset) - 1
+    if i >= 0 and (offset < self.__UPos or self.Points[i][0] > End):
+      UPos, CPos, Decomp = self.Points[i]
+      self.__Start(UPos, CPos, Decomp.copy())
+    elif offset < self.__UPos:
+      self.__Start(0, 0, None)
+    #decompress up to the target
+    while self.__UPos + len(self.__Buf) < offset:
+      self.__BufPos = len(self.__Buf)
+      if not self.__Fill(): break
+    self.__BufPos = min(offset - self.__UPos, len(self.__Buf))
+
+  def close(self):
+    if self.__OwnFile and not self.fobj is None:
+      self.fobj.close()
+    self.fobj = None
+    self.__Buf = ""
+
+
+def ScanTrjOffsets(f, NLine, ChunkSize = 4194304):
+  """Scans an open crd trajectory file and returns the number of header
+bytes and an array of frame byte offsets.  The offsets array has one more
+element than the number of complete frames; the last gives the end of
+the last frame.
+* f: file object opened at any position
+* NLine: number of lines per frame
+* ChunkSize: number of bytes to read at a time"""
+  f.seek(0)
+  BytesHead = len(f.readline())
+  Offsets = [array([BytesHead], int64)]
+  #byte offset of the current chunk
+  ChunkPos = BytesHead
+  #number of lines read so far in the current frame
+  Count = 0
+  while True:
+    try:
+      s = f.read(ChunkSize)
+    except IOError:
+      #stop at the end of a truncated gzip file
+      break
+    if len(s) == 0: break
+    nl = flatnonzero(frombuffer(s, dtype = uint8) == 10)
+    #frames end on every NLine-th newline
+    k = arange(NLine - Count - 1, len(nl), NLine)
+    if len(k) > 0:
+      Offsets.append(ChunkPos + nl[k] + 1)
+    Count = (Count + len(nl)) % NLine
+    ChunkPos += len(s)
+  return BytesHead, concatenate(Offsets)
+
+def LoadTrjIndex(TrjFile, NAtom):
+  """Loads the frame offsets saved for a trajectory file.
+Returns (BytesHead, Offsets), or None if there is no index or
+if the trajectory file changed since the index was made."""
+  fn = TrjFile + TrjIndexExt
+  if not os.path.isfile(fn): return None
+  try:
+    f = open(fn, "rb")
+    Ver, Size, MTime, NAtom2, BytesHead, Offsets = cPickle.load(f)
+    f.close()
+  except Exception:
+    return None
+  if not (Ver == TrjIndexVer and NAtom2 == NAtom
+          and Size == os.path.getsize(TrjFile)
+          and MTime == os.path.getmtime(TrjFile)):
+    return None
+  return BytesHead, Offsets
+
+def SaveTrjIndex(TrjFile, NAtom, BytesHead, Offsets):
+  """Saves frame offsets for a trajectory file, along with its size
+and modification time.  Fails silently if the file can't be written."""
+  fn = TrjFile + TrjIndexExt
+  Dat = (TrjIndexVer, os.path.getsize(TrjFile), os.path.getmtime(TrjFile),
+         NAtom, BytesHead, Offsets)
+  try:
+    f = open(fn, "wb")
+    cPickle.dump(Dat, f, cPickle.HIGHEST_PROTOCOL)
+    f.close()
+  except (IOError, OSError):
+    pass
+
+def GetTrjIndex(TrjFile, NAtom, f = None):
+  """Returns (BytesHead, Offsets) for a trajectory file, using the saved
+index when it is current and otherwise scanning the file (and saving a
+new index).
+* f: optional file object already open for TrjFile"""
+  if UseTrjIndex:
+    Index = LoadTrjIndex(TrjFile, NAtom)
+    if not Index is None: return Index
+  NLine = (3 * NAtom) / 10
+  if mod(3 * NAtom, 10) > 0: NLine += 1
+  if f is None:
+    if TrjFile.strip().lower().endswith("gz"):
+      Trj = GzipSeekFile(TrjFile, "r")
+    else:
+      Trj = open(TrjFile, "r")
+    BytesHead, Offsets = ScanTrjOffsets(Trj, NLine)
+    Trj.close()
+  else:
+    BytesHead, Offsets = ScanTrjOffsets(f, NLine)
+  if UseTrjIndex:
+    SaveTrjIndex(TrjFile, NAtom, BytesHead, Offsets)
+  return BytesHead, Offsets
+
 def GetTrjLenOld(TrjFile, PrmtopFile):
   "Gets the number of frames in a trajectory."
   #get the number of atoms using the prmtop file
@@ -331,46 +962,8 @@ def GetTrjLen(TrjFile, PrmtopFile):
   "Gets the number of frames in a trajectory."
   Names = GetPrmtopAtomNames(PrmtopFile)
   if Names is None: return 0
-  NAtom = len(Names)
-  #calculate the number of lines to read per coordinate set
-  r = mod(3 * NAtom, 10)
-  NLine = (3 * NAtom) / 10
-  if r > 0: NLine += 1
-  #use gzip?
-  if TrjFile.strip().lower().endswith("gz"):
-    FileMthd = gzip.GzipFile
-  else:
-    FileMthd = file
-  #open the trj file
-  try:
-    Trj = FileMthd(TrjFile, "r")
-  except IOError:
-    raise IOError, "There was an error opening the trajectory file."
-    return
-  #read the header
-  BytesHead = len(Trj.readline())
-  #read the first config
-  BytesCoords = 0
-  for i in range(NLine):
-    BytesCoords += len(Trj.readline())
-  #unfortunately for gzip files, we can't seek to end, so we need to
-  #do this bit to get the total size:
-  Trj.seek(0)
-  BytesTot = 0
-  #try to catch errors in the gzipped file; stride 1024 bytes
-  try:
-    while len(Trj.read(1024)) > 0: pass
-  except IOError:
-    #find the exact byte number
-    try:
-      while len(Trj.read(1)) > 0: pass
-    except IOError:
-      pass
-  BytesTot = max(Trj.tell(), 0)
-  #return the total number of configs
-  Trj.close()
-  del Trj
-  return int((BytesTot - BytesHead) / BytesCoords)
+  BytesHead, Offsets = GetTrjIndex(TrjFile, len(Names))
+  return len(Offsets) - 1
 
 
 class TrjClass:
@@ -426,7 +1019,7 @@ class TrjClass:
     "Resets current configuration to trajectory start."
     if not self.__Trj is None:
       #skip to the right configuration
-      self.__Trj.seek(self.BytesHead + self.NSkip * self.BytesCoords)
+      self.__Trj.seek(int(self.FrameOffsets[self.NSkip]))
     #reset the indices
     self.Index, self.SliceIndex = -1, -1
     #set the coordinate set number, corresponding to last set read in
@@ -457,9 +1050,11 @@ class TrjClass:
       return
     self.AtomRes = GetPrmtopAtomRes(self.PrmtopFile)
     self.Seq = GetPrmtopSeq(self.PrmtopFile)
+    #compiled masks
+    self.__MaskCache = {}
     #set the file method
     if self.TrjFile.split(".")[-1].strip().lower() == "gz":
-      self.__FileMthd = gzip.GzipFile
+      self.__FileMthd = GzipSeekFile
       self.Gzip = True
     else:
       self.__FileMthd = open
@@ -477,51 +1072,36 @@ class TrjClass:
     #close for now
     self.Close()
 
+  def __GetMaskInd(self, Mask):
+    """Returns (AtomInd, CrdByteInd) for a mask, compiled once per mask,
+or None if there is no mask."""
+    if Mask == NoMask: return None
+    Key = tuple(Mask)
+    if not Key in self.__MaskCache:
+      AtomInd = GetMaskInd(self.AtomNames, Mask)
+      self.__MaskCache[Key] = (AtomInd, GetCrdByteInd(self.NAtom, AtomInd))
+    return self.__MaskCache[Key]
+
   def __CountBytes(self):
-    """Counts the number of bytes per configuration by reading the first set."""
-    #calculate the number of lines to read per coordinate set
-    r = mod(3 * self.NAtom, 10)
-    self.__NLine = (3 * self.NAtom) / 10
-    if r > 0: self.__NLine += 1
+    """Gets the frame byte offsets, from the index file if it is current
+or else by scanning the trajectory once."""
     #close the trj file if it's open
     self.Close()
     #open the trj file
     self.__Open()
-    #read the header
-    self.BytesHead = len(self.__Trj.readline())
-    #read the first config
-    self.BytesCoords = 0
-    for i in range(0, self.__NLine):
-      self.BytesCoords += len(self.__Trj.readline())
-    if self.Gzip:
-      #unfortunately for gzip files, we need to do this bit to get the total size:
-      self.__Trj.seek(0)
-      self.BytesTot = 0
-      Incr = os.path.getsize(self.TrjFile)
-      while self.BytesTot == self.__Trj.tell():
-        self.BytesTot += Incr
-        self.__Trj.seek(self.BytesTot)
-      self.BytesTot = max(self.__Trj.tell(), 0)
-    else:
-      self.BytesTot = os.path.getsize(self.TrjFile)
-    if 1==2: 
-      #try to catch errors in the gzipped file; stride 1024 bytes
-      try:
-        while len(self.__Trj.read(1024)) > 0: pass
-      except IOError:
-        #find the exact byte number
-        try:
-          while len(self.__Trj.read(1)) > 0: pass
-        except IOError:
-          pass
-      self.BytesTot = max(self.__Trj.tell(), 0)
+    self.BytesHead, self.FrameOffsets = GetTrjIndex(self.TrjFile, self.NAtom,
+                                                    self.__Trj)
+    self.BytesTot = int(self.FrameOffsets[-1])
     #set the total number of configs
-    self.NCoords = int((self.BytesTot - self.BytesHead) / self.BytesCoords)
+    self.NCoords = len(self.FrameOffsets) - 1
+    if self.NCoords > 0:
+      self.BytesCoords = int(self.FrameOffsets[1] - self.FrameOffsets[0])
+    else:
+      self.BytesCoords = 0
     self.NSkip = min(self.NSkip, self.NCoords)
-    a = max(0, self.BytesTot - self.BytesHead - self.BytesCoords*self.NSkip)
-    b = self.NStride * self.BytesCoords
-    self.SliceNCoords = int(a / b)  
-    if a % b > 0: self.SliceNCoords += 1
+    a = self.NCoords - self.NSkip
+    self.SliceNCoords = a / self.NStride
+    if a % self.NStride > 0: self.SliceNCoords += 1
     #set the limit of how many to read in
     if self.NRead is None:
       self.NRead = self.SliceNCoords
@@ -544,19 +1124,72 @@ class TrjClass:
       self.SliceIndex = ind
       self.Index = self.NSkip + self.NStride * ind
       #seek to the right position
-      self.__Trj.seek(self.BytesHead + self.BytesCoords*self.Index)
+      Start, Stop = [int(x) for x in self.FrameOffsets[self.Index:self.Index+2]]
+      self.__Trj.seek(Start)
       #read the data
-      s = self.__Trj.read(self.BytesCoords)
+      s = self.__Trj.read(Stop - Start)
       #check to see if we ran out of coordinates
-      if len(s) < self.BytesCoords:
+      if len(s) < Stop - Start:
         raise IOError
         return
-      #parse the crd string
-      self.Pos = ParseCrdString(s, self.AtomNames, Mask)
+      #parse the crd string, decoding only masked atoms
+      MaskInd = self.__GetMaskInd(Mask)
+      if MaskInd is None:
+        self.Pos = ParseCrdString(s)
+      else:
+        self.Pos = ParseCrdAtoms(s, self.NAtom, *MaskInd)[0]
       #update a linked coord array
       if not self.LinkPos is None: self.LinkPos[:,:] = self.Pos
       return self.Pos
 
+  def IterChunks(self, Size, Mask = None, Reuse = False):
+    """Iterates over the sliced trajectory in blocks of configurations,
+decoding each block in one pass.  Each block is an array of dimensions
+[K, NAtom, 3] with K <= Size.
+* Size: maximum number of configurations per block
+* Mask: list of strings; filter for atom names (default is the class mask)
+* Reuse: if True, one preallocated array is filled and yielded for every
+  block, so a block must be copied if it is to be kept"""
+    if Mask is None: Mask = self.Mask
+    Size = max(int(Size), 1)
+    MaskInd = self.__GetMaskInd(Mask)
+    if MaskInd is None:
+      NAtomOut = self.NAtom
+    else:
+      NAtomOut = len(MaskInd[0])
+    Buf = None
+    self.__Open()
+    self.Reset()
+    for Start in range(0, self.SliceNCoords, Size):
+      Stop = min(Start + Size, self.SliceNCoords)
+      k = Stop - Start
+      if Buf is None or not Reuse:
+        Buf = empty((min(Size, self.SliceNCoords), NAtomOut, 3), float)
+      a = self.NSkip + self.NStride * Start
+      b = self.NSkip + self.NStride * (Stop - 1) + 1
+      if self.NStride == 1:
+        #contiguous frames come in a single read
+        Pos1, Pos2 = int(self.FrameOffsets[a]), int(self.FrameOffsets[b])
+        self.__Trj.seek(Pos1)
+        s = self.__Trj.read(Pos2 - Pos1)
+        if len(s) < Pos2 - Pos1: raise IOError
+      else:
+        l = []
+        for i in range(a, b, self.NStride):
+          Pos1, Pos2 = int(self.FrameOffsets[i]), int(self.FrameOffsets[i+1])
+          self.__Trj.seek(Pos1)
+          l.append(self.__Trj.read(Pos2 - Pos1))
+          if len(l[-1]) < Pos2 - Pos1: raise IOError
+        s = "".join(l)
+      if MaskInd is None:
+        Buf[:k] = ParseCrdFrames(s, self.NAtom)
+      else:
+        Buf[:k] = ParseCrdAtoms(s, self.NAtom, *MaskInd)
+      self.SliceIndex, self.Index = Stop - 1, b - 1
+      self.Count += k
+      yield Buf[:k]
+    self.Reset()
+
   def __getitem__(self, ind):
     return self.Get(ind)
 
@@ -591,15 +1224,563 @@ class TrjClass:
     return range(self.NSkip, self.NCoords, self.NStride)
 
 
+#======== AMBER NETCDF TRAJECTORIES ========
+
+#NetCDF classic-format type codes, mapped to big-endian numpy types
+NetCDFTypes = {1:">i1", 2:"S1", 3:">i2", 4:">i4", 5:">f4", 6:">f8"}
+
+def IsNetCDF(FileName):
+  "Returns True if a file starts with the NetCDF classic-format magic number."
+  try:
+    f = open(FileName, "rb")
+    s = f.read(4)
+    f.close()
+  except IOError:
+    return False
+  return len(s) == 4 and s[:3] == "CDF" and s[3] in "\x01\x02"
+
+def GetNetCDFHeader(FileName):
+  """Reads the header of a NetCDF classic or 64-bit offset file, as
+written by Amber.  Returns a dictionary with entries:
+* Dims: dictionary of dimension name to length (0 for the record dim)
+* Vars: dictionary of variable name to dictionary with entries
+  Dims (tuple of dimension names), Type (numpy type), Begin (byte offset),
+  VSize (bytes per record or total), Rec (True if a record variable), Atts
+* Atts: dictionary of global attributes
+* NRec: number of records (frames)
+* RecSize: bytes per record"""
+  f = open(FileName, "rb")
+  try:
+    s = f.read(4)
+    if len(s) < 4 or s[:3] != "CDF" or not s[3] in "\x01\x02":
+      raise IOError, "%s is not a NetCDF file." % FileName
+    OffsetType = {"\x01":">i4", "\x02":">i8"}[s[3]]
+    #the header is generally small; read more as needed
+    Buf = [f.read(65536), 0]
+    def Read(n):
+      while len(Buf[0]) < Buf[1] + n:
+        s = f.read(65536)
+        if len(s) == 0: raise IOError, "Unexpected end of NetCDF header."
+        Buf[0] += s
+      s = Buf[0][Buf[1]:Buf[1]+n]
+      Buf[1] += n
+      return s
+    def ReadInt(Type = ">i4"):
+      n = dtype(Type).itemsize
+      return int(frombuffer(Read(n), Type)[0])
+    def ReadName():
+      n = ReadInt()
+      s = Read(n)
+      Read((4 - n % 4) % 4)
+      return s
+    def ReadAtts():
+      Atts = {}
+      Tag, n = ReadInt(), ReadInt()
+      for i in range(n):
+        Name = ReadName()
+        Type = NetCDFTypes[ReadInt()]
+        m = ReadInt()
+        Size = dtype(Type).itemsize * m
+        s = Read(Size)
+        Read((4 - Size % 4) % 4)
+        if Type == "S1":
+          Atts[Name] = s
+        else:
+          Atts[Name] = frombuffer(s, Type).copy()
+      return Atts
+    NRec = ReadInt()
+    #dimensions
+    DimNames, Dims = [], {}
+    Tag, n = ReadInt(), ReadInt()
+    for i in range(n):
+      Name = ReadName()
+      DimNames.append(Name)
+      Dims[Name] = ReadInt()
+    Atts = ReadAtts()
+    #variables
+    Vars = {}
+    Tag, n = ReadInt(), ReadInt()
+    for i in range(n):
+      Name = ReadName()
+      m = ReadInt()
+      VarDims = tuple([DimNames[ReadInt()] for j in range(m)])
+      VarAtts = ReadAtts()
+      Type = NetCDFTypes[ReadInt()]
+      VSize = ReadInt()
+      Begin = ReadInt(OffsetType)
+      Rec = len(VarDims) > 0 and Dims[VarDims[0]] == 0
+      Vars[Name] = {"Dims":VarDims, "Type":Type, "Begin":Begin,
+                    "VSize":VSize, "Rec":Rec, "Atts":VarAtts}
+  finally:
+    f.close()
+  #record variables are interleaved; a lone one is unpadded
+  RecVars = [v for v in Vars.values() if v["Rec"]]
+  if len(RecVars) == 1:
+    v = RecVars[0]
+    RecSize = dtype(v["Type"]).itemsize
+    for d in v["Dims"][1:]: RecSize *= Dims[d]
+    v["VSize"] = RecSize
+  else:
+    RecSize = sum([v["VSize"] for v in RecVars])
+  #streaming files may not have the record count filled in
+  if NRec < 0 and len(RecVars) > 0 and RecSize > 0:
+    Begin = min([v["Begin"] for v in RecVars])
+    NRec = (os.path.getsize(FileName) - Begin) / RecSize
+  return {"Dims":Dims, "Vars":Vars, "Atts":Atts, "NRec":max(NRec, 0),
+          "RecSize":RecSize}
+
+def GetNetCDFRecVar(FileName, Header, VarName):
+  """Returns a read-only memory-mapped array of a record variable,
+with the frame as the first dimension."""
+  v = Header["Vars"][VarName]
+  Shape = tuple([Header["NRec"]] + [Header["Dims"][d] for d in v["Dims"][1:]])
+  Type = dtype(v["Type"])
+  if Header["NRec"] == 0:
+    return zeros(Shape, Type)
+  RecSize = Header["RecSize"]
+  #map whole records and view just this variable's slot in each
+  n = (Header["NRec"] - 1) * RecSize + v["VSize"]
+  m = memmap(FileName, dtype = uint8, mode = "r", offset = v["Begin"],
+             shape = (n,))
+  Strides = [RecSize]
+  Size = Type.itemsize
+  for d in reversed(Shape[1:]):
+    Strides.insert(1, Size)
+    Size *= d
+  return ndarray(shape = Shape, dtype = Type, buffer = m,
+                 strides = tuple(Strides))
+
+
+class NetCDFTrjClass:
+  "Provides a class for reading successive sets of coordinates from Amber NetCDF trajectory files."
+  
+  def __init__(self, TrjFile, PrmtopFile, Mask = NoMask,
+               NSkip = 0, NRead = None, NStride = 1,
+               LinkPos = None):
+    """Initializes the class and maps the trajectory file for reading.
+* TrjFile: string name of NetCDF trj file
+* PrmtopFile: string name of prmtop file
+* Mask: list of strings; filter for atom names (default is no mask/empty list)
+* NSkip: number of configurations to skip
+* NRead: maximum number of configurations to read (default is all)
+* NStride: stride between configuration frames (default is 1)
+* LinkPos: an outside array that is updated automatically as Pos are read"""
+    IsFile1, IsFile2 = os.path.isfile(PrmtopFile), os.path.isfile(TrjFile)
+    if IsFile1 and IsFile2:
+      #set the filenames
+      self.TrjFile = TrjFile
+      self.PrmtopFile = PrmtopFile
+      #set the frames to skip, read, and stride
+      if NSkip < 0:
+        raise ValueError, "NSkip is less than zero."
+      self.NSkip = NSkip
+      self.NRead = NRead
+      self.NStride = max(NStride, 1)
+      if self.NRead < 0: self.NRead = None
+      self.NCoords = 0
+      self.SliceNCoords = 0
+      #set the counters
+      self.Count = 0
+      self.Index = -1
+      self.SliceIndex = -1
+      #set the mask option
+      self.Mask = Mask
+      if self.Mask is None: self.Mask = NoMask
+      #set the linked pos
+      self.LinkPos = LinkPos
+      #initialize everything
+      self.__Init()
+    else:
+      if not IsFile2:
+        raise IOError, "Could not find %s." % TrjFile
+      if not IsFile1:
+        raise IOError, "Could not find %s." % PrmtopFile
+
+  def Reset(self):
+    "Resets current configuration to trajectory start."
+    #reset the indices
+    self.Index, self.SliceIndex = -1, -1
+    #set the coordinate set number, corresponding to last set read in
+    self.Count = 0
+
+  def ReadHeader(self):
+    """Reads the trajectory header and returns the number of frames."""
+    self.Header = GetNetCDFHeader(self.TrjFile)
+    if not "coordinates" in self.Header["Vars"]:
+      raise IOError, "Could not find coordinates in %s." % self.TrjFile
+    if not self.Header["Dims"].get("atom", 0) == self.NAtom:
+      raise IOError, "Number of atoms in %s does not match prmtop." % self.TrjFile
+    return self.Header["NRec"]
+
+  def MapCoords(self):
+    """Returns a memory-mapped [NFrame, NAtom, 3] array of all frames."""
+    return GetNetCDFRecVar(self.TrjFile, self.Header, "coordinates")
+
+  def __Open(self):
+    """Maps the coordinates of the trajectory file."""
+    if self.__Crd is None:
+      try:
+        self.__Crd = self.MapCoords()
+      except (IOError, KeyError):
+        raise IOError, "There was an error opening the trajectory file."
+
+  def Close(self):
+    "Closes any open files."
+    self.__Crd = None
+
+  def __Init(self):
+    """Initializes internal variables from disk data."""
+    #get the atom names, seq, and residue nums
+    self.AtomNames = GetPrmtopAtomNames(self.PrmtopFile)
+    self.AtomNames = AmbToPdbAtomNames(self.AtomNames)
+    self.NAtom = len(self.AtomNames)
+    if self.NAtom == 0:
+      raise IOError, "There was an error reading the Prmtop file."
+      return
+    self.AtomRes = GetPrmtopAtomRes(self.PrmtopFile)
+    self.Seq = GetPrmtopSeq(self.PrmtopFile)
+    #compiled masks
+    self.__MaskCache = {}
+    self.__Crd = None
+    #read the header and set the total number of configs
+    self.NCoords = self.ReadHeader()
+    self.NSkip = min(self.NSkip, self.NCoords)
+    a = self.NCoords - self.NSkip
+    self.SliceNCoords = a / self.NStride
+    if a % self.NStride > 0: self.SliceNCoords += 1
+    #set the limit of how many to read in
+    if self.NRead is None:
+      self.NRead = self.SliceNCoords
+    else:
+      self.SliceNCoords = min(self.NRead, self.SliceNCoords)
+    self.Reset()
+    #get an initial set of positions
+    if len(self) > 0:
+      self.Pos = self[0]
+    else:
+      self.Pos = None
+    #close for now
+    self.Close()
+
+  def __MaskInd(self, Mask):
+    """Returns atom indices for a mask, compiled once per mask,
+or None if there is no mask."""
+    if Mask == NoMask: return None
+    Key = tuple(Mask)
+    if not Key in self.__MaskCache:
+      self.__MaskCache[Key] = GetMaskInd(self.AtomNames, Mask)
+    return self.__MaskCache[Key]
+
+  def Get(self, ind, Mask = None):
+    if Mask is None: Mask = self.Mask
+    #this index is relative to the sliced version
+    #check for reverse notation
+    if ind < 0:
+      ind += self.SliceNCoords
+    #check bounds
+    if ind < 0 or ind >= self.SliceNCoords:
+      raise IndexError, "Index out of bounds for trj class."
+    else:
+      #make sure we're open
+      self.__Open()
+      #calculate the absolute index
+      self.SliceIndex = ind
+      self.Index = self.NSkip + self.NStride * ind
+      #read the frame
+      AtomInd = self.__MaskInd(Mask)
+      if AtomInd is None:
+        self.Pos = self.__Crd[self.Index].astype(float)
+      else:
+        self.Pos = self.__Crd[self.Index].take(AtomInd, axis = 0).astype(float)
+      #update a linked coord array
+      if not self.LinkPos is None: self.LinkPos[:,:] = self.Pos
+      return self.Pos
+
+  def GetSlice(self, Start = 0, Stop = None, Mask = None):
+    """Returns an array of dimensions [NFrame, NAtom, 3] holding the
+configurations Start:Stop of the sliced trajectory, read in one pass."""
+    if Mask is None: Mask = self.Mask
+    Start, Stop, Step = slice(Start, Stop).indices(self.SliceNCoords)
+    self.__Open()
+    a = self.NSkip + self.NStride * Start
+    b = self.NSkip + self.NStride * max(Stop, Start)
+    Pos = self.__Crd[a:b:self.NStride]
+    AtomInd = self.__MaskInd(Mask)
+    if not AtomInd is None: Pos = Pos.take(AtomInd, axis = 1)
+    return Pos.astype(float)
+
+  def IterChunks(self, Size, Mask = None, Reuse = False):
+    """Iterates over the sliced trajectory in blocks of configurations.
+Each block is an array of dimensions [K, NAtom, 3] with K <= Size.
+* Size: maximum number of configurations per block
+* Mask: list of strings; filter for atom names (default is the class mask)
+* Reuse: if True, one preallocated array is filled and yielded for every
+  block, so a block must be copied if it is to be kept"""
+    Size = max(int(Size), 1)
+    Buf = None
+    self.Reset()
+    for Start in range(0, self.SliceNCoords, Size):
+      Stop = min(Start + Size, self.SliceNCoords)
+      Pos = self.GetSlice(Start, Stop, Mask)
+      if not Reuse:
+        Buf = Pos
+      elif Buf is None:
+        Buf = empty((min(Size, self.SliceNCoords),) + Pos.shape[1:], float)
+      Buf[:Stop-Start] = Pos
+      self.SliceIndex = Stop - 1
+      self.Index = self.NSkip + self.NStride * (Stop - 1)
+      self.Count += Stop - Start
+      yield Buf[:Stop-Start]
+    self.Reset()
+
+  def __getitem__(self, ind):
+    if type(ind) is slice:
+      if not ind.step in [None, 1]:
+        raise IndexError, "Slices of trj class must have unit step."
+      return self.GetSlice(ind.start, ind.stop)
+    return self.Get(ind)
+
+  def __len__(self):
+    return self.SliceNCoords
+
+  def __iter__(self):
+    self.Reset()
+    return self
+
+  def next(self):
+    ind = self.SliceIndex + 1
+    if ind < self.SliceNCoords:
+      self.Count += 1
+      return self[ind]
+    else:
+      self.Reset()
+      raise StopIteration
+
+  def GetNextCoords(self, Mask = None):
+    "Returns the next set of coordinates in the Trj file, or None if the end is reached."
+    ind = self.SliceIndex + 1
+    if ind < self.SliceNCoords:
+      self.Count += 1
+      result = self.Get(ind, Mask)
+    else:
+      result = None
+    return result
+
+  def GetIndices(self):
+    "Returns the configuration indices of all read in so far."
+    return range(self.NSkip, self.NCoords, self.NStride)[:self.SliceNCoords]
+
+
+#======== BINARY TRAJECTORY CACHE ========
+
+def GetTrjCacheFiles(TrjFile):
+  "Returns the names of the data and header cache files for a trajectory."
+  return TrjFile + TrjCacheExt, TrjFile + TrjCacheHeadExt
+
+def LoadTrjCacheHeader(TrjFile):
+  """Returns the header dictionary of the binary cache for a trajectory,
+or None if there is no cache or the trajectory changed since it was made."""
+  DatFile, HeadFile = GetTrjCacheFiles(TrjFile)
+  if not (os.path.isfile(DatFile) and os.path.isfile(HeadFile)):
+    return None
+  try:
+    f = open(HeadFile, "r")
+    Head = json.load(f)
+    f.close()
+  except (IOError, ValueError):
+    return None
+  Stat = os.stat(TrjFile)
+  if not (Head.get("version") == TrjCacheVer
+          and Head.get("source_size") == Stat.st_size
+          and Head.get("source_mtime") == Stat.st_mtime):
+    return None
+  return Head
+
+def SaveTrjCache(TrjFile, PrmtopFile, ChunkSize = 100, Verbose = False):
+  """Streams a crd (possibly gzipped) or NetCDF trajectory into a float32
+.npy cache file next to it, with a JSON header holding natom, nframes
+and box, and returns the header.  The header is written last, so an
+interrupted conversion leaves no valid cache.
+* ChunkSize: number of frames to convert at a time"""
+  DatFile, HeadFile = GetTrjCacheFiles(TrjFile)
+  Stat = os.stat(TrjFile)
+  Trj = GetTrjObj(TrjFile, PrmtopFile)
+  NFrame, NAtom = len(Trj), Trj.NAtom
+  #box lengths and angles of the first frame, if any
+  Box = None
+  if isinstance(Trj, NetCDFTrjClass) and NFrame > 0:
+    if "cell_lengths" in Trj.Header["Vars"]:
+      Box = GetNetCDFRecVar(TrjFile, Trj.Header, "cell_lengths")[0].tolist()
+      if "cell_angles" in Trj.Header["Vars"]:
+        Box += GetNetCDFRecVar(TrjFile, Trj.Header, "cell_angles")[0].tolist()
+  if os.path.isfile(HeadFile): os.remove(HeadFile)
+  Dat = open_memmap(DatFile, mode = "w+", dtype = float32,
+                    shape = (NFrame, NAtom, 3))
+  i = 0
+  for Pos in Trj.IterChunks(ChunkSize, NoMask, Reuse = True):
+    Dat[i:i+len(Pos)] = Pos
+    i += len(Pos)
+    if Verbose: print "Converted %d of %d frames" % (i, NFrame)
+  Trj.Close()
+  Dat.flush()
+  del Dat
+  Head = {"version":TrjCacheVer, "source_size":Stat.st_size,
+          "source_mtime":Stat.st_mtime, "natom":NAtom, "nframes":NFrame,
+          "box":Box}
+  f = open(HeadFile, "w")
+  json.dump(Head, f)
+  f.close()
+  return Head
+
+
+class CachedTrjClass(NetCDFTrjClass):
+  """Provides a class for reading successive sets of coordinates from the
+binary cache of an Amber trajectory.  The cache is made, or remade if
+the trajectory changed, when the class is initialized.  Arguments are
+the same as for TrjClass."""
+
+  def ReadHeader(self):
+    """Makes the cache if needed, reads its header and returns the number
+of frames."""
+    self.Header = LoadTrjCacheHeader(self.TrjFile)
+    if self.Header is None:
+      self.Header = SaveTrjCache(self.TrjFile, self.PrmtopFile)
+    if not self.Header["natom"] == self.NAtom:
+      raise IOError, "Number of atoms in %s does not match prmtop." % self.TrjFile
+    self.BoxSize = self.Header["box"]
+    return self.Header["nframes"]
+
+  def MapCoords(self):
+    """Returns a memory-mapped [NFrame, NAtom, 3] float32 array of all frames."""
+    DatFile, HeadFile = GetTrjCacheFiles(self.TrjFile)
+    return load(DatFile, mmap_mode = "r")
+
+
+def GetTrjObj(TrjFile, PrmtopFile, *args, **kwargs):
+  """Returns a NetCDFTrjClass object for Amber NetCDF trajectories or a
+TrjClass object for (possibly gzipped) crd trajectories.  Arguments are
+the same as for TrjClass, plus:
+* Cache: if True, returns a CachedTrjClass object reading from a binary
+  cache of either kind of trajectory (default is False)"""
+  if kwargs.pop("Cache", False):
+    return CachedTrjClass(TrjFile, PrmtopFile, *args, **kwargs)
+  elif IsNetCDF(TrjFile):
+    return NetCDFTrjClass(TrjFile, PrmtopFile, *args, **kwargs)
+  else:
+    return TrjClass(TrjFile, PrmtopFile, *args, **kwargs)
+
+
+def ReadPdbListCoords(PdbFile, AtomInd = None, Names = None, Mask = NoMask):
+  """Gets the coordinates of the ATOM records with indices AtomInd from a
+pdb file, falling back on a masked read if the file does not have the
+atom name key Names."""
+  Pos = GetPdbCoordsInd(PdbFile, AtomInd, Names)
+  if Pos is None:
+    Pos = GetPdbCoords(PdbFile, Mask)
+  return Pos
+
+def _ReadPdbListTask(Args):
+  "Reads pdb coordinates in a worker process."
+  return ReadPdbListCoords(*Args)
+
+def _ReadPdbCacheTask(Args):
+  "Reads all pdb coordinates for a cache in a worker process."
+  return GetPdbCoordsInd(*Args)
+
+def GetPdbCacheFiles(CacheFile):
+  "Returns the names of the data and header files of a pdb list cache."
+  return CacheFile + TrjCacheExt, CacheFile + TrjCacheHeadExt
+
+def GetPdbCacheStats(PdbFileList):
+  "Returns [path, size, mtime] for each pdb file, as stored in a cache."
+  Stats = []
+  for f in PdbFileList:
+    Stat = os.stat(f)
+    Stats.append([os.path.abspath(f), Stat.st_size, Stat.st_mtime])
+  return Stats
+
+def LoadPdbCacheHeader(PdbFileList, CacheFile):
+  """Returns the header dictionary of a pdb list coordinate cache, or None
+if there is no cache or it was made from different or changed files."""
+  DatFile, HeadFile = GetPdbCacheFiles(CacheFile)
+  if not (os.path.isfile(DatFile) and os.path.isfile(HeadFile)):
+    return None
+  try:
+    f = open(HeadFile, "r")
+    Head = json.load(f)
+    f.close()
+  except (IOError, ValueError):
+    return None
+  if not (Head.get("version") == PdbCacheVer
+          and Head.get("files") == GetPdbCacheStats(PdbFileList)):
+    return None
+  return Head
+
+def SavePdbCache(PdbFileList, CacheFile, NProc = 1, Verbose = False):
+  """Parses all ATOM coordinates of a list of pdb files into an int32 .npy
+cache of thousandths of an angstrom, with a JSON header that records the
+files, and returns the header.  Files whose atom names differ from the
+first file's are not cached; their indices are listed in the header
+under "uncached" and they are read from the pdb files instead.  The
+header is written last, so an interrupted conversion leaves no valid cache.
+* NProc: number of processes used to parse the files"""
+  DatFile, HeadFile = GetPdbCacheFiles(CacheFile)
+  Stats = GetPdbCacheStats(PdbFileList)
+  Names = GetPdbMaskInd(PdbFileList[0], NoMask)[0]
+  NAtom = len(Names) / 2
+  if os.path.isfile(HeadFile): os.remove(HeadFile)
+  Dat = open_memmap(DatFile, mode = "w+", dtype = int32,
+                    shape = (len(PdbFileList), NAtom, 3))
+  Tasks = [(f, None, Names) for f in PdbFileList]
+  if NProc > 1:
+    Pool = multiprocessing.Pool(NProc)
+    Iter = Pool.imap(_ReadPdbCacheTask, Tasks, 16)
+  else:
+    Pool = None
+    Iter = (_ReadPdbCacheTask(Task) for Task in Tasks)
+  Uncached = []
+  for (i, Pos) in enumerate(Iter):
+    if Pos is None:
+      Uncached.append(i)
+    else:
+      Dat[i] = around(Pos * 1000.)
+    if Verbose and (i+1) % 1000 == 0:
+      print "Cached %d of %d pdb files" % (i+1, len(PdbFileList))
+  if not Pool is None:
+    Pool.close()
+    Pool.join()
+  Dat.flush()
+  del Dat
+  if Verbose and len(Uncached):
+    print "%d pdb files have different atoms and were not cached" % len(Uncached)
+  Head = {"version":PdbCacheVer, "natom":NAtom, "files":Stats,
+          "uncached":Uncached}
+  f = open(HeadFile, "w")
+  json.dump(Head, f)
+  f.close()
+  return Head
+
+
 class PdbListClass:
-  "Provides a class for reading successive sets of coordinates from pdb files."
+  """Provides a class for reading successive sets of coordinates from pdb files.
+Parsed coordinates are kept in a bounded least-recently-used cache; the
+next files can be parsed ahead of time in a pool of worker processes, and
+all of the files can be parsed once into a compact cache on disk."""
   
   def __init__(self, PdbFileList, Mask = NoMask,
-               LinkPos = None):
+               LinkPos = None, Prefetch = 0, NProc = None,
+               CacheSize = 64, CoordCache = None):
     """Initializes the class and checks for pdb file existence.
 * PdbFileList: list of string names of pdb files
 * Mask: list of strings; filter for atom names (default is no mask/empty list)
 * LinkPos: an outside array that is updated automatically as coords are read
+* Prefetch: number of following files to parse ahead in worker processes
+* NProc: number of worker processes (default is the number of cpus)
+* CacheSize: maximum number of parsed configurations held in memory
+* CoordCache: base file name of a coordinate cache (data in
+  CoordCache.cache.npy, header in CoordCache.cache.json), made or remade
+  as needed; reads then skip pdb parsing, except for files whose atoms
+  differ from the first file's
 """
     #check for file existence
     self.PdbFileList = [f for f in PdbFileList if os.path.isfile(f)]
@@ -613,8 +1794,27 @@ class PdbListClass:
     #set the mask option
     self.Mask = Mask
     if self.Mask is None: self.Mask = NoMask
+    #compiled masks
+    self.__MaskCache = {}
     #set the linked pos
     self.LinkPos = LinkPos
+    #parsed coordinates, least recently used first, and pending prefetches
+    self.Prefetch = Prefetch
+    self.CacheSize = max(CacheSize, Prefetch + 1)
+    self.__Cache = OrderedDict()
+    self.__Pending = {}
+    self.__Pool = None
+    if NProc is None: NProc = multiprocessing.cpu_count()
+    self.NProc = max(NProc, 1)
+    #coordinate cache
+    self.__CoordDat = None
+    self.__Uncached = set()
+    if not CoordCache is None:
+      Head = LoadPdbCacheHeader(self.PdbFileList, CoordCache)
+      if Head is None:
+        Head = SavePdbCache(self.PdbFileList, CoordCache, NProc = self.NProc)
+      self.__Uncached = set(Head["uncached"])
+      self.__CoordDat = load(GetPdbCacheFiles(CoordCache)[0], mmap_mode = "r")
     #get the sequence, atom names, and atom residues
     f = self.PdbFileList[0]
     self.AtomNames = pdbtools.Atoms(f)
@@ -661,7 +1861,30 @@ class PdbListClass:
     if ind < 0 or ind >= len(self.PdbFileList):
       raise IndexError, "Index out of bounds for pdb coords class."
     self.Index = ind
-    self.Pos = GetPdbCoords(self.PdbFileList[ind], Mask)
+    #use the atom indices compiled from the first file for this mask;
+    #files with different atom names are read with the name filter
+    Key = tuple(Mask)
+    if not Key in self.__MaskCache:
+      self.__MaskCache[Key] = GetPdbMaskInd(self.PdbFileList[0], Mask)
+    Names, AtomInd = self.__MaskCache[Key]
+    if not (self.__CoordDat is None or ind in self.__Uncached):
+      Pos = self.__CoordDat[ind]
+      if not AtomInd is None: Pos = Pos.take(AtomInd, axis = 0)
+      self.Pos = Pos / 1000.
+    else:
+      CacheKey = (ind, Key)
+      if CacheKey in self.__Cache:
+        Pos = self.__Cache.pop(CacheKey)
+      elif CacheKey in self.__Pending:
+        Pos = self.__Pending.pop(CacheKey).get()
+      else:
+        Pos = ReadPdbListCoords(self.PdbFileList[ind], AtomInd, Names, Mask)
+      self.__Cache[CacheKey] = Pos
+      while len(self.__Cache) > self.CacheSize:
+        self.__Cache.popitem(last = False)
+      self.__PrefetchFrom(ind, Key, AtomInd, Names, Mask)
+      #callers may modify positions in place, so hand out a copy
+      self.Pos = Pos.copy()
     if self.LastLen > 0 and not self.LastLen == len(self.Pos):
       raise ValueError, "Configuration read with different number of atoms from last read."
     self.LastLen = len(self.Pos)
@@ -669,6 +1892,30 @@ class PdbListClass:
     if not self.LinkPos is None: self.LinkPos[:,:] = self.Pos
     return self.Pos
 
+  def __PrefetchFrom(self, ind, Key, AtomInd, Names, Mask):
+    "Starts parsing the Prefetch files after ind in worker processes."
+    if self.Prefetch <= 0: return
+    Wanted = [(i, Key) for i in range(ind + 1,
+              min(ind + 1 + self.Prefetch, len(self.PdbFileList)))]
+    #forget prefetches that are no longer ahead of the current file
+    for CacheKey in self.__Pending.keys():
+      if not CacheKey in Wanted: del self.__Pending[CacheKey]
+    if self.__Pool is None:
+      self.__Pool = multiprocessing.Pool(self.NProc)
+    for CacheKey in Wanted:
+      if CacheKey in self.__Cache or CacheKey in self.__Pending: continue
+      Args = (self.PdbFileList[CacheKey[0]], AtomInd, Names, Mask)
+      self.__Pending[CacheKey] = self.__Pool.apply_async(_ReadPdbListTask, (Args,))
+
+  def Close(self):
+    "Stops any worker processes and releases cached coordinates."
+    if not self.__Pool is None:
+      self.__Pool.terminate()
+      self.__Pool.join()
+      self.__Pool = None
+    self.__Pending = {}
+    self.__Cache = OrderedDict()
+
   def __getitem__(self, ind):
     return self.Get(ind)
 
@@ -788,3 +2035,41 @@ class MultiCoordClass:
     "Returns the configuration indices of all read in so far."
     return range(self.NCoords)
   
+
+
+#======== TESTING ========
+
+def TestParseCrd(NAtom = 50000, NFrame = 10):
+  "Compares the speed and results of the old and vectorized crd parsers."
+  NPerLine = 10
+  Pos = 100. * (random.rand(NFrame, NAtom, 3) - 0.5)
+  #make a crd frame string in the amber format
+  p = ["%8.3f" % x for x in Pos[0].flat]
+  s = "\n".join(["".join(p[i:i+NPerLine]) for i in xrange(0, len(p), NPerLine)]) + "\n"
+  AtomNames = [["CA", "C", "N", "O", "H"][i % 5] for i in range(NAtom)]
+  for (Label, Mask) in [("all atoms", NoMask), ("alpha carbons", AlphaCarbonMask)]:
+    print "Parsing %d frames of %d atoms, %s..." % (NFrame, NAtom, Label)
+    StartTime = time.time()
+    for i in range(NFrame):
+      Pos1 = ParseCrdStringOld(s, AtomNames, Mask)
+    t1 = time.time() - StartTime
+    StartTime = time.time()
+    for i in range(NFrame):
+      Pos2 = ParseCrdString(s, AtomNames, Mask)
+    t2 = time.time() - StartTime
+    StartTime = time.time()
+    Pos3 = ParseCrdFrames(s * NFrame, NAtom, AtomNames, Mask)
+    t3 = time.time() - StartTime
+    StartTime = time.time()
+    AtomInd = GetMaskInd(AtomNames, Mask)
+    if AtomInd is None: AtomInd = arange(NAtom)
+    CrdByteInd = GetCrdByteInd(NAtom, AtomInd)
+    for i in range(NFrame):
+      Pos4 = ParseCrdAtoms(s, NAtom, AtomInd, CrdByteInd)[0]
+    t4 = time.time() - StartTime
+    print "  ParseCrdStringOld: %10.1f frames/sec" % (NFrame / t1)
+    print "  ParseCrdString   : %10.1f frames/sec" % (NFrame / t2)
+    print "  ParseCrdFrames   : %10.1f frames/sec" % (NFrame / t3)
+    print "  ParseCrdAtoms    : %10.1f frames/sec" % (NFrame / t4)
+    print "  Results agree    : %s" % (all(Pos1 == Pos2) and all(Pos3 == Pos1)
+                                       and all(Pos4 == Pos1))
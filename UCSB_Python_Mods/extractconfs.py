@@ -102,22 +102,23 @@ print "First atom is : CA%d in residue %s%d" % (CA1+1, p.Seq[ResNum1], ResNum1+1
 print "Second atom is: CA%d in residue %s%d" % (CA2+1, p.Seq[ResNum2], ResNum2+1)
 print "Distance range is from %8.3f to %8.3f A" % (MinDist, MaxDist)
 
-#now sort through all of the configurations
+#now sort through all of the configurations, writing matches as we go
 Ind = 0
+Crd = coords.CrdWriter(str(mdcrd), "w")
 for (i, Pos) in enumerate(Trj):
   if (i+1) % 500 == 0: print "...examined %d snapshots" % (i+1)
   Dist = geometry.Length(Pos[CA1] - Pos[CA2])
   if Dist >= MinDist and Dist < MaxDist:
     fn = "%s%0*d.pdb" % (str(Prefix), NDigits, Ind)
     p.WritePdb(fn)
+    Crd.Write(Pos)
     Ind += 1
     pdbfiles.append(fn)
 #close down
 p.UnlinkTrj()
 Trj.Close()
-#Creates the mdcrd of the frames the meet the criterion
-print " Writing " + str(len(pdbfiles)) + " frames to " + str(mdcrd)
-
-coords.PdbsToCrd(pdbfiles,str(mdcrd))
+#Closes the mdcrd of the frames the meet the criterion
+Crd.Close()
+print " Wrote " + str(len(Crd)) + " frames to " + str(mdcrd)
     
 
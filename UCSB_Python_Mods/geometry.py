@@ -20,6 +20,10 @@ except ImportError:
 DegPerRad = 180./pi
 RadPerDeg = pi/180.
 
+#relative precision and maximum Newton iterations for the QCP eigenvalue
+QCPPrec = 1.e-11
+QCPMaxIter = 50
+
 
 #======== VECTOR FUNCTIONS ========
 
@@ -416,8 +420,107 @@ dot(Pos2 + Pos2Vec, RotMat)."""
   return Pos1Vec, Pos2Vec, U, Residuals
 
 
+def QCPMaxEig(E0, C):
+  """Returns the largest eigenvalue of the quaternion key matrix by
+Newton iteration on its characteristic polynomial (QCP method); works
+elementwise on stacks of correlation matrices.
+* E0: half the sum of squared (centered) coordinates, scalar or [F]
+* C: correlation matrix dot(transpose(Pos1), Pos2), [3,3] or [F,3,3]"""
+  Single = len(C.shape) == 2
+  if Single:
+    #plain floats are much quicker than numpy scalars here
+    Sxx, Sxy, Sxz, Syx, Syy, Syz, Szx, Szy, Szz = C.ravel().tolist()
+  else:
+    Sxx, Sxy, Sxz = C[:,0,0], C[:,0,1], C[:,0,2]
+    Syx, Syy, Syz = C[:,1,0], C[:,1,1], C[:,1,2]
+    Szx, Szy, Szz = C[:,2,0], C[:,2,1], C[:,2,2]
+  Sxx2, Syy2, Szz2 = Sxx*Sxx, Syy*Syy, Szz*Szz
+  Sxy2, Syz2, Sxz2 = Sxy*Sxy, Syz*Syz, Sxz*Sxz
+  Syx2, Szy2, Szx2 = Syx*Syx, Szy*Szy, Szx*Szx
+  SyzSzymSyySzz2 = 2.*(Syz*Szy - Syy*Szz)
+  Sxx2Syy2Szz2Syz2Szy2 = Syy2 + Szz2 - Sxx2 + Syz2 + Szy2
+  SxzpSzx, SyzpSzy, SxypSyx = Sxz + Szx, Syz + Szy, Sxy + Syx
+  SyzmSzy, SxzmSzx, SxymSyx = Syz - Szy, Sxz - Szx, Sxy - Syx
+  SxxpSyy, SxxmSyy = Sxx + Syy, Sxx - Syy
+  Sxy2Sxz2Syx2Szx2 = Sxy2 + Sxz2 - Syx2 - Szx2
+  #coefficients of the characteristic polynomial
+  C2 = -2. * (Sxx2 + Syy2 + Szz2 + Sxy2 + Syx2 + Sxz2 + Szx2 + Syz2 + Szy2)
+  C1 = 8. * (Sxx*Syz*Szy + Syy*Szx*Sxz + Szz*Sxy*Syx
+             - Sxx*Syy*Szz - Syz*Szx*Sxy - Szy*Syx*Sxz)
+  C0 = Sxy2Sxz2Syx2Szx2 * Sxy2Sxz2Syx2Szx2 \
+       + (Sxx2Syy2Szz2Syz2Szy2 + SyzSzymSyySzz2) * (Sxx2Syy2Szz2Syz2Szy2 - SyzSzymSyySzz2) \
+       + (-SxzpSzx*SyzmSzy + SxymSyx*(SxxmSyy - Szz)) * (-SxzmSzx*SyzpSzy + SxymSyx*(SxxmSyy + Szz)) \
+       + (-SxzpSzx*SyzpSzy - SxypSyx*(SxxpSyy - Szz)) * (-SxzmSzx*SyzmSzy - SxypSyx*(SxxpSyy + Szz)) \
+       + (SxypSyx*SyzpSzy + SxzpSzx*(SxxmSyy + Szz)) * (-SxymSyx*SyzmSzy + SxzpSzx*(SxxpSyy + Szz)) \
+       + (SxypSyx*SyzmSzy + SxzmSzx*(SxxmSyy - Szz)) * (-SxymSyx*SyzpSzy + SxzmSzx*(SxxpSyy - Szz))
+  #Newton iteration starting from the upper bound E0
+  if Single:
+    Eig = float(E0)
+    for i in range(QCPMaxIter):
+      x2 = Eig*Eig
+      b = (x2 + C2)*Eig
+      a = b + C1
+      Denom = 2.*x2*Eig + b + a
+      if Denom == 0.: break
+      Delta = (a*Eig + C0) / Denom
+      Eig = Eig - Delta
+      if abs(Delta) <= abs(QCPPrec*Eig): break
+  else:
+    Eig = array(E0, float)
+    for i in range(QCPMaxIter):
+      x2 = Eig*Eig
+      b = (x2 + C2)*Eig
+      a = b + C1
+      Denom = 2.*x2*Eig + b + a
+      Delta = (a*Eig + C0) / where(Denom == 0., 1., Denom)
+      Eig = Eig - Delta
+      if all(abs(Delta) <= abs(QCPPrec*Eig)): break
+  return Eig
+
+
 def RMSD(Pos1, Pos2, Center = True):
   """Returns root mean squared displacement for aligning
+Pos1 to Pos2, using the QCP method for three dimensions."""
+  d1, d2 = Pos1.shape
+  #QCP converges poorly on the repeated roots of very small sets
+  if not d2 == 3 or d1 < 4: return RMSDOld(Pos1, Pos2, Center)
+  #get centers
+  if Center:
+    p1 = Pos1 - average(Pos1, axis=0)
+    p2 = Pos2 - average(Pos2, axis=0)
+  else:
+    p1, p2 = Pos1, Pos2
+  #check for identity
+  if all(p1 == p2) or d1==0: return 0.
+  #calculate E0 and correlation matrix
+  E0 = 0.5 * (sum(p1*p1, axis=None) + sum(p2*p2, axis=None))
+  C = dot(transpose(p1), p2)
+  Eig = QCPMaxEig(E0, C)
+  return sqrt(max(2. * (E0 - Eig), 0.) / d1)
+
+def RMSDBatch(Pos1, PosStack, Center = True):
+  """Returns an array of root mean squared displacements for aligning
+each of the [F,N,3] conformations in PosStack to Pos1, using the QCP method."""
+  NFrame, d1, d2 = PosStack.shape
+  if not d2 == 3 or d1 < 4:
+    return array([RMSDOld(Pos1, Pos2, Center) for Pos2 in PosStack], float)
+  #get centers
+  if Center:
+    p1 = Pos1 - average(Pos1, axis=0)
+    p2 = PosStack - average(PosStack, axis=1)[:,newaxis,:]
+  else:
+    p1, p2 = Pos1, PosStack
+  #calculate E0 and correlation matrices
+  E0 = 0.5 * (sum(p1*p1, axis=None) + sum(sum(p2*p2, axis=2), axis=1))
+  C = einsum("ni,fnj->fij", p1, p2)
+  Eig = QCPMaxEig(E0, C)
+  r = sqrt(maximum(2. * (E0 - Eig), 0.) / d1)
+  #check for identity
+  r[all(all(p2 == p1, axis=2), axis=1)] = 0.
+  return r
+
+def RMSDOld(Pos1, Pos2, Center = True):
+  """Returns root mean squared displacement for aligning
 Pos1 to Pos2, such that Pos1 + Pos1Vec is aligned to
 dot(Pos2 + Pos2Vec, RotMat)."""
   d1, d2 = Pos1.shape
@@ -41,7 +41,7 @@ if __name__ == "__main__" and len(sys.argv) < 4:
   sys.exit()
 
 from numpy import *
-import os, time, shutil, gzip, copy, random, cPickle, sys, zlib, StringIO, re
+import os, time, shutil, gzip, copy, random, cPickle, sys, zlib, StringIO, re, json, bisect
 import sequence, pdbtools, protein, geometry, scripttools, coords
 
 
@@ -94,7 +94,10 @@ For writes, it will determine whether or not to gzip based on the extension.
     #open the files
     self.fobj = file(FileName, Mode)
     self.UseGzip = UseGzip
-    if self.UseGzip:
+    if self.UseGzip and "r" in Mode:
+      #checkpointed reader so that seeks don't restart decompression
+      self.f = coords.GzipSeekFile(FileName, Mode, fileobj = self.fobj)
+    elif self.UseGzip:
       self.f = gzip.GzipFile(filename = os.path.basename(FileName), fileobj = self.fobj)
     else:
       self.f = self.fobj
@@ -378,6 +381,14 @@ EneBlockLines = 10
 #This gives the number of header lines in the trj file.
 TrjHeadLines = 1
 
+#Extension of the manifest of segment boundaries kept next to each
+#concatenated master file, e.g., 0.mdene.txt.gz.manifest.json
+ConcatManifestExt = ".manifest.json"
+#Version of the concatenation manifest format
+ConcatManifestVer = 1
+#Number of bytes streamed at a time when concatenating a segment
+ConcatChunkSize = 4194304
+
 #These are all the files which must be saved prior to an undo.
 DataFiles = ["mdout.txt","mdout.crd","mdtrj.crd","mdene.txt","current.crd"]
 
@@ -882,12 +893,10 @@ Here, it is a string run by tleap after the system is created.
       #remove first two lines
       i = vals.find("\n")
       i = vals.find("\n", i+1)
-      vals = vals[i:].replace("\n","")
       try:
-        vals = [float(vals[i:i+12]) for i in range(0, len(vals), 12)]
+        Pos = coords.ParseFixedWidth(vals[i:], 12).reshape((-1,3))
       except ValueError:
         raise SimError, "Could not parse current.crd"
-      Pos = array(vals, float).reshape((-1,3))
       N = len(self.Atoms)
       Pos, Vel = Pos[:N,:], Pos[N:,:]
       if UseVel:
@@ -899,11 +908,7 @@ Here, it is a string run by tleap after the system is created.
     """Sets the atomic positions and optionally velocities."""
     def FmtArray(a):
       """Formats an array for Amber input.  Returns string."""
-      p = ["%12.7f" % x for x in a.flat]
-      r = mod(len(p), 6)
-      if r > 0: p.extend([""]*(6 - r))
-      s = "\n".join(["".join(p[i:i+6]) for i in range(0, len(p), 6)])
-      return s
+      return coords.FormatFixedWidth(a, "%12.7f", 6)
     CurFile = os.path.join(self.RunPath, "current.crd")
     if not os.path.isfile(CurFile):
       raise SimError, "Cannot find current.crd"
@@ -912,10 +917,10 @@ Here, it is a string run by tleap after the system is created.
     else:
       s = "ACE".ljust(80) + "\n"
       s += "%5d  0.0000000E+00\n" % len(Pos)
-      s += FmtArray(Pos) + "\n"
+      s += FmtArray(Pos)
       if not Vel is None and len(Vel) > 0:
         if Vel.shape == (len(self.Atoms), 3):
-          s += FmtArray(Vel) + "\n"
+          s += FmtArray(Vel)
         else:
           raise SimError, "Velocity array is not correct dimensionality: %s vs %s" % (repr(Vel.shape), repr(Pos.shape))
       file(CurFile, "w").write(s)
@@ -958,12 +963,10 @@ Here, it is a string run by tleap after the system is created.
       #remove first two lines
       i = vals.find("\n")
       i = vals.find("\n", i+1)
-      vals = vals[i:].replace("\n","")
       try:
-        vals = [float(vals[i:i+12]) for i in range(0, len(vals), 12)]
+        Pos = coords.ParseFixedWidth(vals[i:], 12).reshape((-1,3))
       except ValueError:
         raise SimError, "Could not parse ref.crd"
-      Pos = array(vals, float).reshape((-1,3))
       Pos = Pos[:len(self.Atoms),:]
       return Pos
 
@@ -979,12 +982,8 @@ Here, it is a string run by tleap after the system is created.
       Fmt = "%12.7f"
       s = "ACE".ljust(80) + "\n"
       s += "%5d  0.0000000E+00\n" % len(Pos)
-      p = [Fmt % x for x in Pos.flat]
-      r = mod(len(p), NPerLine)
-      if r > 0: p.extend([""]*(NPerLine - r))
-      for i in xrange(0, len(p), NPerLine):
-        s += "".join(p[i:i + NPerLine]) + "\n"
-      file(CurFile, "w").write(s)      
+      s += coords.FormatFixedWidth(Pos, Fmt, NPerLine)
+      file(CurFile, "w").write(s)
 
   def Recenter(self):
     """Centers the current configuration at the origin;
@@ -1998,26 +1997,49 @@ mdtrj.crd, and mdene.txt.
 * Gzip: Boolean specifying whether to use Gzip (default is True)
 * Current: True will update current.pdb
 * Params: True will update prmtop.parm7"""
-    def TrimLines(s, NLines):
-      """Removes first NLines of s"""
-      n = 0
-      for i in range(NLines):
-        n = s.find("\n", n) + 1
-        if n <= 0: return ""
-      return s[n:]
-    def ConcatFile(BaseFile, ConcatFile, NHeadLines):
-      """Concatenates File to ConcatFile."""
-      if os.path.isfile(BaseFile):     
-        s = file(BaseFile, "r").read()
-        if len(s) == 0 and RaiseErrors:
-          print "File %s is zero-length" % BaseFile
-        if os.path.isfile(ConcatFile):
-          s = TrimLines(s, NHeadLines)
-          myFile(ConcatFile, "a").write(s)
-        else:
-          myFile(ConcatFile, "w").write(s)
-      elif RaiseErrors:
-        raise IOError, "Cannot find %s" % BaseFile
+    def ConcatFile(BaseFile, ConcatFile, NHeadLines, NBlockLines = None):
+      """Streams File onto the end of ConcatFile (as a new gzip member
+if gzipped), without touching existing data, and records the new
+segment in the manifest of ConcatFile."""
+      if not os.path.isfile(BaseFile):
+        if RaiseErrors: raise IOError, "Cannot find %s" % BaseFile
+        return
+      if os.path.getsize(BaseFile) == 0 and RaiseErrors:
+        print "File %s is zero-length" % BaseFile
+      Exists = os.path.isfile(ConcatFile)
+      fin = file(BaseFile, "r")
+      Head = "".join([fin.readline() for i in range(NHeadLines)])
+      if Exists:
+        #master files from before manifests are scanned once
+        Man = GetConcatManifest(ConcatFile, NHeadLines, NBlockLines, Build = True)
+        CompStart = os.path.getsize(ConcatFile)
+        fout = myFile(ConcatFile, "a")
+        n = 0
+      else:
+        Man = {"version":ConcatManifestVer, "head_bytes":len(Head),
+               "block_bytes":None, "size":0, "segments":[]}
+        CompStart = 0
+        fout = myFile(ConcatFile, "w")
+        fout.write(Head)
+        n = len(Head)
+      if Man["block_bytes"] is None and not NBlockLines is None:
+        s = "".join([fin.readline() for i in range(NBlockLines)])
+        if s.count("\n") == NBlockLines: Man["block_bytes"] = len(s)
+        fout.write(s)
+        n += len(s)
+      while True:
+        s = fin.read(ConcatChunkSize)
+        if len(s) == 0: break
+        fout.write(s)
+        n += len(s)
+      fin.close()
+      fout.close()
+      UncompStart = 0
+      if len(Man["segments"]) > 0:
+        UncompStart = Man["segments"][-1][1] + Man["segments"][-1][2]
+      Man["segments"].append([CompStart, UncompStart, n])
+      Man["size"] = os.path.getsize(ConcatFile)
+      SaveConcatManifest(ConcatFile, Man)
     #change to DataPath so gzip names files correctly
     cwd = os.getcwd()
     if UseFullPath:
@@ -2041,7 +2063,7 @@ mdtrj.crd, and mdene.txt.
     trjFn1 = Prefix + "mdtrj.crd" + ext
     eneFn1 = Prefix + "mdene.txt" + ext
     ConcatFile(trjFn2, trjFn1, TrjHeadLines)
-    ConcatFile(eneFn2, eneFn1, EneHeadLines)
+    ConcatFile(eneFn2, eneFn1, EneHeadLines, EneBlockLines)
     os.chdir(cwd)
 
   def DelConcatData(self, Prefix, DataPath):
@@ -2049,11 +2071,98 @@ mdtrj.crd, and mdene.txt.
               "mdene.txt.gz", "mdtrj.crd", "mdtrj.crd.gz"]:
       fn = os.path.join(DataPath, Prefix + f)
       if os.path.isfile(fn): os.remove(fn)    
+      fn += ConcatManifestExt
+      if os.path.isfile(fn): os.remove(fn)
 
         
 
 #======== FUNCTIONS OPERATING ON CONCAT DATA ========
 
+def SaveConcatManifest(ConcatFile, Man):
+  """Saves the manifest of a concatenated master file.  The manifest has
+the header and record sizes in uncompressed bytes, the size of the master
+file when the manifest was written, and a list of segments, each
+[start in file, start in uncompressed data, uncompressed length]."""
+  fn = ConcatFile + ConcatManifestExt
+  f = open(fn + ".tmp", "w")
+  json.dump(Man, f)
+  f.close()
+  os.rename(fn + ".tmp", fn)
+
+def GetConcatManifest(ConcatFile, NHeadLines = EneHeadLines,
+                      NBlockLines = EneBlockLines, Build = False):
+  """Returns the manifest of a concatenated master file, or None if it is
+missing or the master file changed since it was written.  If Build is
+True, a missing or stale manifest is remade by scanning the master file,
+which is then treated as a single segment."""
+  fn = ConcatFile + ConcatManifestExt
+  if os.path.isfile(fn) and os.path.isfile(ConcatFile):
+    try:
+      f = open(fn, "r")
+      Man = json.load(f)
+      f.close()
+      if Man.get("version") == ConcatManifestVer \
+         and Man.get("size") == os.path.getsize(ConcatFile):
+        return Man
+    except (IOError, ValueError):
+      pass
+  if not Build or not os.path.isfile(ConcatFile): return None
+  f = myFile(ConcatFile, "r")
+  Head = "".join([f.readline() for i in range(NHeadLines)])
+  n = len(Head)
+  BlockBytes = None
+  if not NBlockLines is None:
+    s = "".join([f.readline() for i in range(NBlockLines)])
+    if s.count("\n") == NBlockLines: BlockBytes = len(s)
+    n += len(s)
+  if f.UseGzip:
+    #the gzip trailer only gives the size of the last member, so the
+    #data must be scanned once
+    while True:
+      m = len(f.read(ConcatChunkSize))
+      if m == 0: break
+      n += m
+  else:
+    n = os.path.getsize(ConcatFile)
+  f.close()
+  Man = {"version":ConcatManifestVer, "head_bytes":len(Head),
+         "block_bytes":BlockBytes, "size":os.path.getsize(ConcatFile),
+         "segments":[[0, 0, n]]}
+  try:
+    SaveConcatManifest(ConcatFile, Man)
+  except (IOError, OSError):
+    #e.g., a read-only data path; the manifest is just not kept
+    pass
+  return Man
+
+def OpenConcatFrame(ConcatFile, Man, Frame):
+  """Opens a concatenated master file positioned at the start of record
+Frame, using the manifest to go straight to the segment (gzip member)
+that holds it.  Returns a file object."""
+  H, B = Man["head_bytes"], Man["block_bytes"]
+  #first record of each segment
+  Starts, n = [], 0
+  for (i, Seg) in enumerate(Man["segments"]):
+    Starts.append(n)
+    n += (Seg[2] - (i == 0 and H or 0)) / B
+  k = max(bisect.bisect_right(Starts, Frame) - 1, 0)
+  CompStart, UncompStart, NBytes = Man["segments"][k]
+  Skip = (k == 0 and H or 0) + (Frame - Starts[k]) * B
+  if ConcatFile.endswith(".gz"):
+    raw = file(ConcatFile, "rb")
+    raw.seek(CompStart)
+    f = gzip.GzipFile(fileobj = raw)
+    #let the gzip object close the underlying file
+    f.myfileobj = raw
+    while Skip > 0:
+      m = len(f.read(min(Skip, ConcatChunkSize)))
+      if m == 0: break
+      Skip -= m
+  else:
+    f = file(ConcatFile, "r")
+    f.seek(UncompStart + Skip)
+  return f
+
 
 def GetHistory(DataPath, Prefix = "", Vars = [v for v in EneParseData.iterkeys()],
                NFrameSkip = 0, NFrameRead = -1):
@@ -2075,33 +2184,39 @@ data from concatenated files.
   fn = os.path.join(DataPath, Prefix + "mdene.txt.gz")
   if not os.path.isfile(fn):
     fn = os.path.join(DataPath, Prefix + "mdene.txt")
-  f = myFile(fn, "r")
-  #skip over header
-  for i in range(0,EneHeadLines):
-    f.readline()
-  #mark current position
-  CurPos = f.tell()
-  #get block size
-  try:
-    BytesPerBlock = 0
-    for i in range(EneBlockLines):
-      m = len(f.readline())
-      if m == 0:
-        #could not read first record
-        f.close()
-        return l
-      BytesPerBlock += m
-  except IOError:
-    f.close()
-    return l
-  #go back to original position
-  f.seek(CurPos)
-  #skip as necessary
-  try:
-    f.seek(CurPos + BytesPerBlock * NFrameSkip)
-  except IOError:
-    print "Could not skip required number of frames in %s" % os.path.abspath(fn)
-    raise
+  Man = GetConcatManifest(fn)
+  if not Man is None and Man["block_bytes"]:
+    #go straight to the segment holding the first frame
+    BytesPerBlock = Man["block_bytes"]
+    f = OpenConcatFrame(fn, Man, NFrameSkip)
+  else:
+    f = myFile(fn, "r")
+    #skip over header
+    for i in range(0,EneHeadLines):
+      f.readline()
+    #mark current position
+    CurPos = f.tell()
+    #get block size
+    try:
+      BytesPerBlock = 0
+      for i in range(EneBlockLines):
+        m = len(f.readline())
+        if m == 0:
+          #could not read first record
+          f.close()
+          return l
+        BytesPerBlock += m
+    except IOError:
+      f.close()
+      return l
+    #go back to original position
+    f.seek(CurPos)
+    #skip as necessary
+    try:
+      f.seek(CurPos + BytesPerBlock * NFrameSkip)
+    except IOError:
+      print "Could not skip required number of frames in %s" % os.path.abspath(fn)
+      raise
   #read in data
   n = 0
   while n < NFrameRead or NFrameRead < 0:
@@ -2131,48 +2246,21 @@ data from concatenated files.
   return l
 
 def GetNFrames(DataPath, Prefix = ""):
-  """Returns the number of frames in concatenated data.
+  """Returns the number of frames in concatenated data.  The count comes
+from the manifest of the master ene file, which ConcatData updates on
+each append; a master without a valid manifest is scanned once and its
+manifest saved.
 * Prefix: string with the prefix to add to each file it updates
 * DataPath: string specifying path location of the master files"""
   #check for file existence
   fn = os.path.join(DataPath, Prefix + "mdene.txt.gz")
-  try:
-    f = myFile(fn, "r")
-  except IOError:
-    f.close()
-    return 0
-  #skip over header
-  for i in range(0,EneHeadLines):
-    f.readline()
-  #initialize count
-  n = 0
-  #read first record
-  try:
-    BytesPerBlock = 0
-    for i in range(EneBlockLines):
-      m = len(f.readline())
-      if m == 0:
-        #could not read first record
-        f.close()
-        return 0
-      BytesPerBlock += m
-    n = 1
-  except IOError:
-    f.close()
-    return 0
-  #now read remaining records  
-  while True:
-    #read data and get tokens
-    try:
-      s = f.read(BytesPerBlock)
-      if len(s) < BytesPerBlock:
-        break
-    except IOError:
-      break
-    n += 1
-  f.close()
-  #return length
-  return n
+  if not os.path.isfile(fn):
+    fn = os.path.join(DataPath, Prefix + "mdene.txt")
+    if not os.path.isfile(fn): return 0
+  Man = GetConcatManifest(fn, EneHeadLines, EneBlockLines, Build = True)
+  if not Man["block_bytes"]: return 0
+  Seg = Man["segments"][-1]
+  return (Seg[1] + Seg[2] - Man["head_bytes"]) / Man["block_bytes"]
 
 
 #======== PREPARING PDB FILES FOR INPUT ========
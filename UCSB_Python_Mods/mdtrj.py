@@ -8,12 +8,14 @@
 
 from numpy import *
 import os, sys, glob, gzip
-import coords, sequence
+import coords, sequence, scripttools
 
 #GLOBALS
 BlockLen = 13
 DistFmt = "%.3f"
 VerboseDflt = False
+#number of frames decoded and written per block in SaveTrjDists
+ChunkSize = 100
 DistMethodDesc = ["alpha carbons", "beta carbons", "residue centroid"]
 
 
@@ -133,6 +135,20 @@ Returns PairAtoms, PairList.
   return PairAtoms, PairList
   
 
+def MakeGroupWeights(GroupAtoms):
+  """Makes a group membership matrix so that centroids are a dot product.
+Returns UsedAtoms, Weights.
+* GroupAtoms: list of atoms in each group
+* UsedAtoms: sorted array of all atom numbers in any group
+* Weights: array [NGroup, len(UsedAtoms)] such that dot(Weights, Pos[UsedAtoms])
+           gives the group centroids"""
+  UsedAtoms = unique(concatenate([array(g, int) for g in GroupAtoms]))
+  Weights = zeros((len(GroupAtoms), len(UsedAtoms)), float)
+  for (i, Group) in enumerate(GroupAtoms):
+    add.at(Weights[i], searchsorted(UsedAtoms, Group), 1. / len(Group))
+  return UsedAtoms, Weights
+
+
 def SaveTrjDists(TrjFile, PrmtopFile, OutputPath, PairAtoms,
   PairLabels = None, NSkip = 0, NRead = None, NStride = 1,
   Prefix = "", Verbose = VerboseDflt):
@@ -150,9 +166,9 @@ def SaveTrjDists(TrjFile, PrmtopFile, OutputPath, PairAtoms,
   #make sure any pairs are specified
   if len(PairAtoms) == 0:
     return
+  if Verbose: print "Processing trajectory %s" % TrjFile
   #convert to groups
   GroupAtoms, PairGroups = MakeAtomGroups(PairAtoms)
-  NGroup = len(GroupAtoms)
   #make trj object
   Trj = coords.TrjClass(TrjFile, PrmtopFile, NSkip = NSkip, NRead = NRead, NStride = NStride)
   #check labels
@@ -164,26 +180,26 @@ def SaveTrjDists(TrjFile, PrmtopFile, OutputPath, PairAtoms,
   f = gzip.GzipFile(fn, "w")
   f.write("".join(ColHead) + "\n")
   #initialize variables
-  GroupPos = zeros((NGroup,3), float)
-  #now parse the trajectory
-  for Pos in Trj:
-    #calculate the centroid of group coordinates
-    GroupPos.fill(0.)
-    for i in range(0,NGroup):
-      Group = GroupAtoms[i]
-      for AtomNum in Group:
-        GroupPos[i,:] += Pos[AtomNum,:]
-      GroupPos[i,:] /= float(len(Group))
-    #calculate the distances
-    DistList = []
-    for Group1, Group2 in PairGroups:
-      Dist = sqrt( sum((GroupPos[Group1,:] - GroupPos[Group2,:])**2) )
-      DistList.append(Dist)
-    #output to file
-    s = ("%d" % Trj.Index).ljust(BlockLen-1) + " "
-    s += " ".join([(DistFmt % d).ljust(BlockLen-1) for d in DistList])
-    s += "\n"
-    f.write(s)
+  UsedAtoms, Weights = MakeGroupWeights(GroupAtoms)
+  Group1 = array([g1 for (g1, g2) in PairGroups], int)
+  Group2 = array([g2 for (g1, g2) in PairGroups], int)
+  Fmt = "%%-%dd " % (BlockLen-1)
+  Fmt += " ".join(["%%-%d%s" % (BlockLen-1, DistFmt[1:])] * len(PairGroups))
+  Fmt += "\n"
+  #now parse the trajectory a block of frames at a time
+  Start = 0
+  for Pos in Trj.IterChunks(ChunkSize, Reuse = True):
+    K = len(Pos)
+    #group centroids for all frames, [NGroup, K, 3]
+    GroupPos = dot(Weights, Pos[:,UsedAtoms,:])
+    #pair distances, [K, NPair]
+    Dist = sqrt(((GroupPos[Group1] - GroupPos[Group2])**2).sum(axis=2)).T
+    #output the block with frame indices
+    Out = empty((K, len(PairGroups) + 1), float)
+    Out[:,0] = NSkip + NStride * arange(Start, Start + K)
+    Out[:,1:] = Dist
+    f.write((Fmt * K) % tuple(Out.ravel().tolist()))
+    Start += K
   f.close()
   Trj.Close()
 
@@ -210,9 +226,27 @@ def GetTrjList(DataPath, ReplicaInd = None):
         raise IOError, "Trajectory %d in %s not found" % (i, DataPath)
   return TrjList, ReplicaInd
 
+def RunTrjTasks(Func, TrjList, ArgsList, KwArgsList, NProc = 1):
+  """Runs a per-trajectory function over a list of trajectories in
+parallel; raises IOError naming every trajectory that failed, after
+all of the others have finished.  With one process, an exception
+propagates unchanged from the trajectory that raised it.
+* Func: module-level function taking the trajectory file first
+* TrjList: list of trajectory files, one per task
+* ArgsList, KwArgsList: arguments and keyword arguments for each task
+* NProc: number of worker processes (None for all cpus)"""
+  Results, Errors = scripttools.RunTasks(Func, ArgsList, KwArgsList,
+                                         NProc = NProc)
+  if len(Errors) > 0:
+    for (i, Msg) in Errors:
+      sys.stderr.write("Error processing trajectory %s:\n%s" % (TrjList[i], Msg))
+    raise IOError, "Failed processing %d of %d trajectories: %s" % \
+      (len(Errors), len(TrjList), ", ".join([TrjList[i] for (i, Msg) in Errors]))
+  return Results
+
 def SaveAllTrjDists(DataPath, OutputPath, PairAtoms,
   PairLabels = None, ReplicaInd = None, NSkip = 0, NRead = None, NStride = 1,
-  Prefix = "", Verbose = VerboseDflt):
+  Prefix = "", Verbose = VerboseDflt, NProc = 1):
   """Saves distances from all trajectories in a path to gzipped files.
 * DataPath: path with trajectories and prmtop files
 * OutputPath: string, path to save distance files
@@ -223,20 +257,23 @@ def SaveAllTrjDists(DataPath, OutputPath, PairAtoms,
 * NRead: maximum number of configurations to read (default is all)
 * NStride: stride between configuration frames (default is 1)
 * Prefix: will be added after the number, eg "0.prefixdist.txt.gz"
-* Verbose: boolean, display verbose messages?"""
+* Verbose: boolean, display verbose messages?
+* NProc: number of trajectories to process in parallel (None for all cpus)"""
   #check path
   if not os.path.isdir(OutputPath): os.mkdir(OutputPath)
   #find all trajectories
   TrjList, ReplicaInd = GetTrjList(DataPath, ReplicaInd)  
-  #for each trajectory
+  #make a task for each trajectory
+  ArgsList, KwArgsList = [], []
   for TrjFile in TrjList:
     #get trj prefix
-    if Verbose: print "Processing trajectory %s" % TrjFile
     TrjPrefix = os.path.basename(TrjFile).replace("mdtrj.crd", "").replace(".gz", "").strip()
     PrmtopFile =  os.path.join(DataPath, TrjPrefix + "prmtop.parm7")
-    SaveTrjDists(TrjFile, PrmtopFile, OutputPath, PairAtoms,
-      PairLabels = PairLabels, NSkip = NSkip, NRead = NRead, NStride = NStride,
-      Prefix = TrjPrefix + Prefix, Verbose = Verbose)   
+    ArgsList.append((TrjFile, PrmtopFile, OutputPath, PairAtoms))
+    KwArgsList.append({"PairLabels" : PairLabels, "NSkip" : NSkip,
+      "NRead" : NRead, "NStride" : NStride,
+      "Prefix" : TrjPrefix + Prefix, "Verbose" : Verbose})
+  RunTrjTasks(SaveTrjDists, TrjList, ArgsList, KwArgsList, NProc)
   if Verbose: print "Done processing trajectory distances"
   
 
@@ -275,7 +312,8 @@ def SaveTrjResDists(TrjFile, PrmtopFile, OutputPath, PairList,
     
 def SaveAllTrjResDists(DataPath, OutputPath, PairList,
   ReplicaInd = None, NSkip = 0, NRead = None, NStride = 1,
-  DistMethod = 0, StartRes = 0, Prefix = "", Verbose = VerboseDflt):
+  DistMethod = 0, StartRes = 0, Prefix = "", Verbose = VerboseDflt,
+  NProc = 1):
   """Saves distances from all trajectories in a path to gzipped files.
 * DataPath: path with trajectories and prmtop files
 * OutputPath: string, path to save distance files
@@ -290,21 +328,23 @@ def SaveAllTrjResDists(DataPath, OutputPath, PairList,
             equal to 2 means a pair between the 2nd and 3rd residues
             in the trajectory
 * Prefix: will be added after the number, eg "0.prefixdist.txt.gz"
-* Verbose: boolean, display verbose messages?"""
+* Verbose: boolean, display verbose messages?
+* NProc: number of trajectories to process in parallel (None for all cpus)"""
   #check path
   if not os.path.isdir(OutputPath): os.mkdir(OutputPath)
   #find all trajectories
   TrjList, ReplicaInd = GetTrjList(DataPath, ReplicaInd)       
-  #for each trajectory
+  #make a task for each trajectory
+  ArgsList, KwArgsList = [], []
   for TrjFile in TrjList:
     #get trj prefix
-    if Verbose: print "Processing trajectory %s" % TrjFile
     TrjPrefix = os.path.basename(TrjFile).replace("mdtrj.crd", "").replace(".gz", "").strip()
     PrmtopFile =  os.path.join(DataPath, TrjPrefix + "prmtop.parm7")
-    SaveTrjResDists(TrjFile, PrmtopFile, OutputPath, PairList,
-      NSkip = NSkip, NRead = NRead, NStride = NStride,
-      Prefix = TrjPrefix + Prefix, DistMethod = DistMethod,
-      StartRes = StartRes, Verbose = Verbose)   
+    ArgsList.append((TrjFile, PrmtopFile, OutputPath, PairList))
+    KwArgsList.append({"NSkip" : NSkip, "NRead" : NRead, "NStride" : NStride,
+      "Prefix" : TrjPrefix + Prefix, "DistMethod" : DistMethod,
+      "StartRes" : StartRes, "Verbose" : Verbose})
+  RunTrjTasks(SaveTrjResDists, TrjList, ArgsList, KwArgsList, NProc)
   if Verbose: print "Done processing trajectory distances"
   
 
@@ -166,7 +166,7 @@ def RunAnalTrj(TrjFile, PrmtopFile, OutputPath = None, Prefix = None,
   NSkip = 0, NRead = None, NStride = 1):
   "Runs a mesostring analysis of a trajectory."
   #make the coords object
-  CoordsObj = coords.TrjClass(TrjFile, PrmtopFile,
+  CoordsObj = coords.GetTrjObj(TrjFile, PrmtopFile,
       NSkip = NSkip, NRead = NRead, NStride = NStride)
   ConfMeso, MesoPop, MesoEntropy = RunAnal(CoordsObj, OutputPath, Prefix)
   return ConfMeso, MesoPop, MesoEntropy
@@ -24,9 +24,29 @@ if __name__ == "__main__" and len(sys.argv) == 1:
   sys.exit()
 
 from numpy import *  
-import copy, os, coords, random
+from numpy.lib.format import open_memmap
+import copy, os, coords, random, hashlib
 import geometry, sequence, protein, scripttools
 
+#frames per side of one tile of the pairwise rmsd matrix
+RMSDMatrixTile = 500
+#number of cluster centroids compared to a configuration at once
+ClusterChunk = 64
+#k-medoids samples: number of samples drawn and the number of
+#frames in each beyond twice the number of clusters (CLARA)
+MedoidDraws = 5
+MedoidSampleBase = 40
+#extensions of the completed-tile log and the worker position
+#cache kept next to a pairwise rmsd matrix file
+RMSDMatrixLogExt = ".tiles"
+RMSDMatrixPosExt = ".pos.npy"
+#fraction of the free memory that the working copy of the rmsd matrix in
+#ClusterLinkage may take before it is put on disk next to the matrix file
+LinkageMemFrac = 0.5
+LinkageScratchExt = ".linkage.npy"
+#number of matrix elements copied at a time into a working copy
+MatrixCopyChunk = 10000000
+
 
 def RMSD(Pos1, Pos2, Align = False, Center = True,
          CompInd = None, CalcInd = None, Verbose = False,
@@ -56,6 +76,9 @@ def RMSD(Pos1, Pos2, Align = False, Center = True,
   elif not len(shape(p1)) == 2:
     if Verbose: print "Position vectors are not the correct rank."
     return
+  #rmsd only needs the optimal eigenvalue, not the rotation
+  if not Align and not RetAlignment and all(CompInd == CalcInd):
+    return geometry.RMSD(p1, p2, Center = Center)
   #get alignment
   Pos1Vec, Pos2Vec, RotMat, Resid = geometry.AlignmentRMSD(p1, p2, Center = Center)
   #compute rmsd
@@ -76,6 +99,75 @@ def RMSD(Pos1, Pos2, Align = False, Center = True,
     return r
 
 
+def RMSDBatch(Ref, PosStack, CompInd = None, CalcInd = None, Center = True,
+              RetAligned = False):
+  """Calculates the RMSD between a reference and a stack of conformations,
+solving all of the alignments at once; matches RMSD frame by frame.
+* Ref: array of dimensions [N,3] for the reference conformation
+* PosStack: array of dimensions [F,N,3] for F conformations
+* CompInd: indices in [0,N) for positions in Pos to perform alignment
+* CalcInd: indices in [0,N) for positions in Pos to compute RMSD
+* RetAligned: True to also return an [F,N,3] array of PosStack aligned
+  to Ref
+Returns an array of F RMSD values (and the aligned array)."""
+  Ref = asarray(Ref, float)
+  PosStack = asarray(PosStack, float)
+  if not len(Ref.shape) == 2 or not len(PosStack.shape) == 3 \
+     or not PosStack.shape[1:] == Ref.shape:
+    raise ValueError, "Expected a [N,3] reference and a [F,N,3] stack."
+  #clean indices
+  AllInd = arange(len(Ref), dtype = int)
+  if all(CompInd == AllInd): CompInd = None
+  if all(CalcInd == AllInd): CalcInd = None
+  #get indices
+  if CompInd is None:
+    p1, p2, n = Ref, PosStack, len(Ref)
+  else:
+    p1, p2, n = Ref.take(CompInd, axis=0), PosStack.take(CompInd, axis=1), len(CompInd)
+  #rmsd only needs the optimal eigenvalues, not the rotations
+  if not RetAligned and all(CompInd == CalcInd):
+    return geometry.RMSDBatch(p1, p2, Center = Center)
+  NFrame, Dim = len(PosStack), Ref.shape[1]
+  #get centers
+  if Center:
+    Pos1Vec = -average(p1, axis=0)
+    Pos2Vec = -average(p2, axis=1)
+    p1 = p1 + Pos1Vec
+    p2 = p2 + Pos2Vec[:,newaxis,:]
+  else:
+    Pos1Vec, Pos2Vec = zeros(Dim, float), zeros((NFrame, Dim), float)
+  #calculate E0 and the correlation matrices
+  E0 = sum(p1*p1, axis=None) + sum(sum(p2*p2, axis=2), axis=1)
+  C = einsum("fni,nj->fij", p2, p1)
+  #get singular value decomps for all frames at once
+  V, S, Wt = linalg.svd(C)
+  #if it's a reflection, reflect along lowest eigenvalue
+  Sign = sign(linalg.det(V) * linalg.det(Wt))
+  S[:,-1] = S[:,-1] * Sign
+  Resid = maximum(E0 - 2. * sum(S, axis=1), 0.)
+  Wt[:,-1,:] = Wt[:,-1,:] * Sign[:,newaxis]
+  RotMat = matmul(V, Wt)
+  #frames identical to the reference need no rotation
+  Same = all(all(p2 == p1, axis=2), axis=1)
+  if any(Same):
+    RotMat[Same] = identity(Dim, float)
+    Resid[Same] = 0.
+  #compute rmsd
+  if not all(CompInd == CalcInd):
+    if CalcInd is None:
+      p1, p2, n = Ref, PosStack, len(Ref)
+    else:
+      p1, p2, n = Ref.take(CalcInd, axis=0), PosStack.take(CalcInd, axis=1), len(CalcInd)
+    p1 = p1 + Pos1Vec
+    p2 = matmul(p2 + Pos2Vec[:,newaxis,:], RotMat)
+    Resid = sum(sum((p2 - p1)**2, axis=2), axis=1)
+  r = sqrt(Resid / float(n))
+  if RetAligned:
+    return r, matmul(PosStack + Pos2Vec[:,newaxis,:], RotMat) - Pos1Vec
+  else:
+    return r
+
+
 def GetProteinClassMasks(p, AtomMask = None, CompResInd = None,
                          CalcResInd = None):
   if AtomMask is None:
@@ -215,14 +307,6 @@ def ClusterMSS(CoordsObj, Cutoff, MaxIter = 3, MaxCluster = None,
 * IterMaxCluster: True will dump all but MaxCluster configs each iter
 * IterNormalize: True will dump previous iter contribs to centroids
 """
-  def BasicRMSD(Pos1, Pos2, Ind = None):
-    "Calculates the rmsd between two configurations without alignment."
-    if Ind is None:
-      rmsdsq = sum((Pos1-Pos2)**2) / float(size(Pos1,0))
-    else:
-      rmsdqs = sum((Pos1[Ind]-Pos2[Ind])**2) / float(size(Pos1[Ind],0))
-    rmsdsq = max([rmsdsq,0.])
-    return sqrt(rmsdsq)
   Iteration = 0   #iteration number
   WeightSum = []  #total weights of clusters
   PosSum = []        #list of cluster configuration arrays
@@ -249,10 +333,20 @@ def ClusterMSS(CoordsObj, Cutoff, MaxIter = 3, MaxCluster = None,
     if Verbose: print "Starting with %d clusters" % len(PosSum)
     CoordsObj.Reset()
     ClustNum = zeros(NCoord, int)  #cluster number of each configuration, starting at 1
-    NAddThis = [0]*len(PosSum)     #number of configs added to each cluster this iteration
     ThisFrame = 0
-    PosSumThis = copy.deepcopy(PosSum)
-    WeightSumThis = copy.deepcopy(WeightSum)
+    #cluster sums, weights, and normalized centroids are kept in
+    #contiguous arrays that grow as clusters are added
+    NClust = len(PosSum)
+    NAddThis = zeros(NClust, int)  #number of configs added to each cluster this iteration
+    if NClust > 0:
+      PosSumArr = array(PosSum, float)
+      WeightSumArr = array(WeightSum, float)
+      CentArr = PosSumArr / WeightSumArr[:,newaxis,newaxis]
+    else:
+      PosSumArr, WeightSumArr, CentArr = None, zeros(0, float), None
+    if IterNormalize and NClust > 0:
+      PosSumThis = PosSumArr.copy()
+      WeightSumThis = WeightSumArr.copy()
     #check where to start
     if NewStartInd >= 0: StartInd = NewStartInd
     NewStartInd = -1
@@ -265,39 +359,61 @@ def ClusterMSS(CoordsObj, Cutoff, MaxIter = 3, MaxCluster = None,
         continue
       ThisFrame += 1
       ind = -1  #cluster number assigned to this config; -1 means none
-      #calculate the rmsd between this configuration and each cluster config,
-      #but stop when a rmsd is found which is below the cutoff
+      #calculate the rmsd between this configuration and the cluster
+      #centroids a chunk at a time, but stop at the first chunk with a
+      #rmsd below the cutoff and take the first such cluster
       minRMSD = 1.e300
-      for (i, PosSumi) in enumerate(PosSum):
-        ThisPos = PosSumi / WeightSum[i]
+      for Start in range(0, NClust, ClusterChunk):
+        Stop = min(Start + ClusterChunk, NClust)
         if Method == 0:
-          #rmsd between new config and average cluster config
-          r = RMSD(ThisPos, CurPos, Align = True, Center = True,
-                   CompInd = CompInd, CalcInd = CalcInd)
+          #rmsd between new config and average cluster configs
+          r = RMSDBatch(CurPos, CentArr[Start:Stop], CompInd = CompInd,
+                        CalcInd = CalcInd)
         else:
-          #rmsd between new config and average cluster config, without alignment
-          r = BasicRMSD(ThisPos, CurPos, Ind = CalcInd)
-        minRMSD = min(minRMSD, r)
-        if r < Cutoff:
+          #rmsd between new config and average cluster configs, without alignment
+          d = CentArr[Start:Stop] - CurPos
+          if not CalcInd is None: d = d.take(CalcInd, axis=1)
+          r = sqrt(sum(sum(d*d, axis=2), axis=1) / float(d.shape[1]))
+        minRMSD = min(minRMSD, r.min())
+        Hits = flatnonzero(r < Cutoff)
+        if len(Hits) > 0:
           #go with a cluster if rmsd is within the cutoff
-          ind = i
+          ind = Start + Hits[0]
           break
+      if Method == 0 and NClust > 0:
+        #align the config to its cluster or, as a new cluster, to the last
+        #centroid, the same orientation a one-by-one search would leave
+        j = ind
+        if j < 0: j = NClust - 1
+        RMSD(CentArr[j], CurPos, Align = True, Center = True,
+             CompInd = CompInd, CalcInd = CalcInd)
       if ind >= 0:
         #add the configuration to the cluster
-        PosSum[ind] = PosSum[ind] + CurPos * CurWeight
-        WeightSum[ind] = WeightSum[ind] + CurWeight
-        NAddThis[ind] = NAddThis[ind] + 1
+        PosSumArr[ind] += CurPos * CurWeight
+        WeightSumArr[ind] += CurWeight
+        CentArr[ind] = PosSumArr[ind] / WeightSumArr[ind]
+        NAddThis[ind] += 1
         ClustNum[CurInd] = ind+1
-      elif len(PosSum) < MaxClusterWork or MaxClusterWork is None:
+      elif NClust < MaxClusterWork or MaxClusterWork is None:
         #create a new cluster with this config, as long as it
         #doesn't exceed the maximum number of working clusters
         if minRMSD == 1.e300: minRMSD = 0.
         if Verbose: print "Adding cluster: config %d (%d/%d) | min RMSD %.1f | %d clusters tot" % (CoordsObj.Index+1,
-                          ThisFrame, NFrameTot, minRMSD, len(PosSum)+1)
-        PosSum.append(CurPos * CurWeight)
-        WeightSum.append(CurWeight)
-        NAddThis.append(1)
-        ClustNum[CurInd] = len(PosSum)
+                          ThisFrame, NFrameTot, minRMSD, NClust+1)
+        if PosSumArr is None:
+          PosSumArr = zeros((0,) + CurPos.shape, float)
+          CentArr = zeros((0,) + CurPos.shape, float)
+        if NClust == len(PosSumArr):
+          PosSumArr = __GrowClust(PosSumArr)
+          WeightSumArr = __GrowClust(WeightSumArr)
+          CentArr = __GrowClust(CentArr)
+          NAddThis = __GrowClust(NAddThis)
+        PosSumArr[NClust] = CurPos * CurWeight
+        WeightSumArr[NClust] = CurWeight
+        CentArr[NClust] = CurPos
+        NAddThis[NClust] = 1
+        NClust += 1
+        ClustNum[CurInd] = NClust
         FinalIters = 0
       else:
         #cluster is nothing
@@ -307,12 +423,19 @@ def ClusterMSS(CoordsObj, Cutoff, MaxIter = 3, MaxCluster = None,
           NewStartInd = CurInd
           if Verbose: print "Ran out of clusters. Next iteration starting from config %d" % (CoordsObj.Index+1,)
     #remove contribution to centroids from all but this round
-    if IterNormalize:
-      for i in range(len(PosSumThis)):
-        PosSum[i] = PosSum[i] - PosSumThis[i]
-        WeightSum[i] = WeightSum[i] - WeightSumThis[i]
-    del PosSumThis
-    del WeightSumThis
+    if IterNormalize and len(PosSum) > 0:
+      n = len(PosSumThis)
+      PosSumArr[:n] -= PosSumThis
+      WeightSumArr[:n] -= WeightSumThis
+      del PosSumThis
+      del WeightSumThis
+    if NClust > 0:
+      PosSum = list(PosSumArr[:NClust])
+      WeightSum = list(WeightSumArr[:NClust])
+    NAddThis = list(NAddThis[:NClust])
+    del PosSumArr
+    del WeightSumArr
+    del CentArr
     #loop through clusters
     i = 0
     while i < len(PosSum):
@@ -322,11 +445,9 @@ def ClusterMSS(CoordsObj, Cutoff, MaxIter = 3, MaxCluster = None,
         del PosSum[i]
         del WeightSum[i]
         del NAddThis[i]
-        for (k, cn) in enumerate(ClustNum):
-          if cn > i + 1:
-            ClustNum[k] -= 1
-          elif cn == i + 1:
-            ClustNum[k] = -1
+        Above, This = ClustNum > i + 1, ClustNum == i + 1
+        ClustNum[Above] -= 1
+        ClustNum[This] = -1
         FinalIters = 0
       else:
         i += 1
@@ -365,6 +486,13 @@ def ClusterMSS(CoordsObj, Cutoff, MaxIter = 3, MaxCluster = None,
   return Pos, ClustNum, ClustWeights, ClustPop, ConfRmsd, ClustRmsd
 
 
+def __GrowClust(Arr):
+  "Returns a copy of a cluster array with room for twice as many clusters."
+  New = zeros((max(2*len(Arr), 16),) + Arr.shape[1:], Arr.dtype)
+  New[:len(Arr)] = Arr
+  return New
+
+
 def __SortClust(Pos, ClustNum, Weights, WeightSum, NAddThis, Verbose = True):
   if Verbose: print "Reordering clusters by population"
   Sums = [(sum(Weights[abs(ClustNum) == i+1]), i) for i in range(len(Pos))]
@@ -402,16 +530,11 @@ def __CalcForceClust(CoordsObj, ClustWeights, ClustPop, Pos, ClustNum, Weights,
   if Verbose: print "Forcing %d extraneous configurations to existing clusters" % c
   #find the nearest cluster to each clusterless config and assign it
   CoordsObj.Reset()
+  PosArr = array(Pos, float)
   for (j, CurPos) in enumerate(CoordsObj):
     if ClustNum[j] == 0:
-      ind = -1
-      minr = 0.
-      for (i, Posi) in enumerate(Pos):
-        r = RMSD(Posi, CurPos, Align = False, Center = True,
-                 CompInd = CompInd, CalcInd = CalcInd)
-        if r < minr or ind < 0: 
-          ind = i
-          minr = r
+      r = RMSDBatch(CurPos, PosArr, CompInd = CompInd, CalcInd = CalcInd)
+      ind = argmin(r)
       ClustNum[j] = ind + 1
       ClustWeights[ind] = ClustWeights[ind] + Weights[j]
       ClustPop[ind] = ClustPop[ind] + 1.
@@ -423,12 +546,11 @@ def __CalcRmsd(CoordsObj, Pos, ClustNum,
   if Verbose: print "Calculating cluster rmsd values"
   #calculate the pairwise cluster rmsd values
   ClustRmsd = zeros((len(Pos), len(Pos)),float)
-  for (i, Posi) in enumerate(Pos):
-    for (j, Posj) in enumerate(Pos):
-      if j <= i: continue
-      ClustRmsd[i,j] = RMSD(Posi, Posj, Align=False, Center=True,
-                            CompInd = CompInd, CalcInd = CalcInd)
-      ClustRmsd[j,i] = ClustRmsd[i,j]
+  PosArr = array(Pos, float)
+  for i in range(len(Pos) - 1):
+    ClustRmsd[i,i+1:] = RMSDBatch(PosArr[i], PosArr[i+1:], CompInd = CompInd,
+                                  CalcInd = CalcInd)
+    ClustRmsd[i+1:,i] = ClustRmsd[i,i+1:]
   if Verbose: print "Calculating final rmsd values"
   #loop through configs and find the one with the lowest
   #rmsd in each cluster
@@ -494,6 +616,417 @@ def SaveClustResults(Pos, ClustNum, ClustWeights, ClustPop, ConfRmsd, ClustRmsd,
 
 
 
+#======== PAIRWISE RMSD MATRIX ========
+
+def CondensedIndex(N, i, j):
+  """Returns the position of the pair (i,j), i < j, in the condensed
+upper triangle of an N x N matrix; works on arrays of indices."""
+  return N*i - i*(i+1)//2 + j - i - 1
+
+
+def GetMatrixRow(Mat, N, i):
+  """Returns the distances from frame i to all N frames, taken from a
+condensed matrix."""
+  Row = zeros(N, float)
+  Row[:i] = Mat[CondensedIndex(N, arange(i), i)]
+  Start = CondensedIndex(N, i, i+1)
+  Row[i+1:] = Mat[Start:Start + N - i - 1]
+  return Row
+
+
+def SetMatrixRow(Mat, N, i, Row):
+  "Stores the distances from frame i to all N frames in a condensed matrix."
+  Mat[CondensedIndex(N, arange(i), i)] = Row[:i]
+  Start = CondensedIndex(N, i, i+1)
+  Mat[Start:Start + N - i - 1] = Row[i+1:]
+
+
+def GetMatrixSub(Mat, N, Ind):
+  """Returns the square matrix of distances between the frames Ind,
+taken from a condensed matrix."""
+  Ind = asarray(Ind, int)
+  I, J = Ind[:,newaxis], Ind[newaxis,:]
+  Sub = Mat[CondensedIndex(N, minimum(I, J), maximum(I, J))].astype(float)
+  Sub[I == J] = 0.
+  return Sub
+
+
+def GetMatrixTiles(N, TileSize = RMSDMatrixTile):
+  """Returns a list of (I0, I1, J0, J1) frame ranges that cover the
+upper triangle of an N x N matrix in tiles of TileSize frames a side."""
+  TileSize = max(int(TileSize), 1)
+  Tiles = []
+  for I0 in range(0, N, TileSize):
+    for J0 in range(I0, N, TileSize):
+      Tiles.append((I0, min(I0 + TileSize, N), J0, min(J0 + TileSize, N)))
+  return Tiles
+
+
+def _CalcMatrixTile(MatrixFile, PosFile, Tile, CompInd = None, CalcInd = None,
+                    Centered = False):
+  """Computes one tile of a pairwise rmsd matrix and writes it into the
+condensed matrix file.  Centered positions with no index masks are done
+with a single matrix product for all of the correlation matrices and the
+QCP method.  Returns the tile."""
+  I0, I1, J0, J1 = Tile
+  Pos = load(PosFile, mmap_mode = "r")
+  N, n = Pos.shape[:2]
+  PosI, PosJ = array(Pos[I0:I1]), array(Pos[J0:J1])
+  del Pos
+  a, b = len(PosI), len(PosJ)
+  if Centered and n >= 4:
+    GI = sum(sum(PosI*PosI, axis=2), axis=1)
+    GJ = sum(sum(PosJ*PosJ, axis=2), axis=1)
+    E0 = 0.5 * (GI[:,newaxis] + GJ[newaxis,:]).ravel()
+    C = dot(PosI.transpose((0,2,1)).reshape((a*3, n)),
+            PosJ.transpose((1,0,2)).reshape((n, b*3)))
+    C = C.reshape((a,3,b,3)).transpose((0,2,1,3)).reshape((a*b,3,3))
+    Eig = geometry.QCPMaxEig(E0, C)
+    r = sqrt(maximum(2. * (E0 - Eig), 0.) / n).reshape((a,b))
+  else:
+    r = array([RMSDBatch(PosI[k], PosJ, CompInd, CalcInd) for k in range(a)])
+  #rows of a tile are contiguous runs in the condensed matrix
+  Mat = load(MatrixFile, mmap_mode = "r+")
+  for k in range(a):
+    i = I0 + k
+    j0 = max(J0, i + 1)
+    if j0 >= J1: continue
+    Start = CondensedIndex(N, i, j0)
+    Mat[Start:Start + J1 - j0] = r[k, j0 - J0:]
+  Mat.flush()
+  del Mat
+  return Tile
+
+
+def GetCoordsSource(CoordsObj):
+  """Returns a list of (path, size, mtime) for the files behind a
+coordinates object, followed by its NSkip, NRead, NStride, and Mask."""
+  if hasattr(CoordsObj, "CoordObjList"):
+    return [GetCoordsSource(c) for c in CoordsObj.CoordObjList]
+  Files = []
+  if hasattr(CoordsObj, "PdbFileList"): Files = CoordsObj.PdbFileList
+  for Attr in ["TrjFile", "PrmtopFile"]:
+    if hasattr(CoordsObj, Attr): Files = Files + [getattr(CoordsObj, Attr)]
+  Source = [(os.path.abspath(f), os.path.getsize(f), os.path.getmtime(f))
+            for f in Files if os.path.isfile(f)]
+  for Attr in ["NSkip", "NRead", "NStride", "Mask"]:
+    Source.append(getattr(CoordsObj, Attr, None))
+  return Source
+
+
+def GetMatrixFingerprint(CoordsObj, NAtom, CompInd = None, CalcInd = None):
+  """Returns a hash identifying the frames, atoms, and indices that a
+pairwise rmsd matrix is computed from."""
+  if not CompInd is None: CompInd = [int(i) for i in CompInd]
+  if not CalcInd is None: CalcInd = [int(i) for i in CalcInd]
+  s = repr((GetCoordsSource(CoordsObj), NAtom, CompInd, CalcInd))
+  return hashlib.md5(s).hexdigest()
+
+
+def CalcRMSDMatrix(CoordsObj, MatrixFile, CompInd = None, CalcInd = None,
+                   TileSize = RMSDMatrixTile, NProc = None, Verbose = True):
+  """Computes the rmsd between every pair of configurations into a .npy
+file holding the condensed upper triangle as float32, with the pair
+(i,j), i < j, at CondensedIndex(N, i, j).  Tiles are computed in a pool
+of worker processes and logged as they finish, so that calling again
+after an interruption only computes the missing tiles.  The log header
+records a fingerprint of the source files, trajectory slice, atom count,
+and indices; an existing matrix that does not match it is rebuilt.
+Returns the matrix as a read-only memory map.
+* CoordsObj: coordinates object, as for ClusterMSS
+* MatrixFile: name of the condensed matrix file
+* CompInd: indices in [0,N) for positions in Pos to perform alignment
+* CalcInd: indices in [0,N) for positions in Pos to compute RMSD
+* TileSize: number of frames on a side of each tile
+* NProc: number of worker processes (default is the number of cpus)"""
+  N = len(CoordsObj)
+  LogFile = MatrixFile + RMSDMatrixLogExt
+  PosFile = MatrixFile + RMSDMatrixPosExt
+  Tiles = GetMatrixTiles(N, TileSize)
+  #clean indices against the masked atoms
+  NAtom = 0
+  if N > 0:
+    NAtom = len(CoordsObj.Get(0))
+    CoordsObj.Reset()
+  AllInd = arange(NAtom, dtype = int)
+  if all(CompInd == AllInd): CompInd = None
+  if all(CalcInd == AllInd): CalcInd = None
+  Header = "%d %d %s" % (N, max(int(TileSize), 1),
+                         GetMatrixFingerprint(CoordsObj, NAtom, CompInd, CalcInd))
+  #pick up the completed tiles of a previous run; a last line
+  #without a newline was cut short and does not count
+  Done = set()
+  if os.path.isfile(LogFile) and os.path.isfile(MatrixFile):
+    Lines = file(LogFile, "r").read().split("\n")
+    if Lines[0] == Header:
+      Done = set([int(l) for l in Lines[1:-1]])
+    elif Verbose:
+      print "Rmsd matrix %s is from different coordinates; rebuilding" % MatrixFile
+  if len(Done) == len(Tiles) and Verbose:
+    print "Reusing rmsd matrix %s" % MatrixFile
+  if len(Done) == 0:
+    Mat = open_memmap(MatrixFile, mode = "w+", dtype = float32,
+                      shape = (N*(N-1)//2,))
+    del Mat
+    file(LogFile, "w").write(Header + "\n")
+  Todo = [k for k in range(len(Tiles)) if not k in Done]
+  if len(Todo) > 0:
+    if Verbose: print "Computing %d of %d rmsd matrix tiles" % (len(Todo), len(Tiles))
+    #cache the positions for the workers; with a single set of
+    #indices, only those atoms are kept and they are pre-centered
+    Pos = None
+    CoordsObj.Reset()
+    for (i, CurPos) in enumerate(CoordsObj):
+      if Pos is None:
+        Centered = all(CompInd == CalcInd)
+        if Centered and not CompInd is None:
+          Sel = array(CompInd, int)
+        else:
+          Sel = AllInd
+        Pos = open_memmap(PosFile, mode = "w+", dtype = float,
+                          shape = (N, len(Sel), 3))
+      p = CurPos.take(Sel, axis=0)
+      if Centered: p = p - average(p, axis=0)
+      Pos[i] = p
+    Pos.flush()
+    del Pos
+    if Centered: CompInd, CalcInd = None, None
+    Log = file(LogFile, "a")
+    def LogTile(i, Tile):
+      Log.write("%d\n" % Todo[i])
+      Log.flush()
+      if Verbose and (i+1) % 100 == 0:
+        print "Finished %d of %d tiles" % (i+1, len(Todo))
+    ArgsList = [(MatrixFile, PosFile, Tiles[k], CompInd, CalcInd, Centered)
+                for k in Todo]
+    try:
+      Results, Errors = scripttools.RunTasks(_CalcMatrixTile, ArgsList,
+                                             NProc = NProc, Callback = LogTile)
+    finally:
+      Log.close()
+    if len(Errors) > 0:
+      for (i, Msg) in Errors:
+        sys.stderr.write("Error computing rmsd matrix tile %d:\n%s" % (Todo[i], Msg))
+      raise IOError, "Failed computing %d of %d rmsd matrix tiles; run again to resume." % \
+        (len(Errors), len(Todo))
+    os.remove(PosFile)
+  return load(MatrixFile, mmap_mode = "r")
+
+
+#======== CLUSTERING ON THE RMSD MATRIX ========
+
+def ClusterMedoids(CoordsObj, Mat, NClust, NSample = None, NDraw = MedoidDraws,
+                   MaxIter = 100, Verbose = True):
+  """Clusters conformations around NClust medoid conformations, using
+a precomputed condensed rmsd matrix.  Medoids are found for random
+samples of frames and the set that fits all of the frames best is
+kept (CLARA); each frame belongs to its nearest medoid.  Returns the
+same results as ClusterMSS, with the medoids as cluster structures.
+* CoordsObj: coordinates object the matrix was computed for
+* Mat: condensed rmsd matrix, as from CalcRMSDMatrix
+* NClust: number of clusters
+* NSample: frames per sample (default 40 + 2*NClust); all frames are
+  used at once if this covers them
+* NDraw: number of samples to draw
+* MaxIter: maximum number of medoid updates per sample"""
+  N = len(CoordsObj)
+  K = max(min(int(NClust), N), 1)
+  if NSample is None: NSample = MedoidSampleBase + 2*K
+  NSample = min(max(int(NSample), K), N)
+  if NSample == N: NDraw = 1
+  Best, BestCost, BestRows = None, None, None
+  for Draw in range(NDraw):
+    if NSample == N:
+      Ind = arange(N)
+    else:
+      Ind = array(random.sample(xrange(N), NSample), int)
+      #each sample also holds the best medoids so far
+      if not Best is None: Ind = union1d(Ind, Best)
+    Med = Ind[__KMedoids(GetMatrixSub(Mat, N, Ind), K, MaxIter)]
+    #score the medoids on all of the frames
+    Rows = array([GetMatrixRow(Mat, N, m) for m in Med])
+    Cost = Rows.min(axis=0).sum()
+    if Verbose: print "Medoid sample %d: mean rmsd to medoids %.3f" % (Draw+1, Cost / N)
+    if Best is None or Cost < BestCost:
+      Best, BestCost, BestRows = Med, Cost, Rows
+  Labels = argmin(BestRows, axis=0)
+  del BestRows
+  return __MatrixClustResults(CoordsObj, Mat, Labels, Best, Verbose = Verbose)
+
+
+def GetFreeMemory():
+  "Returns the free physical memory in bytes, or None if unknown."
+  try:
+    return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+  except (ValueError, OSError, AttributeError):
+    return None
+
+
+def ClusterLinkage(CoordsObj, Mat, Cutoff, MaxCluster = None, ScratchFile = None,
+                   Verbose = True):
+  """Clusters conformations by average-linkage hierarchical clustering
+on a precomputed condensed rmsd matrix, merging clusters while their
+average rmsd is below Cutoff.  Returns the same results as ClusterMSS,
+with the medoid of each cluster as its structure.  A float32 working
+copy of the matrix is held in memory or, if it would take more than
+LinkageMemFrac of the free memory, in a scratch file on disk, which is
+much slower.
+* CoordsObj: coordinates object the matrix was computed for
+* Mat: condensed rmsd matrix, as from CalcRMSDMatrix
+* Cutoff: maximum average rmsd between two clusters that are merged
+* MaxCluster: maximum number of clusters; negative values will keep
+  merging past Cutoff until there are no more than this many
+  (default is none)
+* ScratchFile: file for a disk-backed working copy; by default one is
+  only used when memory is short, named after the matrix file"""
+  N = len(CoordsObj)
+  if ScratchFile is None:
+    Free = GetFreeMemory()
+    if not Free is None and 4. * len(Mat) > LinkageMemFrac * Free:
+      if not getattr(Mat, "filename", None):
+        raise MemoryError, "Rmsd matrix of %d frames does not fit in memory." % N
+      ScratchFile = Mat.filename + LinkageScratchExt
+  if Verbose: print "Building average-linkage tree for %d conformations" % N
+  if Verbose and not ScratchFile is None:
+    print "Using disk-backed working matrix %s" % ScratchFile
+  Merges = __AverageLinkage(Mat, N, ScratchFile)
+  #replay the merges in order of distance, with a union-find forest
+  Merges.sort()
+  Parent = arange(N)
+  def Root(i):
+    while not Parent[i] == i:
+      Parent[i] = Parent[Parent[i]]
+      i = Parent[i]
+    return i
+  Force = not MaxCluster is None and MaxCluster < 0
+  NLeft = N
+  for (d, a, b) in Merges:
+    if d >= Cutoff and not (Force and NLeft > abs(MaxCluster)): break
+    Parent[Root(a)] = Root(b)
+    NLeft -= 1
+  Roots = array([Root(i) for i in range(N)], int)
+  Roots, Labels = unique(Roots, return_inverse = True)
+  #the medoid has the least summed rmsd to the rest of its cluster
+  if Verbose: print "Finding medoids of %d clusters" % len(Roots)
+  Medoids = zeros(len(Roots), int)
+  for k in range(len(Roots)):
+    Memb = flatnonzero(Labels == k)
+    if len(Memb) > 1:
+      Sums = [GetMatrixRow(Mat, N, m)[Memb].sum() for m in Memb]
+      Medoids[k] = Memb[argmin(Sums)]
+    else:
+      Medoids[k] = Memb[0]
+  if not MaxCluster is None and MaxCluster > 0:
+    MaxCluster = int(MaxCluster)
+  else:
+    MaxCluster = None
+  return __MatrixClustResults(CoordsObj, Mat, Labels, Medoids,
+                              MaxCluster = MaxCluster, Verbose = Verbose)
+
+
+def __KMedoids(D, K, MaxIter = 100):
+  """Returns the indices of K medoids for the square distance matrix D,
+using a greedy start and alternating assignment/medoid updates."""
+  Med = [argmin(D.sum(axis=1))]
+  Near = D[Med[0]].copy()
+  for k in range(1, K):
+    #add the frame that most reduces the distance to the nearest medoid
+    Gain = maximum(Near[newaxis,:] - D, 0.).sum(axis=1)
+    Gain[Med] = -1.
+    Med.append(argmax(Gain))
+    Near = minimum(Near, D[Med[-1]])
+  Med = array(Med, int)
+  for Iter in range(MaxIter):
+    Labels = argmin(D[Med], axis=0)
+    NewMed = Med.copy()
+    for k in range(K):
+      Memb = flatnonzero(Labels == k)
+      if len(Memb) == 0: continue
+      NewMed[k] = Memb[argmin(D[ix_(Memb, Memb)].sum(axis=1))]
+    if all(NewMed == Med): break
+    Med = NewMed
+  return Med
+
+
+def __AverageLinkage(Mat, N, ScratchFile = None):
+  """Returns the N-1 merges (distance, a, b) of average-linkage clustering
+of a condensed matrix, found with a nearest-neighbor chain; the cluster
+holding frame a is merged into that holding frame b.  The working copy
+of the matrix is a memory map of ScratchFile, if given."""
+  if ScratchFile is None:
+    D = array(Mat, float32)
+    return __NNChain(D, N)
+  D = open_memmap(ScratchFile, mode = "w+", dtype = float32, shape = (len(Mat),))
+  try:
+    for Start in range(0, len(Mat), MatrixCopyChunk):
+      Stop = min(Start + MatrixCopyChunk, len(Mat))
+      D[Start:Stop] = Mat[Start:Stop]
+    return __NNChain(D, N)
+  finally:
+    del D
+    os.remove(ScratchFile)
+
+
+def __NNChain(D, N):
+  "Runs the nearest-neighbor chain on the working condensed matrix D."
+  Size = ones(N, float)
+  Active = ones(N, bool)
+  Merges = []
+  Chain = []
+  while len(Merges) < N - 1:
+    if len(Chain) == 0: Chain.append(flatnonzero(Active)[0])
+    a = Chain[-1]
+    Row = GetMatrixRow(D, N, a)
+    Row[~Active] = inf
+    Row[a] = inf
+    b = argmin(Row)
+    #ties go back down the chain so that it always ends in a merge
+    if len(Chain) > 1 and Row[Chain[-2]] <= Row[b]: b = Chain[-2]
+    if len(Chain) > 1 and b == Chain[-2]:
+      del Chain[-2:]
+      Merges.append((float(Row[b]), a, b))
+      #Lance-Williams update for average linkage
+      New = (Size[a] * Row + Size[b] * GetMatrixRow(D, N, b)) / (Size[a] + Size[b])
+      SetMatrixRow(D, N, b, New)
+      Size[b] += Size[a]
+      Active[a] = False
+    else:
+      Chain.append(b)
+  return Merges
+
+
+def __MatrixClustResults(CoordsObj, Mat, Labels, Medoids, MaxCluster = None,
+                         Verbose = True):
+  """Converts cluster labels in [0,K) (negative for none) and medoid frames
+into the results returned by ClusterMSS, with clusters sorted by
+population and all but the first MaxCluster of them dropped."""
+  N = len(Labels)
+  Medoids = asarray(Medoids, int)
+  Pop = bincount(Labels[Labels >= 0], minlength = len(Medoids))
+  Order = [k for k in argsort(-Pop, kind = "mergesort") if Pop[k] > 0]
+  if not MaxCluster is None: Order = Order[:MaxCluster]
+  Trans = zeros(len(Medoids), int)
+  Trans[Order] = arange(len(Order)) + 1
+  ClustNum = zeros(N, int)
+  Used = Labels >= 0
+  ClustNum[Used] = Trans[Labels[Used]]
+  Medoids = Medoids[Order]
+  if Verbose: print "Calculating final rmsd values"
+  ConfRmsd = -1. * ones(N, float)
+  ClustRmsd = zeros((len(Medoids), len(Medoids)), float)
+  for (k, m) in enumerate(Medoids):
+    Row = GetMatrixRow(Mat, N, m)
+    Memb = ClustNum == k + 1
+    ConfRmsd[Memb] = Row[Memb]
+    ClustRmsd[k] = Row[Medoids]
+  ClustNum[Medoids] = -ClustNum[Medoids]
+  ClustPop = array(Pop[Order], float)
+  ClustWeights = ClustPop.copy()
+  Pos = [CoordsObj.Get(m, coords.NoMask) for m in Medoids]
+  if Verbose: print "%d configurations sorted into %d clusters" % (sum(ClustNum != 0), len(Pos))
+  return Pos, ClustNum, ClustWeights, ClustPop, ConfRmsd, ClustRmsd
+
+
 #======== COMMAND-LINE RUNNING ========
 
 def GetResList(Arg):
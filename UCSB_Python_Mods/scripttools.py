@@ -2,7 +2,7 @@
 
 #LAST MODIFIED: 01-13-09
 
-import sys, os, glob, time
+import sys, os, glob, time, traceback, multiprocessing
 
 
 def ExpandArgs(Args, NTOnly = False):
@@ -148,3 +148,60 @@ class ProgressBar(object):
         n = len(self.Text) + self.BarLen + 11
         sys.stdout.write(" "*n + "\r")
         sys.stdout.flush()
+
+
+def _RunTask(Task):
+  """Runs one (Func, Args, KwArgs) task in a worker process.
+Returns (True, result) or (False, formatted traceback)."""
+  Func, Args, KwArgs = Task
+  try:
+    return True, Func(*Args, **KwArgs)
+  except Exception:
+    return False, traceback.format_exc()
+
+def RunTasks(Func, ArgsList, KwArgsList = None, NProc = None, Verbose = False,
+             Callback = None):
+  """Runs Func(*Args, **KwArgs) for each task in a pool of worker processes.
+Results are collected in task order and a failure in one task does not
+stop the others.  With one process the tasks run in this process and an
+exception propagates unchanged, as in a plain loop.  Returns Results, Errors.
+* Func: module-level (picklable) function to call
+* ArgsList: list of argument tuples, one per task
+* KwArgsList: list of keyword dictionaries, or a single dictionary for all
+* NProc: number of worker processes (default is the number of cpus);
+         1 runs the tasks in this process
+* Verbose: boolean, report each task as it finishes?
+* Callback: function called here as Callback(i, result) as each task succeeds
+* Results: list of return values, None for tasks that failed
+* Errors: list of (task index, traceback string) for tasks that failed
+  (always empty with one process)"""
+  N = len(ArgsList)
+  if KwArgsList is None: KwArgsList = {}
+  if type(KwArgsList) is dict: KwArgsList = [KwArgsList] * N
+  Tasks = [(Func, tuple(Args), KwArgs) for (Args, KwArgs) in zip(ArgsList, KwArgsList)]
+  if NProc is None: NProc = multiprocessing.cpu_count()
+  NProc = max(1, min(NProc, N))
+  if NProc == 1:
+    Pool = None
+    Iter = ((True, Func(*Args, **KwArgs)) for (Func, Args, KwArgs) in Tasks)
+  else:
+    Pool = multiprocessing.Pool(NProc)
+    Iter = Pool.imap(_RunTask, Tasks, 1)
+  Results, Errors = [], []
+  try:
+    for (i, (Success, Val)) in enumerate(Iter):
+      if Success:
+        Results.append(Val)
+        if not Callback is None: Callback(i, Val)
+        if Verbose: print "Finished task %d of %d" % (i+1, N)
+      else:
+        Results.append(None)
+        Errors.append((i, Val))
+        if Verbose: print "Task %d of %d failed" % (i+1, N)
+  except:
+    if not Pool is None: Pool.terminate()
+    raise
+  if not Pool is None:
+    Pool.close()
+    Pool.join()
+  return Results, Errors
@@ -4,10 +4,20 @@
 This program will take a list of REMD trajectory files and temperatures and it
 will extract temperature-specific trajectories from those trajectory files for
 each temperature provided.
+
+By default every replica trajectory is read exactly once: frames are read in
+chunks from all replicas in lockstep and routed to a writer for each requested
+temperature (optionally RMS-fit on the way), so the cost is proportional to the
+total number of frames rather than frames x temperatures. The temperature of
+each frame comes from the temp0 variable of the NetCDF trajectories or, if
+--remlog is given, from the replica exchange log (trajectories must then be
+listed in replica order). --cpptraj runs the original one-pass-per-temperature
+cpptraj extraction instead.
 """
 from optparse import OptionParser, OptionGroup
 from subprocess import Popen, PIPE
-import sys, time
+import sys, os, time
+import numpy as np
 
 start_time = time.time()
 
@@ -27,12 +37,196 @@ def which(program):
             return exe_file
    return None
 
+#~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~
+
+def open_netcdf(fname, mode='r'):
+   """ Opens a NetCDF file with netCDF4 if present, else ScientificPython """
+   try:
+      from netCDF4 import Dataset
+      return Dataset(fname, mode)
+   except ImportError:
+      from Scientific.IO.NetCDF import NetCDFFile
+      return NetCDFFile(fname, mode)
+
+def read_ref_coords(fname):
+   """ Reads coordinates from an Amber restart/inpcrd or a PDB file """
+   lines = open(fname, 'r').readlines()
+   if fname.endswith('.pdb') or fname.endswith('.ent'):
+      return np.array([[float(l[30:38]), float(l[38:46]), float(l[46:54])]
+                       for l in lines if l[:6] in ('ATOM  ', 'HETATM')])
+   natom = int(lines[1].split()[0])
+   text = ''.join([l.rstrip('\r\n') for l in lines[2:]])
+   vals = [float(text[i:i+12]) for i in range(0, 36 * natom, 12)]
+   return np.array(vals).reshape((natom, 3))
+
+def kabsch_fit(pos, ref, sel):
+   """ Fits each frame in pos (nframe x natom x 3) onto ref over the atoms in
+       sel, in place, and returns the RMSD of the selection """
+   refsel = ref[sel] - ref[sel].mean(axis=0)
+   rmsd = np.zeros(len(pos))
+   for i, frame in enumerate(pos):
+      cen = frame[sel].mean(axis=0)
+      x = frame[sel] - cen
+      v, s, w = np.linalg.svd(np.dot(x.T, refsel))
+      if np.linalg.det(v) * np.linalg.det(w) < 0:
+         s[-1] = -s[-1]
+         v[:,-1] = -v[:,-1]
+      rot = np.dot(v, w)
+      frame[:] = np.dot(frame - cen, rot) + ref[sel].mean(axis=0)
+      rmsd[i] = np.sqrt(((np.dot(x, rot) - refsel)**2).sum(axis=1).mean())
+   return rmsd
+
+class TempTrajWriter(object):
+   """ Appends the frames for one temperature to an Amber NetCDF trajectory """
+
+   def __init__(self, fname, temp, natom, has_box, rmsfile=None):
+      self.temp = temp
+      self.nframe = 0
+      self.ncfile = open_netcdf(fname, 'w')
+      nc = self.ncfile
+      nc.Conventions = 'AMBER'
+      nc.ConventionVersion = '1.0'
+      nc.program = os.path.split(sys.argv[0])[1]
+      nc.programVersion = '1.0'
+      nc.title = 'Frames at %f K' % temp
+      nc.createDimension('frame', None)
+      nc.createDimension('spatial', 3)
+      nc.createDimension('atom', natom)
+      v = nc.createVariable('spatial', 'c', ('spatial',))
+      v[:] = np.array(list('xyz'), 'c')
+      v = nc.createVariable('time', 'f', ('frame',))
+      v.units = 'picosecond'
+      v = nc.createVariable('coordinates', 'f', ('frame', 'atom', 'spatial'))
+      v.units = 'angstrom'
+      v = nc.createVariable('temp0', 'd', ('frame',))
+      v.units = 'kelvin'
+      self.has_box = has_box
+      if has_box:
+         nc.createDimension('cell_spatial', 3)
+         nc.createDimension('cell_angular', 3)
+         nc.createDimension('label', 5)
+         v = nc.createVariable('cell_spatial', 'c', ('cell_spatial',))
+         v[:] = np.array(list('abc'), 'c')
+         v = nc.createVariable('cell_angular', 'c', ('cell_angular', 'label'))
+         v[:] = np.array([list('alpha'), list('beta '), list('gamma')], 'c')
+         v = nc.createVariable('cell_lengths', 'd', ('frame', 'cell_spatial'))
+         v.units = 'angstrom'
+         v = nc.createVariable('cell_angles', 'd', ('frame', 'cell_angular'))
+         v.units = 'degree'
+      self.rmsfile = rmsfile
+      if rmsfile is not None:
+         self.rmsfile = open(rmsfile, 'w')
+         self.rmsfile.write('#Frame     RMSD_00000\n')
+
+   def write(self, crds, times, box=None, rmsd=None):
+      """ Appends a block of frames with their times (and box, rmsd) """
+      n = len(crds)
+      if not n: return
+      start, stop = self.nframe, self.nframe + n
+      nc = self.ncfile
+      nc.variables['coordinates'][start:stop] = crds.astype(np.float32)
+      nc.variables['time'][start:stop] = times.astype(np.float32)
+      nc.variables['temp0'][start:stop] = np.zeros(n) + self.temp
+      if self.has_box:
+         nc.variables['cell_lengths'][start:stop] = box[0]
+         nc.variables['cell_angles'][start:stop] = box[1]
+      if self.rmsfile is not None and rmsd is not None:
+         self.rmsfile.write(''.join(['%8d %12.4f\n' % (start + i + 1, r)
+                                     for i, r in enumerate(rmsd)]))
+      self.nframe = stop
+
+   def close(self):
+      self.ncfile.close()
+      if self.rmsfile is not None: self.rmsfile.close()
+
+def remlog_temps(remlog, rep, nframe):
+   """ Temperature of each of nframe frames of a replica, from the rem.log.
+       Frame k was written during exchange ((k+1)*numexchg-1)/nframe """
+   exchg = ((np.arange(nframe) + 1) * remlog.numexchg - 1) // nframe
+   return remlog.reps[rep].old_temp[exchg]
+
+def demux(trajs, temps, prefix, natom, chunk=100, remlog=None, ref=None,
+          sel=None, rmsout=None, tol=0.01):
+   """ Reads every trajectory once, in lockstep chunks of frames, and routes
+       each frame to the writer for its temperature. Frames for a given
+       temperature are written in frame order. Returns the frame counts """
+   ncs = [open_netcdf(t) for t in trajs]
+   for nc, t in zip(ncs, trajs):
+      if len(nc.variables['coordinates'][0]) != natom:
+         raise ValueError('%s does not have %d atoms!' % (t, natom))
+   nframes = [len(nc.variables['coordinates']) for nc in ncs]
+   frame_temps = []
+   for i, (nc, t) in enumerate(zip(ncs, trajs)):
+      if remlog is not None:
+         frame_temps.append(remlog_temps(remlog, i, nframes[i]))
+      elif 'temp0' in nc.variables:
+         frame_temps.append(np.asarray(nc.variables['temp0'][:], float))
+      else:
+         raise ValueError('%s has no temp0 variable; use --remlog' % t)
+   has_box = min(['cell_lengths' in nc.variables for nc in ncs])
+   writers = []
+   for temp in temps:
+      rmsfile = None
+      if ref is not None: rmsfile = '%s_%s.dat' % (rmsout, temp)
+      writers.append(TempTrajWriter('%s.%f.nc' % (prefix, temp), temp, natom,
+                                    has_box, rmsfile))
+   temps = np.array(temps)
+   for start in range(0, max(nframes), chunk):
+      # Read this chunk of every replica and tag each frame with its slot in
+      # the temperature list (-1 if not wanted)
+      frames, slots = [], []
+      for nc, ftemps, n in zip(ncs, frame_temps, nframes):
+         stop = min(start + chunk, n)
+         if stop <= start: continue
+         diff = np.abs(ftemps[start:stop, np.newaxis] - temps[np.newaxis,:])
+         slot = np.where(diff.min(axis=1) < tol, diff.argmin(axis=1), -1)
+         if not (slot >= 0).any(): continue
+         crds = np.asarray(nc.variables['coordinates'][start:stop])
+         times = np.asarray(nc.variables['time'][start:stop])
+         if has_box:
+            box = (np.asarray(nc.variables['cell_lengths'][start:stop]),
+                   np.asarray(nc.variables['cell_angles'][start:stop]))
+         for k in np.flatnonzero(slot >= 0):
+            frames.append((start + k, slot[k], crds[k], times[k],
+                           has_box and (box[0][k], box[1][k]) or None))
+      frames.sort(key=lambda f: f[0])
+      for j, writer in enumerate(writers):
+         mine = [f for f in frames if f[1] == j]
+         if not mine: continue
+         crds = np.array([f[2] for f in mine], float)
+         times = np.array([f[3] for f in mine])
+         box, rmsd = None, None
+         if has_box:
+            box = (np.array([f[4][0] for f in mine]),
+                   np.array([f[4][1] for f in mine]))
+         if ref is not None:
+            rmsd = kabsch_fit(crds, ref, sel)
+         writer.write(crds, times, box, rmsd)
+   for nc in ncs: nc.close()
+   counts = []
+   for writer in writers:
+      writer.close()
+      counts.append(writer.nframe)
+   return counts
+
+#~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~
+
 parser = OptionParser('usage: %prog [Options] mdcrd1 [mdcrd2 [mdcrd3 ...] ]')
 parser.add_option('--temperatures', dest='temp_list', help='Comma-separated ' +
                   'list of temperatures to extract trajectories for')
 parser.add_option('--prefix', dest='prefix', help='Prefix for trajectory ' +
                   'file names. They will be named PREFIX.temp.nc')
 parser.add_option('--prmtop', dest='prmtop', help='Prmtop for your system')
+parser.add_option('--remlog', dest='remlog', metavar='FILE', default=None,
+                  help='Replica exchange log to map frames to temperatures. ' +
+                  'Trajectories must be given in replica order. Default ' +
+                  'is to use the temp0 variable in the trajectories')
+parser.add_option('--chunk', dest='chunk', metavar='INT', type='int',
+                  default=100, help='Frames read from each replica at a ' +
+                  'time. Default %default')
+parser.add_option('--cpptraj', dest='cpptraj', action='store_true',
+                  default=False, help='Run one cpptraj pass per temperature ' +
+                  'instead of demultiplexing all temperatures in one pass')
 group = OptionGroup(parser, 'RMSd Options', 'If a REFSTRUCT is specified, ' +
                     'these options will be used to RMS fit a structure')
 group.add_option('--rmsd', dest='refstruct', help='Reference structure for ' +
@@ -49,12 +243,45 @@ if not opt.temp_list or not opt.prefix or not opt.prmtop or not trajs:
    parser.print_help()
    sys.exit(1)
 
+temps = opt.temp_list.split(',')
+
+if not opt.cpptraj:
+   from chemistry.amber.readparm import AmberParm
+   parm = AmberParm(opt.prmtop)
+   natom = parm.ptr('natom')
+   ref, sel = None, None
+   if opt.refstruct:
+      from chemistry.amber.mask import AmberMask
+      ref = read_ref_coords(opt.refstruct)
+      if len(ref) != natom:
+         print 'Error: %s has %d atoms but %s has %d atoms!' % (
+               opt.refstruct, len(ref), opt.prmtop, natom)
+         sys.exit(1)
+      sel = np.flatnonzero(AmberMask(parm, opt.rmsmask).Selection())
+   remlog = None
+   if opt.remlog:
+      from remd import TempRemLog
+      remlog = TempRemLog(opt.remlog)
+      if len(remlog.reps) != len(trajs):
+         print 'Error: %s has %d replicas but %d trajectories were given!' % (
+               opt.remlog, len(remlog.reps), len(trajs))
+         sys.exit(1)
+   wanted = []
+   for temp in temps:
+      try: wanted.append(float(temp))
+      except ValueError: continue
+   temps = wanted
+   counts = demux(trajs, temps, opt.prefix, natom, opt.chunk, remlog, ref,
+                  sel, opt.rmsout)
+   for temp, count in zip(temps, counts):
+      print 'Wrote %d frames to %s.%f.nc' % (count, opt.prefix, temp)
+   print '\n\nThis took %f min.' % ((time.time() - start_time) / 60)
+   sys.exit(0)
+
 cpptraj = which('cpptraj')
 
 assert(cpptraj)
 
-temps = opt.temp_list.split(',')
-
 for temp in temps:
    try: temp=float(temp)
    except ValueError: continue
@@ -23,6 +23,7 @@ Boston, MA 02111-1307, USA.
 """ 
 
 import sys, os
+import numpy
 
 #~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+#
 
@@ -78,6 +79,56 @@ class AmberRestart(file):
       # Add a new line after every even velocity
       if not self.vel_num % 2: self.write(os.linesep)
 
+   def _format_block(self, vals):
+      """ Formats an natom x 3 block as 2 triplets per line in one pass """
+      vals = numpy.asarray(vals, dtype=float).ravel()
+      nline, rem = divmod(len(vals), 6)
+      key = len(vals)
+      if not hasattr(self, 'block_fmts'): self.block_fmts = {}
+      if not key in self.block_fmts:
+         fmt = ('%12.7F' * 6 + os.linesep) * nline
+         if rem: fmt += '%12.7F' * rem + os.linesep
+         self.block_fmts[key] = fmt
+      return self.block_fmts[key] % tuple(vals.tolist())
+
+   def write_coordinates(self, crds):
+      """ Writes out all natom coordinates at once, 2 per line. A last line
+          with a single coordinate is terminated too, so the velocities
+          start on a new line
+      """
+      if not hasattr(self, 'title_written'):
+         raise RestartError('Write the title before writing coordinates!')
+      if not hasattr(self, 'header_written'):
+         raise RestartError('Write the header before writing coordinates!')
+      if hasattr(self, 'crd_num') and self.crd_num:
+         raise RestartError('Coordinates already partially written!')
+      crds = numpy.asarray(crds, dtype=float).reshape((-1,3))
+      if len(crds) != self.natom:
+         raise RestartError('Expected %d coordinates, got %d!' %
+                            (self.natom, len(crds)))
+      self.write(self._format_block(crds))
+      self.crd_num = len(crds)
+
+   def write_velocities(self, vels):
+      """ Writes out all natom velocities at once, 2 per line. A last line
+          with a single velocity is terminated too, so the box starts on a
+          new line
+      """
+      if not hasattr(self, 'title_written'):
+         raise RestartError('Write the title before writing velocities!')
+      if not hasattr(self, 'header_written'):
+         raise RestartError('Write the header before writing velocities!')
+      if not hasattr(self, 'crd_num') or self.crd_num != self.natom:
+         raise RestartError('Write all coordinates before writing velocities!')
+      if hasattr(self, 'vel_num') and self.vel_num:
+         raise RestartError('Velocities already partially written!')
+      vels = numpy.asarray(vels, dtype=float).reshape((-1,3))
+      if len(vels) != self.natom:
+         raise RestartError('Expected %d velocities, got %d!' %
+                            (self.natom, len(vels)))
+      self.write(self._format_block(vels))
+      self.vel_num = len(vels)
+
    def write_box_info(self, a, b, c, alpha=None, beta=None, gamma=None):
       """ Writes out the box information """
       if not hasattr(self, 'title_written'):
@@ -98,7 +149,6 @@ class AmberRestart(file):
 #~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+#
 
 def main():
-   import numpy
    from optparse import OptionParser, OptionGroup
    from Scientific.IO.NetCDF import NetCDFFile
    """ The main function """
@@ -189,10 +239,7 @@ files and preserve any velocity information that may be present."""
       rst_file.write_header(natom=traj.dimensions['atom'],
                             time=traj.variables['time'][idx])
       # Now write the coordinates
-      for it in range(traj.dimensions['atom']):
-         rst_file.write_coordinate(traj.variables['coordinates'][idx][it][0],
-                                   traj.variables['coordinates'][idx][it][1],
-                                   traj.variables['coordinates'][idx][it][2])
+      rst_file.write_coordinates(traj.variables['coordinates'][idx])
       # Now write the velocities
       if 'velocities' in traj.variables.keys():
          vels = traj.variables['velocities'][idx]
@@ -202,8 +249,7 @@ files and preserve any velocity information that may be present."""
          vels = numpy.zeros((traj.dimensions['atom'],3))
 
       # Now write the velocities
-      for it in range(traj.dimensions['atom']):
-         rst_file.write_velocity(vels[it][0], vels[it][1], vels[it][2])
+      rst_file.write_velocities(vels)
 
       # Now write the box information if it's present
       if 'cell_lengths' in traj.variables.keys():
@@ -214,7 +260,7 @@ files and preserve any velocity information that may be present."""
          if 'cell_angles' in traj.variables.keys():
             alpha = traj.variables['cell_angles'][idx][0]
             beta = traj.variables['cell_angles'][idx][1]
-            alpha = traj.variables['cell_angles'][idx][2]
+            gamma = traj.variables['cell_angles'][idx][2]
          rst_file.write_box_info(a, b, c, alpha, beta, gamma)
       
       # Now we're done with our restart file -- close it
@@ -245,11 +291,7 @@ files and preserve any velocity information that may be present."""
       rst_file.write_header(natom=traj.dimensions['atom'],
                             time=traj.variables['time'][idx])
       # Now write the coordinates
-      for it in range(traj.dimensions['atom']):
-         rst_file.write_coordinate(traj.variables['coordinates'][idx][it][0],
-                                   traj.variables['coordinates'][idx][it][1],
-                                   traj.variables['coordinates'][idx][it][2])
-      if traj.dimensions['atom'] % 2 != 0: rst_file.write('\n')
+      rst_file.write_coordinates(traj.variables['coordinates'][idx])
       # Now write the velocities
       if 'velocities' in traj.variables.keys():
          vels = traj.variables['velocities'][idx]
@@ -257,9 +299,7 @@ files and preserve any velocity information that may be present."""
          vels = numpy.zeros((traj.dimensions['atom'],3))
 
       # Now write the velocities
-      for it in range(traj.dimensions['atom']):
-         rst_file.write_velocity(vels[it][0], vels[it][1], vels[it][2])
-      if traj.dimensions['atom'] % 2 != 0: rst_file.write('\n')
+      rst_file.write_velocities(vels)
 
       # Now write the box information if it's present
       if 'cell_lengths' in traj.variables.keys():
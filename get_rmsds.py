@@ -36,7 +36,7 @@ trajs.rmsd(mask=opt.mask, outfile=opt.rmsfile, ref=opt.reffile)
 trajs.run()
 
 if opt.rmsbin:
-   process = Popen([binner, '-f', opt.rmsfile, '-o', opt.rmsbin, '-n', '-c', 2])
+   process = Popen([binner, '-f', opt.rmsfile, '-o', opt.rmsbin, '-n', '-c', '2'])
    if process.wait():
       print >> sys.stderr, 'Error: Binning program (%s) failed!' % binner
       sys.exit(1)
@@ -5,8 +5,16 @@ generating useful data sets for analyzing them.
 
 import numpy as np
 from subprocess import Popen, PIPE
+from cStringIO import StringIO
 from utilities import which
-import re, sys, os
+import re, sys, os, struct, shutil, tempfile, threading
+
+# Frame counts of trajectory files, keyed by (absolute path, mtime, size), so
+# each file is only examined once per process
+_frame_counts = {}
+
+# Atom counts of topology files, keyed the same way
+_atom_counts = {}
 
 #~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~
 
@@ -22,6 +30,179 @@ class RMSError(Exception): pass
 
 #~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~
 
+def _file_key(fname):
+   " Returns the key for a file in the frame and atom count caches "
+   st = os.stat(fname)
+   return (os.path.abspath(fname), st.st_mtime, st.st_size)
+
+#~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~
+
+def parm_natom(parm):
+   """ Returns the number of atoms in a topology file from the first entry of
+       its POINTERS section, or None if it cannot be found
+   """
+   key = _file_key(parm)
+   if key in _atom_counts: return _atom_counts[key]
+   natom = None
+   fl = open(parm, 'r')
+   for line in fl:
+      if line.startswith('%FLAG POINTERS'):
+         for line in fl:
+            if line.startswith('%'): continue
+            natom = int(line[:8])
+            break
+         break
+   fl.close()
+   _atom_counts[key] = natom
+   return natom
+
+#~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~
+
+def _netcdf_frames(fname):
+   """ Returns the number of frames in a NetCDF (classic or 64-bit offset)
+       trajectory from the record count in its header, or None if the file is
+       not one or the count is not filled in
+   """
+   fl = open(fname, 'rb')
+   head = fl.read(8)
+   fl.close()
+   if len(head) < 8 or head[:3] != 'CDF' or head[3] not in '\x01\x02':
+      return None
+   nframes = struct.unpack('>i', head[4:8])[0]
+   # Streaming files have a record count of -1
+   if nframes < 0: return None
+   return nframes
+
+#~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~
+
+def _ascii_frames(fname, natom):
+   """ Returns the number of frames in an ASCII trajectory (with or without box
+       lines) from the file size, or None if the file does not have the
+       standard layout of 10 8-character fields per line
+   """
+   nfields = 3 * natom
+   nlines = nfields // 10 + int(nfields % 10 > 0)
+   frame_bytes = 8 * nfields + nlines
+   fl = open(fname, 'rb')
+   head = len(fl.readline())
+   # Look at the line after the first frame to see if there is a box
+   fl.seek(head + frame_bytes)
+   line = fl.readline()
+   fl.close()
+   if nfields > 3 and len(line.rstrip('\n')) == 24:
+      frame_bytes += 25
+   nbytes = os.path.getsize(fname) - head
+   if nbytes % frame_bytes: return None
+   return nbytes // frame_bytes
+
+#~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~
+
+def count_frames(fname, parm):
+   """ Returns the number of frames in a trajectory file without running
+       cpptraj, or None for formats that cannot be counted here (e.g. gzipped
+       or NetCDF4 files). Results are cached by file path and mtime
+   """
+   key = _file_key(fname)
+   if key in _frame_counts: return _frame_counts[key]
+   nframes = _netcdf_frames(fname)
+   if nframes is None and not fname.endswith(('.gz', '.bz2', '.zip')):
+      fl = open(fname, 'rb')
+      magic = fl.read(4)
+      fl.close()
+      # Skip binary formats we do not know
+      if magic[:3] != 'CDF' and magic[1:4] != 'HDF':
+         natom = parm_natom(parm)
+         if natom: nframes = _ascii_frames(fname, natom)
+   if nframes is not None:
+      _frame_counts[key] = nframes
+   return nframes
+
+#~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~
+
+def parse_data(text):
+   """ Parses the text of a cpptraj/ptraj data file. Returns the list of
+       column names from the '#' header line and a 2-D array of the data
+       (frame numbers in the first column). Other lines starting with '#' or
+       '@' are skipped, and all the numbers are parsed in one pass by numpy
+   """
+   names = []
+   body = text
+   # The column names are on the first '#' line of the leading comments
+   while body[:1] in ('#', '@'):
+      head, body = (body.split('\n', 1) + [''])[:2]
+      if head.startswith('#') and not names:
+         names = head[1:].split()
+   if '#' in body or '@' in body:
+      body = '\n'.join([line for line in body.split('\n')
+                        if line.lstrip()[:1] not in ('#', '@')])
+   first = body.lstrip().split('\n', 1)[0].split()
+   ncols = len(first) or max(len(names), 1)
+   data = np.fromstring(body, sep=' ')
+   if data.size % ncols:
+      raise TrajError('Ragged cpptraj data; expected %d columns' % ncols)
+   return names, data.reshape((-1, ncols))
+
+#~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~
+
+def load_data(fname, cols=None, structured=False):
+   """ Loads the columns of a cpptraj/ptraj data file in one pass. Returns a
+       dict mapping column names (from the '#' header, or col0, col1, ...) to
+       arrays, or a numpy structured array if structured is True.
+         cols: list of column indices or names to keep (column 0 is the frame
+               number); default is all of them
+   """
+   if not os.path.exists(fname):
+      raise RMSError('load_data: Non-existent file %s' % fname)
+   names, data = parse_data(open(fname, 'r').read())
+   # Fall back on generic names if the header does not match the data
+   if len(names) != data.shape[1] or len(set(names)) != len(names):
+      names = ['col%d' % i for i in range(data.shape[1])]
+   if cols is None:
+      cols = range(data.shape[1])
+   cols = [names.index(c) if isinstance(c, str) else c for c in cols]
+   if structured:
+      ret = np.empty(data.shape[0], dtype=[(names[c], float) for c in cols])
+      for c in cols:
+         ret[names[c]] = data[:,c]
+      return ret
+   return dict([(names[c], data[:,c]) for c in cols])
+
+#~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~
+
+class _FifoReader(threading.Thread):
+   " Reads everything written to a named pipe in the background "
+
+   def __init__(self, path):
+      threading.Thread.__init__(self)
+      self.daemon = True
+      self.path = path
+      self.text = ''
+      # Whether the writer opened the pipe, so that an empty data set can be
+      # told apart from a data file that was never written
+      self.opened = False
+      self._releasing = False
+
+   def run(self):
+      fl = open(self.path, 'r')
+      self.opened = not self._releasing
+      self.text = fl.read()
+      fl.close()
+
+   def release(self):
+      """ Once the writer has exited, unblocks a reader still waiting to open
+          the pipe (i.e. the writer never opened it) and waits for it
+      """
+      self._releasing = True
+      while self.is_alive():
+         try:
+            os.close(os.open(self.path, os.O_WRONLY | os.O_NONBLOCK))
+         except OSError:
+            # No reader has the pipe open yet
+            pass
+         self.join(0.05)
+
+#~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~
+
 class AmberTraj(object):
    " This is a class to analyze trajectory files (a series of them, or just 1) "
    
@@ -77,6 +258,21 @@ class AmberTraj(object):
       # Start keeping track of the commands we want to run
       self._cpptraj_commands = ''
 
+      # Data files written by the commands, which parallel runs must merge
+      self._outfiles = []
+
+      # Whether any command refers to the first frame, which parallel runs
+      # must load as an explicit reference
+      self._uses_first = False
+
+      # Data sets to return in memory rather than write to files, mapping the
+      # placeholder file name in the commands to the data set name
+      self._captures = {}
+
+      # Captured data sets from the last run, as numpy arrays of the values
+      # (one column of data) or of all columns (more than one) by set name
+      self.data = {}
+
    #===================================================
 
    def add_trajectory(self, name, start=1, stride=1, end=99999999):
@@ -104,6 +300,12 @@ class AmberTraj(object):
       for traj in self.traj_list:
          # Skip over any frames we've already determined
          if self.traj_list[traj] != -1: continue
+         # Count the frames ourselves if we can read this format
+         if os.path.exists(traj):
+            nframes = count_frames(traj, self.parm)
+            if nframes is not None:
+               self.traj_list[traj] = nframes
+               continue
          # Now launch a subprocess where we just trajin the file and parse
          # the output to find out how many frames are present
          process = Popen([self.cpptraj, self.parm], stdin=PIPE, stdout=PIPE,
@@ -121,11 +323,16 @@ class AmberTraj(object):
                             (traj, out, err))
          # Otherwise, we got our number of frames
          self.traj_list[traj] = int(nframes.groups()[0])
+         if os.path.exists(traj):
+            _frame_counts[_file_key(traj)] = self.traj_list[traj]
 
    #===================================================
 
-   def rmsd(self, setname='rmsd', mask=':*', ref=None, outfile=None, fit=True):
-      """ Calculates the RMSD value for all of the trajectories """
+   def rmsd(self, setname='rmsd', mask=':*', ref=None, outfile=None, fit=True,
+            capture=False):
+      """ Calculates the RMSD value for all of the trajectories. If capture is
+          True, the values are put in self.data[setname] by run()
+      """
       # Make sure we aren't overwriting something:
       if outfile and os.path.exists(outfile) and not self.overwrite:
          raise TrajError('Cannot overwrite %s' % outfile)
@@ -141,33 +348,226 @@ class AmberTraj(object):
          self._cpptraj_commands += 'reference ref %s ' % ref
       else:
          self._cpptraj_commands += 'first '
+         self._uses_first = True
 
       # Dump to a file?
       if outfile:
          self._cpptraj_commands += 'out %s ' % outfile
+         self._outfiles.append(outfile)
+      elif capture:
+         self._cpptraj_commands += 'out %s ' % self._capture_name(setname)
+
+      # Also load the file once it is written
+      if outfile and capture:
+         self._captures[outfile] = setname
 
       # Terminate the command
       self._cpptraj_commands += '\n'
 
    #===================================================
 
-   def run(self):
-      """ This runs cpptraj with the given commands """
+   def _capture_name(self, setname):
+      " Returns a placeholder file name for a data set that is captured "
+      name = '_ambertraj_capture%d.dat' % len(self._captures)
+      self._captures[name] = setname
+      return name
+
+   #===================================================
+
+   def _store(self, setname, text):
+      " Parses the text of a captured data file into self.data "
+      names, data = parse_data(text)
+      # An empty data file holds an empty data set
+      if data.shape[1] < 2:
+         self.data[setname] = np.zeros(0)
+         return
+      if data.shape[1] == 2:
+         self.data[setname] = data[:,1]
+      else:
+         self.data[setname] = data[:,1:]
+
+   #===================================================
+
+   def run(self, nproc=1):
+      """ This runs cpptraj with the given commands. With nproc > 1, the frames
+          are split into nproc contiguous windows that are run concurrently,
+          and the data files are merged afterwards
+      """
       # adjust the ends to be either the highest frame # or the value of end
       self.end = [min(self.end[i], self.traj_list[j]) 
                   for i,j in enumerate(self.traj_name_list)]
+      if nproc > 1:
+         return self._run_parallel(nproc)
       cmd_str = ''
       for i, traj in enumerate(self.traj_name_list):
          cmd_str += 'trajin %s %d %d %d \n' % (traj, self.start[i], self.end[i],
                                                self.stride[i])
       
+      # Captured data sets are streamed through named pipes. A pipe can only
+      # be read once, so a data file named more than once in the commands
+      # (which cpptraj may open more than once) goes to a temporary file
+      commands = self._cpptraj_commands
+      readers = {}
+      tmpdir = None
+      for name in self._captures:
+         if name in self._outfiles: continue
+         if tmpdir is None: tmpdir = tempfile.mkdtemp(prefix='ambertraj')
+         path = os.path.join(tmpdir, name)
+         if commands.count(name) == 1:
+            os.mkfifo(path)
+            readers[name] = _FifoReader(path)
+            readers[name].start()
+         commands = commands.replace('out %s ' % name, 'out %s ' % path)
+
       process = Popen([self.cpptraj, self.parm], stdin=PIPE,
                       stdout=self.logfile, stderr=self.logfile)
       
       print >> self.logfile, 'Running cpptraj:'
-      process.communicate(cmd_str + self._cpptraj_commands)
+      process.communicate(cmd_str + commands)
+
+      failed = process.wait()
+      # A data file that was never written means the run failed, but an
+      # empty one is just an empty data set
+      for name, reader in readers.items():
+         reader.release()
+         if reader.opened:
+            self._store(self._captures[name], reader.text)
+         else:
+            failed = True
+      for name in self._captures:
+         if name in readers: continue
+         if name in self._outfiles:
+            path = name
+         else:
+            path = os.path.join(tmpdir, name)
+         if os.path.exists(path):
+            self._store(self._captures[name], open(path, 'r').read())
+         elif name not in self._outfiles:
+            failed = True
+      if tmpdir is not None:
+         shutil.rmtree(tmpdir, ignore_errors=True)
+
+      if failed:
+         print >> self.logfile, 'Running cpptraj failed.'
+      else:
+         print >> self.logfile, 'cpptraj ran successfully!'
+
+   #===================================================
+
+   def _windows(self, nproc):
+      """ Splits the frames that will be read into at most nproc contiguous
+          windows. Returns a list of (first frame offset, trajin list) where
+          each trajin is a (traj, start, end, stride) tuple
+      """
+      # Number of frames read from each trajectory
+      counts = [max(0, (self.end[i] - self.start[i]) // self.stride[i] + 1)
+                for i in range(len(self.traj_name_list))]
+      total = sum(counts)
+      nproc = max(1, min(nproc, total))
+      windows = []
+      for k in range(nproc):
+         # Global frame range [first, last) of this window
+         first, last = k * total // nproc, (k + 1) * total // nproc
+         trajins = []
+         offset = 0
+         for i, traj in enumerate(self.traj_name_list):
+            lo, hi = max(first, offset), min(last, offset + counts[i])
+            if lo < hi:
+               start = self.start[i] + (lo - offset) * self.stride[i]
+               end = self.start[i] + (hi - offset - 1) * self.stride[i]
+               trajins.append((traj, start, end, self.stride[i]))
+            offset += counts[i]
+         windows.append((first, trajins))
+      return windows
+
+   #===================================================
+
+   def _ref_first(self, commands, refname):
+      """ Replaces the 'first' reference argument of the rms/rmsd actions in
+          commands with 'ref refname', leaving data set names, masks and file
+          names alone
+      """
+      lines = []
+      for line in commands.split('\n'):
+         words = list(re.finditer(r'\S+', line))
+         if words and words[0].group() in ('rms', 'rmsd'):
+            # Go backwards so the earlier word positions stay valid. Word 1
+            # is the data set name
+            for i in range(len(words) - 1, 1, -1):
+               if words[i].group() == 'first' and words[i-1].group() != 'out':
+                  line = line[:words[i].start()] + 'ref %s' % refname + \
+                         line[words[i].end():]
+         lines.append(line)
+      return '\n'.join(lines)
+
+   #===================================================
 
-      if process.wait():
+   def _run_parallel(self, nproc):
+      " Runs cpptraj over disjoint frame windows at once and merges the output "
+      windows = self._windows(nproc)
+      tmpdir = tempfile.mkdtemp(prefix='ambertraj')
+      commands = self._cpptraj_commands
+      # A 'first' reference must be the first frame of the whole run
+      if self._uses_first and windows[0][1]:
+         traj, start = windows[0][1][0][:2]
+         commands = self._ref_first(commands, '[ambertraj_first]')
+         commands = 'reference %s %d [ambertraj_first]\n' % (traj, start) + \
+                    commands
+      processes = []
+      print >> self.logfile, 'Running cpptraj on %d processors:' % len(windows)
+      for k, (first, trajins) in enumerate(windows):
+         cmd_str = ''
+         for trajin in trajins:
+            cmd_str += 'trajin %s %d %d %d \n' % trajin
+         # Each worker writes to its own copies of the data files
+         my_commands = commands
+         for outfile in self._outfiles + [name for name in self._captures
+                                          if name not in self._outfiles]:
+            my_commands = my_commands.replace('out %s ' % outfile, 'out %s ' %
+                     os.path.join(tmpdir, '%d.%s' % (k, os.path.basename(outfile))))
+         log = open(os.path.join(tmpdir, '%d.log' % k), 'w')
+         process = Popen([self.cpptraj, self.parm], stdin=PIPE, stdout=log,
+                         stderr=log)
+         process.stdin.write(cmd_str + my_commands)
+         process.stdin.close()
+         processes.append((process, log))
+      failed = False
+      for k, (process, log) in enumerate(processes):
+         failed = process.wait() or failed
+         log.close()
+         self.logfile.write(open(os.path.join(tmpdir, '%d.log' % k)).read())
+      # Merge the data files, renumbering the frames
+      for outfile in self._outfiles + [name for name in self._captures
+                                       if name not in self._outfiles]:
+         if outfile in self._outfiles:
+            out = open(outfile, 'w')
+         else:
+            out = StringIO()
+         for k, (first, trajins) in enumerate(windows):
+            fname = os.path.join(tmpdir, '%d.%s' % (k, os.path.basename(outfile)))
+            if not os.path.exists(fname):
+               failed = True
+               continue
+            for line in open(fname, 'r'):
+               if line.startswith('#'):
+                  if k == 0: out.write(line)
+                  continue
+               frame = re.match(r'(\s*)(\d+)', line)
+               if frame is None:
+                  out.write(line)
+                  continue
+               width = len(frame.group(0))
+               out.write('%*d' % (width, int(frame.group(2)) + first) +
+                         line[width:])
+         if outfile in self._outfiles:
+            out.close()
+            if outfile in self._captures:
+               self._store(self._captures[outfile], open(outfile, 'r').read())
+         else:
+            self._store(self._captures[outfile], out.getvalue())
+      shutil.rmtree(tmpdir, ignore_errors=True)
+
+      if failed:
          print >> self.logfile, 'Running cpptraj failed.'
       else:
          print >> self.logfile, 'cpptraj ran successfully!'
@@ -180,24 +580,10 @@ class RmsdData(object):
    numpy arrays
    """
    def __init__(self, fname, col=1):
-      from utilities import linecount
       if not os.path.exists(fname):
          raise RMSError('RmsdData: Non-existent file %s' % fname)
-      data_re = re.compile(r'\s*(\d+)')
-      nums_re = re.compile(r'([+-]?(?:\d+(?:\.\d*)?|\.\d+)(?:[eE][-+]?\d+)?)')
-      # Find the number of lines in the 
-      numframes = linecount(fname)
-      # Load the numpy array
-      self.data = np.empty(numframes)
-      idx = 0
-      for line in open(fname, 'r'):
-         if not data_re.match(line): continue
-         # The header line doesn't match
-         cols = nums_re.findall(line)
-         # cols is every number in the line, separated by column. The first
-         # number is the frame number
-         self.data[idx] = float(cols[col])
-         idx += 1
+      # column 0 is the frame number
+      self.data = load_data(fname, cols=[col]).values()[0]
 
 #~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~
 
@@ -209,6 +595,8 @@ if __name__ == '__main__':
    parser = OptionParser('python %prog [Options] mdcrd1 [mdcrd2 [...] ]')
    parser.add_option('-p', '--parm', dest='prmtop', metavar='FILE',
                    default=None, help='Topology file matching the trajectories')
+   parser.add_option('-n', '--nproc', dest='nproc', metavar='INT', type='int',
+                   default=1, help='Number of cpptraj processes to run at once')
    opt, args = parser.parse_args()
 
    if not args or not opt.prmtop:
@@ -228,7 +616,7 @@ if __name__ == '__main__':
    # Test the RMSd
    mytraj.rmsd(outfile='AmberTraj_RMSD.dat')
 
-   mytraj.run()
+   mytraj.run(opt.nproc)
 
    # Now test the RMSd class
 